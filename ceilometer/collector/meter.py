@@ -18,22 +18,45 @@
 """Compute the signature of a metering message.
 """
 
+import base64
 import hashlib
 import hmac
+import itertools
 import uuid
+import zlib
 
 from oslo.config import cfg
 
+from ceilometer.openstack.common import jsonutils
+from ceilometer import utils
+
 METER_OPTS = [
     cfg.StrOpt('metering_secret',
                default='change this or be hacked',
                help='Secret value for signing metering messages',
                ),
+    cfg.IntOpt('metering_partitions',
+               default=0,
+               help='number of <metering_topic>.p<N> topics the metering '
+               'messages are spread over by resource, 0 to use the '
+               'metering topic only',
+               ),
+    cfg.ListOpt('metering_priorities',
+                default=[],
+                help='priority classes of the pipelines, as name:weight, '
+                'whose metering messages go to their own '
+                '<metering_topic>-<name> topic and are recorded by the '
+                'collector in proportion to their weight; the "default" '
+                'class is the metering topic itself, of weight 1 unless '
+                'listed',
+                ),
 ]
 
+DEFAULT_PRIORITY = 'default'
+
 
 def register_opts(config):
-    """Register the options for signing metering messages.
+    """Register the options for signing and routing metering messages.
     """
     config.register_opts(METER_OPTS)
 
@@ -41,6 +64,38 @@ def register_opts(config):
 register_opts(cfg.CONF)
 
 
+def partition_topic(topic, resource_id, partitions):
+    """Return the partitioned metering topic of a resource."""
+    return '%s.p%d' % (topic, utils.stable_hash(resource_id) % partitions)
+
+
+def get_priorities(values):
+    """Return the weights of the priority classes, by name.
+
+    :param values: name:weight strings, as in the metering_priorities
+                   option.
+    """
+    weights = {DEFAULT_PRIORITY: 1}
+    for value in values:
+        name, sep, weight = value.partition(':')
+        try:
+            weights[name.strip()] = int(weight) if sep else 1
+        except ValueError:
+            raise ValueError('invalid weight of priority class %s: %s'
+                             % (name, weight))
+        if weights[name.strip()] <= 0:
+            raise ValueError('weight of priority class %s should be > 0'
+                             % name)
+    return weights
+
+
+def priority_topic(topic, priority):
+    """Return the metering topic of a priority class."""
+    if not priority or priority == DEFAULT_PRIORITY:
+        return topic
+    return '%s-%s' % (topic, priority)
+
+
 def recursive_keypairs(d):
     """Generator that produces sequence of keypairs for nested dictionaries.
     """
@@ -101,3 +156,138 @@ def meter_message_from_counter(counter, secret, source):
            }
     msg['message_signature'] = compute_signature(msg, secret)
     return msg
+
+
+# Fields of the metering messages with a small set of distinct values in
+# a batch, which are stored in the columnar format as indexes in the
+# string table.
+DICTIONARY_FIELDS = frozenset(['source',
+                               'counter_name',
+                               'counter_type',
+                               'counter_unit',
+                               'user_id',
+                               'project_id',
+                               'resource_id',
+                               ])
+
+COLUMNAR_ENCODING = 'columnar'
+
+
+def encode_meters(meters):
+    """Encode a list of metering messages into the columnar format.
+
+    Each field is stored as a column holding the values of every
+    message. Low-cardinality fields are stored as indexes into a per
+    batch string table, and the resource metadata as indexes into a
+    list of distinct metadata.
+
+    All the messages must have the same fields.
+    """
+    fields = sorted(meters[0]) if meters else []
+    if any(len(meter) != len(fields) for meter in meters):
+        raise ValueError('all metering messages must have the same '
+                         'fields to be encoded')
+    strings = {}
+    metadata = {}
+    columns = {}
+    for field in fields:
+        values = [meter[field] for meter in meters]
+        if field in DICTIONARY_FIELDS:
+            values = [strings.setdefault(value, len(strings))
+                      for value in values]
+        elif field == 'resource_metadata':
+            # NOTE: equal metadata with nested values built in a
+            # different order may not be shared, which is harmless.
+            values = [metadata.setdefault(
+                repr(sorted(value.iteritems()))
+                if isinstance(value, dict) else repr(value),
+                (len(metadata), value))[0]
+                for value in values]
+        columns[field] = values
+    return {'count': len(meters),
+            'strings': sorted(strings, key=strings.get),
+            'metadata': [value for index, value in
+                         sorted(metadata.itervalues())],
+            'columns': columns,
+            }
+
+
+def _check_indexes(values, table, field):
+    """Check that the values of a column are indexes of a table."""
+    for value in values:
+        if (not isinstance(value, (int, long)) or isinstance(value, bool)
+                or not 0 <= value < len(table)):
+            raise ValueError('invalid index %r in column %s' %
+                             (value, field))
+
+
+def decode_meters(payload):
+    """Decode metering messages encoded by encode_meters().
+
+    Raises ValueError if the payload is malformed.
+    """
+    if not isinstance(payload, dict):
+        raise ValueError('columnar payload should be a dict')
+    missing = set(['count', 'strings', 'metadata', 'columns']) - set(payload)
+    if missing:
+        raise ValueError('columnar payload misses %s' %
+                         ', '.join(sorted(missing)))
+    count = payload['count']
+    strings = payload['strings']
+    metadata = payload['metadata']
+    columns = payload['columns']
+    if not isinstance(count, (int, long)) or count < 0:
+        raise ValueError('invalid count of metering messages %r' % count)
+    if not isinstance(strings, list):
+        raise ValueError('the string table should be a list')
+    if (not isinstance(metadata, list)
+            or not all(isinstance(m, dict) for m in metadata)):
+        raise ValueError('the metadata should be a list of dicts')
+    if not isinstance(columns, dict):
+        raise ValueError('the columns should be a dict')
+    for field, values in columns.iteritems():
+        if not isinstance(values, list) or len(values) != count:
+            raise ValueError('column %s should hold %d values' %
+                             (field, count))
+        if field in DICTIONARY_FIELDS:
+            _check_indexes(values, strings, field)
+        elif field == 'resource_metadata':
+            _check_indexes(values, metadata, field)
+
+    meters = [{} for i in xrange(count)]
+    for field, values in columns.iteritems():
+        if field in DICTIONARY_FIELDS:
+            values = [strings[i] for i in values]
+        elif field == 'resource_metadata':
+            values = [dict(metadata[i]) for i in values]
+        for meter, value in itertools.izip(meters, values):
+            meter[field] = value
+    return meters
+
+
+ZLIB_COMPRESSION = 'zlib'
+
+
+def compress_data(data, compression, level=6, threshold=0):
+    """Compress the data of a metering message.
+
+    The data is serialized to JSON, compressed and base64 encoded so
+    that it can be sent by any rpc driver. Returns None when the
+    serialized data is smaller than `threshold` bytes.
+    """
+    if compression != ZLIB_COMPRESSION:
+        raise ValueError('unknown metering data compression %s' %
+                         compression)
+    payload = jsonutils.dumps(data)
+    if len(payload) < threshold:
+        return None
+    return base64.b64encode(zlib.compress(payload, level))
+
+
+def decompress_data(payload, compression):
+    """Decompress data compressed by compress_data().
+    """
+    if compression != ZLIB_COMPRESSION:
+        raise ValueError('unknown metering data compression %s' %
+                         compression)
+    return jsonutils.loads(zlib.decompress(base64.b64decode(payload)))
@@ -0,0 +1,153 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Green thread pools preserving the ordering of jobs sharing a key, or
+sharing the workers between lanes of jobs by weight.
+"""
+
+import collections
+
+from eventlet import greenpool
+from eventlet import semaphore
+
+from ceilometer.openstack.common import log
+
+
+LOG = log.getLogger(__name__)
+
+
+class OrderedGreenPool(object):
+    """Run jobs concurrently, serializing the ones sharing the same key.
+
+    Jobs submitted with the same key are run one after the other, in
+    the order they have been submitted, while jobs with different keys
+    are spread over at most `size` green threads. Once `max_in_flight`
+    jobs are waiting or running, `submit()` blocks the caller until one
+    of them is done.
+    """
+
+    def __init__(self, size, max_in_flight):
+        self._pool = greenpool.GreenPool(size)
+        self._in_flight = semaphore.Semaphore(max_in_flight)
+        self._queues = {}
+
+    def submit(self, key, func, *args, **kwargs):
+        self._in_flight.acquire()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+            queue.append((func, args, kwargs))
+            self._pool.spawn_n(self._drain, key, queue)
+        else:
+            queue.append((func, args, kwargs))
+
+    def _drain(self, key, queue):
+        while queue:
+            func, args, kwargs = queue[0]
+            try:
+                func(*args, **kwargs)
+            except Exception as err:
+                LOG.error('error processing job for %s: %s', key, err)
+                LOG.exception(err)
+            finally:
+                queue.popleft()
+                self._in_flight.release()
+        del self._queues[key]
+
+    def running(self):
+        """Return the number of jobs waiting or running."""
+        return sum(len(q) for q in self._queues.values())
+
+    def waitall(self):
+        """Wait for all the submitted jobs to be processed."""
+        self._pool.waitall()
+
+
+class WeightedFairPool(object):
+    """Run the jobs queued in several lanes in proportion to their weights.
+
+    The jobs are run by at most `size` green threads, which always pick
+    the next job of the lane with pending jobs that received the least
+    service relative to its weight: while all the lanes have jobs
+    waiting, a lane of weight 4 gets four jobs run for each one of a
+    lane of weight 1, and an idle lane leaves its share to the others
+    without accumulating credit. Once `max_in_flight` jobs of a lane are
+    waiting or running, `submit()` blocks the callers submitting to
+    that lane only.
+
+    :param weights: Weights of the lanes, by name.
+    """
+
+    def __init__(self, weights, size, max_in_flight):
+        self.weights = weights
+        self._pool = greenpool.GreenPool(size)
+        self._queues = dict((lane, collections.deque()) for lane in weights)
+        self._in_flight = dict((lane, semaphore.Semaphore(max_in_flight))
+                               for lane in weights)
+        # Virtual time at which each lane has its next job run, and
+        # virtual time of the last job run
+        self._start = dict((lane, 0.0) for lane in weights)
+        self._now = 0.0
+        self._workers = 0
+        self.done = dict((lane, 0) for lane in weights)
+
+    def submit(self, lane, func, *args, **kwargs):
+        self._in_flight[lane].acquire()
+        queue = self._queues[lane]
+        if not queue:
+            self._start[lane] = max(self._start[lane], self._now)
+        queue.append((func, args, kwargs))
+        if self._workers < self._pool.size:
+            self._workers += 1
+            self._pool.spawn_n(self._work)
+
+    def _next_lane(self):
+        lanes = [lane for lane, queue in self._queues.iteritems() if queue]
+        if not lanes:
+            return None
+        lane = min(lanes, key=lambda l: (self._start[l], l))
+        self._now = self._start[lane]
+        self._start[lane] += 1.0 / self.weights[lane]
+        return lane
+
+    def _work(self):
+        try:
+            while True:
+                lane = self._next_lane()
+                if lane is None:
+                    return
+                func, args, kwargs = self._queues[lane].popleft()
+                try:
+                    func(*args, **kwargs)
+                except Exception as err:
+                    LOG.error('error processing job of lane %s: %s',
+                              lane, err)
+                    LOG.exception(err)
+                finally:
+                    self.done[lane] += 1
+                    self._in_flight[lane].release()
+        finally:
+            self._workers -= 1
+
+    def running(self, lane=None):
+        """Return the number of jobs waiting, of a lane or of all of them.
+        """
+        if lane is not None:
+            return len(self._queues[lane])
+        return sum(len(q) for q in self._queues.values())
+
+    def waitall(self):
+        """Wait for all the submitted jobs to be processed."""
+        self._pool.waitall()
@@ -16,11 +16,20 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import fnmatch
+import itertools
+import operator
+import socket
+
 from oslo.config import cfg
 
 from ceilometer.collector import meter as meter_api
+from ceilometer.collector import pool
+from ceilometer.collector import stats
+from ceilometer import counter
 from ceilometer import extension_manager
 from ceilometer.openstack.common import context
+from ceilometer.openstack.common import jsonutils
 from ceilometer.openstack.common import log
 from ceilometer.openstack.common.rpc import dispatcher as rpc_dispatcher
 
@@ -34,6 +43,7 @@ from ceilometer import pipeline
 from ceilometer import publisher
 from ceilometer import service
 from ceilometer import storage
+from ceilometer.storage import cache
 from ceilometer import transformer
 
 OPTS = [
@@ -41,23 +51,157 @@ OPTS = [
                 default=[],
                 help='list of listener plugins to disable',
                 ),
+    cfg.IntOpt('notification_workers',
+               default=16,
+               help='number of green threads publishing the counters '
+               'built from notifications',
+               ),
+    cfg.IntOpt('notification_max_in_flight',
+               default=256,
+               help='maximum number of notifications being processed '
+               'before the collector stops consuming new ones',
+               ),
+    cfg.IntOpt('metering_data_log_rate',
+               default=100,
+               help='log one metering data out of this many received, '
+               'at debug level (0 to disable)',
+               ),
+    cfg.FloatOpt('slow_write_threshold',
+                 default=1.0,
+                 help='seconds above which a metering data write is '
+                 'logged as slow',
+                 ),
+    cfg.IntOpt('write_profile_rate',
+               default=0,
+               help='profile one metering data write out of this many, '
+               'logging the profile of slow ones (0 to disable)',
+               ),
+    cfg.BoolOpt('collector_self_metering',
+                default=False,
+                help='publish the write path timings of the collector '
+                'as counters',
+                ),
+    cfg.IntOpt('rollup_compaction_interval',
+               default=3600,
+               help='seconds between two compactions of the rollups of '
+               'the samples recorded, 0 to disable it, for instance when '
+               'ceilometer-rollup-compactor is run periodically instead',
+               ),
+    cfg.StrOpt('udp_address',
+               default='',
+               help='address to bind the UDP socket receiving metering '
+               'messages to, empty to disable it',
+               ),
+    cfg.IntOpt('udp_port',
+               default=4952,
+               help='port to bind the UDP socket receiving metering '
+               'messages to',
+               ),
+    cfg.ListOpt('metering_consumed_partitions',
+                default=[],
+                help='indexes of the metering topic partitions consumed by '
+                'this collector, empty for all of them',
+                ),
+    cfg.IntOpt('metering_priority_workers',
+               default=16,
+               help='number of green threads recording the metering data '
+               'of the priority classes, when some are configured',
+               ),
+    cfg.IntOpt('metering_priority_max_in_flight',
+               default=64,
+               help='maximum number of metering messages of a priority '
+               'class being recorded before the collector stops '
+               'consuming new ones of that class',
+               ),
 ]
 
 cfg.CONF.register_opts(OPTS)
 
 LOG = log.getLogger(__name__)
 
+# Number of event types matching a wildcard whose handlers are cached
+EVENT_TYPE_CACHE_SIZE = 1000
+
 
 class CollectorService(service.PeriodicService):
 
     COLLECTOR_NAMESPACE = 'ceilometer.collector'
 
+    # Version 1.1 adds the encoding argument to record_metering_data
+    # Version 1.2 adds the compression argument to record_metering_data
+    RPC_API_VERSION = '1.2'
+
+    WRITE_STAGES = ['decode', 'verify', 'normalize', 'store']
+
+    def __init__(self, host, topic, manager=None):
+        super(CollectorService, self).__init__(host, topic, manager)
+        self.notification_pool = pool.OrderedGreenPool(
+            cfg.CONF.notification_workers,
+            cfg.CONF.notification_max_in_flight,
+        )
+        self.write_stats = stats.WriteStats(self.WRITE_STAGES,
+                                            cfg.CONF.slow_write_threshold,
+                                            cfg.CONF.write_profile_rate)
+        self._metering_data_received = 0
+        # Set up once the rpc connection is created
+        self.pipeline_manager = None
+        if cfg.CONF.metering_priorities:
+            self.metering_pool = pool.WeightedFairPool(
+                meter_api.get_priorities(cfg.CONF.metering_priorities),
+                cfg.CONF.metering_priority_workers,
+                cfg.CONF.metering_priority_max_in_flight,
+            )
+        else:
+            self.metering_pool = None
+
     def start(self):
         super(CollectorService, self).start()
 
         storage.register_opts(cfg.CONF)
         self.storage_engine = storage.get_engine(cfg.CONF)
         self.storage_conn = self.storage_engine.get_connection(cfg.CONF)
+        interval = cfg.CONF.rollup_compaction_interval
+        if interval > 0:
+            self.tg.add_timer(interval, self.compact_rollups,
+                              initial_delay=interval)
+
+        if cfg.CONF.udp_address:
+            self.udp_socket = socket.socket(socket.AF_INET,
+                                            socket.SOCK_DGRAM)
+            self.udp_socket.bind((cfg.CONF.udp_address,
+                                  cfg.CONF.udp_port))
+            self.tg.add_thread(self.consume_udp)
+
+    def compact_rollups(self):
+        """Merge the rows of the rollups written since the last compaction,
+        not to let them grow with the samples.
+        """
+        try:
+            self.storage_conn.compact_rollups()
+        except Exception as err:
+            LOG.warning('Failed to compact the rollups: %s', err)
+            LOG.exception(err)
+
+    def consume_udp(self):
+        while True:
+            self.receive_udp()
+
+    def receive_udp(self):
+        """Record the metering messages of one UDP datagram.
+
+        A malformed datagram is logged and discarded, it must not stop the
+        listener.
+        """
+        datagram, source = self.udp_socket.recvfrom(64 * 1024)
+        try:
+            msg = jsonutils.loads(datagram)
+            data = msg['data']
+            self.record_metering_data(context.get_admin_context(), data,
+                                      encoding=msg.get('encoding'),
+                                      compression=msg.get('compression'))
+        except Exception as err:
+            LOG.warning('UDP: unable to record datagram sent by %s:%d: %s',
+                        source[0], source[1], err)
 
     def initialize_service_hook(self, service):
         '''Consumers must be declared before consume_thread start.'''
@@ -83,14 +227,41 @@ class CollectorService(service.PeriodicService):
             LOG.warning('Failed to load any notification handlers for %s',
                         self.COLLECTOR_NAMESPACE)
         self.notification_manager.map(self._setup_subscription)
+        self._build_event_type_index()
+
+        self._setup_metering_workers()
+
+    def _metering_topics(self, topic=None):
+        topic = topic or cfg.CONF.metering_topic
+        topics = [topic]
+        partitions = cfg.CONF.metering_partitions
+        if partitions > 0:
+            consumed = (cfg.CONF.metering_consumed_partitions or
+                        range(partitions))
+            topics.extend('%s.p%d' % (topic, int(p)) for p in consumed)
+        return topics
 
+    def _setup_metering_workers(self):
         # Set ourselves up as a separate worker for the metering data,
         # since the default for service is to use create_consumer().
-        self.conn.create_worker(
-            cfg.CONF.metering_topic,
-            rpc_dispatcher.RpcDispatcher([self]),
-            'ceilometer.collector.' + cfg.CONF.metering_topic,
-        )
+        # The unpartitioned topic is still consumed for the agents not
+        # partitioning their metering messages.
+        if self.metering_pool is None:
+            lanes = [(cfg.CONF.metering_topic, self)]
+        else:
+            # The messages of each priority class are queued into the
+            # pool, which records them in proportion to the class weight.
+            lanes = [(meter_api.priority_topic(cfg.CONF.metering_topic,
+                                               priority),
+                      MeteringLane(self, priority))
+                     for priority in sorted(self.metering_pool.weights)]
+        for lane_topic, endpoint in lanes:
+            for topic in self._metering_topics(lane_topic):
+                self.conn.create_worker(
+                    topic,
+                    rpc_dispatcher.RpcDispatcher([endpoint]),
+                    'ceilometer.collector.' + topic,
+                )
 
     def _setup_subscription(self, ext, *args, **kwds):
         handler = ext.obj
@@ -109,52 +280,256 @@ class CollectorService(service.PeriodicService):
                     LOG.exception('Could not join consumer pool %s/%s' %
                                   (topic, exchange_topic.exchange))
 
+    def _build_event_type_index(self):
+        """Map event types to the notification handlers accepting them.
+
+        Event types containing shell-style wildcards are kept aside
+        and resolved the first time a matching event type is seen, the
+        handlers of the most recent ones being cached.
+        """
+        self._handlers = []
+        self._event_type_index = {}
+        self._wildcard_index = cache.BoundedCache(EVENT_TYPE_CACHE_SIZE)
+        for ext in self.notification_manager:
+            event_types = ext.obj.get_event_types()
+            self._handlers.append((
+                ext,
+                frozenset(t for t in event_types if '*' not in t),
+                [t for t in event_types if '*' in t],
+            ))
+            for event_type in event_types:
+                if '*' not in event_type:
+                    self._event_type_index.setdefault(event_type, [])
+        for event_type in self._event_type_index:
+            self._event_type_index[event_type] = self._match_handlers(
+                event_type)
+
+    def _match_handlers(self, event_type):
+        return [ext for ext, exact, patterns in self._handlers
+                if event_type in exact
+                or any(fnmatch.fnmatchcase(event_type, pattern)
+                       for pattern in patterns)]
+
+    def _handlers_for_event_type(self, event_type):
+        handlers = self._event_type_index.get(event_type)
+        if handlers is None:
+            handlers = self._wildcard_index.get(event_type)
+        if handlers is None:
+            handlers = self._match_handlers(event_type)
+            # The event types without handler are not remembered
+            if handlers:
+                self._wildcard_index.set(event_type, handlers)
+        return handlers
+
     def process_notification(self, notification):
-        """Make a notification processed by an handler."""
+        """Make a notification processed by an handler.
+
+        The counters are published from the notification pool, those
+        of a given resource being published in the order their
+        notifications have been received.
+        """
         LOG.debug('notification %r', notification.get('event_type'))
-        self.notification_manager.map(self._process_notification_for_ext,
-                                      notification=notification,
-                                      )
+        handlers = self._handlers_for_event_type(notification['event_type'])
+        counters = []
+        for ext in handlers:
+            try:
+                counters.extend(ext.obj.process_notification(notification))
+            except Exception as err:
+                LOG.error('error calling %r: %s', ext.name, err)
+                LOG.exception(err)
+        key = operator.attrgetter('resource_id')
+        for resource_id, resource_counters in itertools.groupby(
+                sorted(counters, key=key), key):
+            self.notification_pool.submit(resource_id,
+                                          self._publish_counters,
+                                          list(resource_counters))
 
-    def _process_notification_for_ext(self, ext, notification):
-        handler = ext.obj
-        if notification['event_type'] in handler.get_event_types():
-            ctxt = context.get_admin_context()
-            with self.pipeline_manager.publisher(ctxt,
-                                                 cfg.CONF.counter_source) as p:
-                # FIXME(dhellmann): Spawn green thread?
-                p(list(handler.process_notification(notification)))
-
-    def record_metering_data(self, context, data):
+    def _publish_counters(self, counters):
+        ctxt = context.get_admin_context()
+        with self.pipeline_manager.publisher(ctxt,
+                                             cfg.CONF.counter_source) as p:
+            p(counters)
+
+    def record_metering_data(self, context, data, encoding=None,
+                             compression=None):
         """This method is triggered when metering data is
         cast from an agent.
         """
-        # We may have receive only one counter on the wire
-        if not isinstance(data, list):
-            data = [data]
+        with self.write_stats.time('decode'):
+            if compression:
+                try:
+                    data = meter_api.decompress_data(data, compression)
+                except Exception as err:
+                    LOG.error('unable to decompress %s metering data, '
+                              'discarding message: %s', compression, err)
+                    return
+            if encoding == meter_api.COLUMNAR_ENCODING:
+                try:
+                    data = meter_api.decode_meters(data)
+                except ValueError as err:
+                    LOG.error('unable to decode columnar metering data, '
+                              'discarding message: %s', err)
+                    return
+            elif encoding:
+                LOG.error('unknown metering data encoding %s, '
+                          'discarding message', encoding)
+                return
+            # We may have receive only one counter on the wire
+            elif not isinstance(data, list):
+                data = [data]
 
+        log_rate = cfg.CONF.metering_data_log_rate
+        meters = []
         for meter in data:
-            LOG.info('metering data %s for %s @ %s: %s',
-                     meter['counter_name'],
-                     meter['resource_id'],
-                     meter.get('timestamp', 'NO TIMESTAMP'),
-                     meter['counter_volume'])
-            if meter_api.verify_signature(meter, cfg.CONF.metering_secret):
+            if not isinstance(meter, dict):
+                LOG.warning('metering data is not a dict, discarding '
+                            'message: %r', meter)
+                continue
+            self._metering_data_received += 1
+            if log_rate and not self._metering_data_received % log_rate:
+                LOG.debug('metering data %s for %s @ %s: %s',
+                          meter.get('counter_name'),
+                          meter.get('resource_id'),
+                          meter.get('timestamp', 'NO TIMESTAMP'),
+                          meter.get('counter_volume'))
+            with self.write_stats.time('verify'):
+                valid = meter_api.verify_signature(meter,
+                                                   cfg.CONF.metering_secret)
+            if valid:
                 try:
                     # Convert the timestamp to a datetime instance.
                     # Storage engines are responsible for converting
                     # that value to something they can store.
-                    if meter.get('timestamp'):
-                        ts = timeutils.parse_isotime(meter['timestamp'])
-                        meter['timestamp'] = timeutils.normalize_time(ts)
-                    self.storage_conn.record_metering_data(meter)
+                    with self.write_stats.time('normalize'):
+                        if meter.get('timestamp'):
+                            ts = timeutils.parse_isotime(meter['timestamp'])
+                            meter['timestamp'] = timeutils.normalize_time(ts)
                 except Exception as err:
-                    LOG.error('Failed to record metering data: %s', err)
+                    LOG.error('Failed to normalize metering data: %s', err)
                     LOG.exception(err)
+                else:
+                    meters.append(meter)
             else:
                 LOG.warning(
                     'message signature invalid, discarding message: %r',
                     meter)
 
+        if meters:
+            self._record_meters(meters)
+
+    def _record_meters(self, meters):
+        """Write the metering data of a message at once, one at a time if
+        the batch fails so that a single bad sample is the only one lost.
+        """
+        with self.write_stats.write('%d metering data' % len(meters)):
+            with self.write_stats.time('store'):
+                try:
+                    self.storage_conn.record_metering_batch(meters)
+                except Exception as err:
+                    LOG.error('Failed to record a batch of %d metering '
+                              'data, recording them one at a time: %s',
+                              len(meters), err)
+                    LOG.exception(err)
+                    for meter in meters:
+                        try:
+                            self.storage_conn.record_metering_data(meter)
+                        except Exception as err:
+                            LOG.error('Failed to record metering data: %s',
+                                      err)
+                            LOG.exception(err)
+
+    def stop(self):
+        super(CollectorService, self).stop()
+        # Let the notifications already accepted go through the
+        # pipelines before exiting.
+        self.notification_pool.waitall()
+        if self.metering_pool is not None:
+            self.metering_pool.waitall()
+        self.flush_publishers()
+
+    def flush_publishers(self):
+        """Publish the counters still held by the publishers."""
+        if self.pipeline_manager is not None:
+            self.pipeline_manager.flush_publishers()
+
     def periodic_tasks(self, context):
-        pass
+        LOG.info('metering data write stats '
+                 '(count/avg/p99/max per stage): %s',
+                 self.write_stats.report())
+        cache_stats = self.storage_conn.get_cache_stats()
+        if cache_stats:
+            LOG.info('storage cache stats (hits/misses): %s',
+                     ', '.join('%s %d/%d' % (name, s['hits'], s['misses'])
+                               for name, s in sorted(cache_stats.items())))
+        if self.metering_pool is not None:
+            LOG.info('metering data per priority class (recorded/waiting): '
+                     '%s', ', '.join('%s %d/%d' % (
+                         priority, self.metering_pool.done[priority],
+                         self.metering_pool.running(priority))
+                         for priority in sorted(self.metering_pool.weights)))
+        if cfg.CONF.collector_self_metering:
+            self._publish_write_stats(context, cache_stats)
+        self.write_stats.reset()
+
+    def _publish_write_stats(self, context, cache_stats=None):
+        timestamp = timeutils.utcnow().isoformat()
+        counters = [
+            counter.Counter(
+                name='collector.write.' + stage,
+                type=counter.TYPE_GAUGE,
+                unit='ms',
+                volume=histogram.average,
+                user_id=None,
+                project_id=None,
+                resource_id=cfg.CONF.host,
+                timestamp=timestamp,
+                resource_metadata={'count': histogram.count,
+                                   'p99': histogram.percentile(99),
+                                   'max': histogram.max},
+            )
+            for stage, histogram in sorted(
+                self.write_stats.histograms.items())
+            if histogram.count
+        ]
+        # The hits and misses of the storage caches are counted since the
+        # collector started.
+        counters.extend(
+            counter.Counter(
+                name='collector.cache.' + name,
+                type=counter.TYPE_GAUGE,
+                unit='%',
+                volume=100.0 * s['hits'] / (s['hits'] + s['misses']),
+                user_id=None,
+                project_id=None,
+                resource_id=cfg.CONF.host,
+                timestamp=timestamp,
+                resource_metadata={'hits': s['hits'],
+                                   'misses': s['misses']},
+            )
+            for name, s in sorted((cache_stats or {}).items())
+            if s['hits'] + s['misses']
+        )
+        if counters:
+            with self.pipeline_manager.publisher(
+                    context, cfg.CONF.counter_source) as p:
+                p(counters)
+
+
+class MeteringLane(object):
+    """Endpoint queueing the metering data of a priority class into the
+    weighted fair pool of the collector.
+    """
+
+    RPC_API_VERSION = CollectorService.RPC_API_VERSION
+
+    def __init__(self, collector, priority):
+        self.collector = collector
+        self.priority = priority
+
+    def record_metering_data(self, context, data, encoding=None,
+                             compression=None):
+        self.collector.metering_pool.submit(
+            self.priority,
+            self.collector.record_metering_data,
+            context, data, encoding=encoding, compression=compression,
+        )
@@ -0,0 +1,156 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Timing statistics for the collector write path.
+"""
+
+import bisect
+import contextlib
+import cProfile
+import pstats
+import StringIO
+import time
+
+from ceilometer.openstack.common import log
+
+
+LOG = log.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in milliseconds.
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class Histogram(object):
+    """Distribution of durations over fixed logarithmic buckets."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        """Record a duration, in milliseconds."""
+        self.counts[bisect.bisect_left(BUCKETS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket holding the percentile.
+
+        The value is approximated by the bucket bound, or the maximum
+        recorded duration for the last, unbounded, bucket.
+        """
+        if not self.count:
+            return 0.0
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= threshold:
+                return min(bound, self.max)
+        return self.max
+
+
+class WriteStats(object):
+    """Per-stage timings of the metering data write path.
+
+    :param stages: Names of the stages to time.
+    :param slow_threshold: Duration in seconds above which a write is
+                           reported as slow.
+    :param profile_rate: Profile one write out of `profile_rate`, and
+                         log the profile when it turns out to be slow.
+                         0 disables profiling.
+
+    The profiler hooks the whole OS thread, shared by the green threads
+    writing concurrently: a single write is profiled at a time, and the
+    time the other green threads run while it waits on I/O is counted in
+    its profile.
+    """
+
+    def __init__(self, stages, slow_threshold, profile_rate=0):
+        self.stages = stages
+        self.histograms = dict((stage, Histogram()) for stage in stages)
+        self.slow_threshold = slow_threshold
+        self.profile_rate = profile_rate
+        self.slow_writes = 0
+        self._writes = 0
+        self._profiling = False
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.histograms[stage].add((time.time() - start) * 1000)
+
+    @contextlib.contextmanager
+    def write(self, description):
+        """Time a whole write, profiling a sample of them."""
+        self._writes += 1
+        profiler = None
+        if (self.profile_rate and not self._writes % self.profile_rate
+                and not self._profiling):
+            profiler = cProfile.Profile()
+            profiler.enable()
+            self._profiling = True
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+            if duration >= self.slow_threshold:
+                self.slow_writes += 1
+                LOG.warning('slow write (%.3fs) for %s',
+                            duration, description)
+                if profiler is not None:
+                    LOG.warning('profile of slow write for %s:\n%s',
+                                description, self._format_profile(profiler))
+
+    @staticmethod
+    def _format_profile(profiler):
+        stream = StringIO.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(15)
+        return stream.getvalue()
+
+    def report(self):
+        """Return a one line summary of the stats."""
+        return ' '.join(
+            '%s=%d/%.1f/%.1f/%.1fms' % (
+                stage,
+                self.histograms[stage].count,
+                self.histograms[stage].average,
+                self.histograms[stage].percentile(99),
+                self.histograms[stage].max)
+            for stage in self.stages) + ' slow=%d' % self.slow_writes
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.slow_writes = 0
@@ -18,10 +18,13 @@
 
 import itertools
 import os
+import time
 
+import eventlet
 from oslo.config import cfg
 import yaml
 
+from ceilometer.collector import meter as meter_api
 from ceilometer.openstack.common import log
 
 OPTS = [
@@ -29,6 +32,18 @@ OPTS = [
                default="pipeline.yaml",
                help="Configuration file for pipeline definition"
                ),
+    cfg.IntOpt('publisher_max_batch_size',
+               default=1000,
+               help="Maximum number of counters handed at once by a "
+               "pipeline to its publishers, 0 to hand them as soon as "
+               "they are transformed"
+               ),
+    cfg.IntOpt('publisher_max_linger_ms',
+               default=1000,
+               help="Maximum milliseconds a pipeline keeps counters before "
+               "handing them to its publishers, they are always handed "
+               "when the publish context is exited"
+               ),
 ]
 
 cfg.CONF.register_opts(OPTS)
@@ -103,6 +118,8 @@ class Pipeline(object):
             self.publishers = cfg['publishers']
             # It's legal to have no transformer specified
             self.transformer_cfg = cfg['transformers'] or []
+            # Priority class handed to the publishers, if any
+            self.priority = cfg.get('priority')
             self.publisher_manager = publisher_manager
         except KeyError as err:
             raise PipelineException(
@@ -113,13 +130,33 @@ class Pipeline(object):
 
         self._check_counters()
 
+        self._check_priority()
+
         self._check_publishers(cfg, publisher_manager)
 
         self.transformers = self._setup_transformers(cfg, transformer_manager)
 
+        # Counters waiting to be handed to the publishers, by source and
+        # execution context
+        self._batches = {}
+
     def __str__(self):
         return self.name
 
+    def _check_priority(self):
+        """The priority class must be one of the metering_priorities."""
+        if self.priority is None:
+            return
+        try:
+            priorities = meter_api.get_priorities(
+                cfg.CONF.metering_priorities)
+        except ValueError as err:
+            raise PipelineException(str(err), self.cfg)
+        if self.priority not in priorities:
+            raise PipelineException(
+                "Priority class %s not in metering_priorities"
+                % self.priority, self.cfg)
+
     def _check_counters(self):
         """Counter rules checking
 
@@ -176,7 +213,11 @@ class Pipeline(object):
 
     def _publish_counters_to_one_publisher(self, ext, ctxt, counters, source):
         try:
-            ext.obj.publish_counters(ctxt, counters, source)
+            if self.priority is None:
+                ext.obj.publish_counters(ctxt, counters, source)
+            else:
+                ext.obj.publish_counters(ctxt, counters, source,
+                                         priority=self.priority)
         except Exception as err:
             LOG.warning("Pipeline %s: Continue after error "
                         "from publisher %s", self, ext.name)
@@ -217,11 +258,74 @@ class Pipeline(object):
             if counter:
                 transformed_counters.append(counter)
 
+        if transformed_counters:
+            self._batch_counters(ctxt, transformed_counters, source)
+
+    @staticmethod
+    def _batch_key(ctxt, source):
+        # The contexts are not always hashable, each publish context has
+        # its own during the batch
+        return source, id(ctxt)
+
+    def _batch_counters(self, ctxt, counters, source):
+        """Buffer counters until a batch is full or has lingered enough.
+
+        The counters handed to the publishers are taken out of the batch
+        before, so that the publishers yielding to another flush of the
+        batch never get them twice.
+        """
+        max_batch_size = cfg.CONF.publisher_max_batch_size
+        if max_batch_size <= 0:
+            # No batching
+            self._publish_batch(ctxt, counters, source)
+            return
+        key = self._batch_key(ctxt, source)
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = {'started': time.time(),
+                                          'ctxt': ctxt,
+                                          'counters': []}
+            # Flushed when lingering, even if no more counters arrive
+            batch['timer'] = eventlet.spawn_after(
+                cfg.CONF.publisher_max_linger_ms / 1000.0,
+                self._flush_lingering, key, batch)
+        buffered = batch['counters']
+        buffered.extend(counters)
+
+        while len(buffered) >= max_batch_size:
+            chunk = buffered[:max_batch_size]
+            del buffered[:max_batch_size]
+            self._publish_batch(ctxt, chunk, source)
+
+        if ((time.time() - batch['started']) * 1000
+                >= cfg.CONF.publisher_max_linger_ms):
+            self._flush_batch(ctxt, source)
+
+    def _flush_lingering(self, key, batch):
+        batch['timer'] = None
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+            self._publish_buffered(batch, key[0])
+
+    def _flush_batch(self, ctxt, source):
+        batch = self._batches.pop(self._batch_key(ctxt, source), None)
+        if batch is not None:
+            if batch['timer'] is not None:
+                batch['timer'].cancel()
+            self._publish_buffered(batch, source)
+
+    def _publish_buffered(self, batch, source):
+        buffered = batch['counters'][:]
+        del batch['counters'][:]
+        if buffered:
+            self._publish_batch(batch['ctxt'], buffered, source)
+
+    def _publish_batch(self, ctxt, counters, source):
         LOG.audit("Pipeline %s: Publishing counters", self)
         self.publisher_manager.map(self.publishers,
                                    self._publish_counters_to_one_publisher,
                                    ctxt=ctxt,
-                                   counters=transformed_counters,
+                                   counters=counters,
                                    source=source,
                                    )
 
@@ -274,6 +378,8 @@ class Pipeline(object):
                     self, transformer)
                 LOG.exception(err)
 
+        self._flush_batch(ctxt, source)
+
     def get_interval(self):
         return self.interval
 
@@ -334,6 +440,7 @@ class PipelineManager(object):
         self.pipelines = [Pipeline(pipedef, publisher_manager,
                                    transformer_manager)
                           for pipedef in cfg]
+        self.publisher_manager = publisher_manager
 
     def publisher(self, context, source):
         """Build a new Publisher for these manager pipelines.
@@ -343,6 +450,17 @@ class PipelineManager(object):
         """
         return PublishContext(context, source, self.pipelines)
 
+    def flush_publishers(self):
+        """Publish the counters still held by the publishers, when the
+        service stops.
+        """
+        for ext in self.publisher_manager.extensions:
+            try:
+                ext.obj.flush()
+            except Exception as err:
+                LOG.error("Failed to flush publisher %s", ext.name)
+                LOG.exception(err)
+
 
 def setup_pipeline(transformer_manager, publisher_manager):
     """Setup pipeline manager according to yaml config file."""
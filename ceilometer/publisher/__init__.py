@@ -38,5 +38,14 @@ class PublisherBase(object):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def publish_counters(self, context, counters, source):
-        "Publish counters into final conduit."
+    def publish_counters(self, context, counters, source, priority=None):
+        """Publish counters into final conduit.
+
+        The priority is only passed by the pipelines having a priority
+        class.
+        """
+
+    def flush(self):
+        """Publish the counters still held by the publisher, called when
+        the service stops.
+        """
@@ -0,0 +1,206 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Cast messages through publishers cached on the pooled connections.
+
+rpc.cast declares a new publisher, and thus its exchange, for every
+message, on a channel which is closed each time the connection goes back
+to the pool. The casts done here use a channel of their own on each
+pooled kombu connection, where the publisher of a topic is declared once
+and kept until the connection to the broker is re-established. All the
+messages of a call are sent while holding a single connection, and the
+broker confirms, when enabled, are waited for once for all of them.
+"""
+
+import time
+import weakref
+
+from oslo.config import cfg
+
+from ceilometer.openstack.common import log
+from ceilometer.openstack.common import rpc
+from ceilometer.openstack.common.rpc import amqp as rpc_amqp
+from ceilometer.openstack.common.rpc import common as rpc_common
+from ceilometer.openstack.common.rpc import impl_kombu
+
+
+LOG = log.getLogger(__name__)
+
+# Method signature of the basic.nack sent by the broker in confirm mode
+BASIC_NACK = (60, 120)
+
+CACHED_CAST_OPTS = [
+    cfg.BoolOpt('metering_publisher_confirms',
+                default=False,
+                help='wait for the broker to confirm the metering messages '
+                'cast through the cached publishers, once per batch',
+                ),
+    cfg.FloatOpt('metering_confirm_timeout',
+                 default=30,
+                 help='seconds to wait for the broker confirms of a batch '
+                 'before sending it again on a new connection',
+                 ),
+]
+
+
+def register_opts(config):
+    """Register the options for casting through cached publishers.
+    """
+    config.register_opts(CACHED_CAST_OPTS)
+
+
+register_opts(cfg.CONF)
+
+# Publishers of the pooled impl_kombu connections
+_publishers = weakref.WeakKeyDictionary()
+
+
+class MessagesRejected(Exception):
+    """The broker did not accept messages."""
+
+    def __init__(self, count):
+        super(MessagesRejected, self).__init__(
+            'the broker rejected %d messages' % count)
+        self.count = count
+
+
+def _basic_nack_recv(channel, args):
+    """Handle a basic.nack like basic.ack, for the amqp versions which only
+    dispatch the latter.
+    """
+    delivery_tag = args.read_longlong()
+    multiple = args.read_bit()
+    for callback in channel.events['basic_nack']:
+        callback(delivery_tag, multiple)
+
+
+class PublisherCache(object):
+    """Topic publishers declared on a channel of a broker connection.
+
+    :param broker: The kombu connection to the broker.
+    :param confirms: Put the channel in confirm mode, if the transport
+                     supports it.
+    """
+
+    def __init__(self, broker, confirms=False):
+        self.broker = broker
+        self.channel = broker.channel()
+        self.publishers = {}
+        self.confirms = confirms and hasattr(self.channel, 'confirm_select')
+        self.delivery_tag = 0
+        self.unconfirmed = set()
+        self.rejected = 0
+        if self.confirms:
+            self.channel.events['basic_ack'].add(self._on_ack)
+            self.channel.events['basic_nack'].add(self._on_nack)
+            if BASIC_NACK not in self.channel._METHOD_MAP:
+                self.channel._METHOD_MAP = dict(self.channel._METHOD_MAP)
+                self.channel._METHOD_MAP[BASIC_NACK] = _basic_nack_recv
+            self.channel.confirm_select()
+
+    def _confirm(self, delivery_tag, multiple):
+        """Return the number of messages confirmed by an ack or nack."""
+        if multiple:
+            confirmed = set(t for t in self.unconfirmed if t <= delivery_tag)
+        else:
+            confirmed = set([delivery_tag]) & self.unconfirmed
+        self.unconfirmed -= confirmed
+        return len(confirmed)
+
+    def _on_ack(self, delivery_tag, multiple):
+        self._confirm(delivery_tag, multiple)
+
+    def _on_nack(self, delivery_tag, multiple):
+        self.rejected += self._confirm(delivery_tag, multiple)
+
+    def send(self, conf, topic, msg):
+        publisher = self.publishers.get(topic)
+        if publisher is None:
+            publisher = impl_kombu.TopicPublisher(conf, self.channel, topic)
+            self.publishers[topic] = publisher
+        publisher.send(msg)
+        if self.confirms:
+            self.delivery_tag += 1
+            self.unconfirmed.add(self.delivery_tag)
+
+    def wait_confirms(self, timeout=None):
+        """Wait until the broker confirmed all the messages sent.
+
+        :param timeout: Seconds after which socket.timeout is raised.
+        :raises MessagesRejected: when the broker rejected some of them.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.unconfirmed:
+            if deadline is None:
+                self.broker.drain_events()
+            else:
+                # Raises socket.timeout once expired
+                self.broker.drain_events(
+                    timeout=max(deadline - time.time(), 0))
+        rejected, self.rejected = self.rejected, 0
+        if rejected:
+            raise MessagesRejected(rejected)
+
+
+def _send(connection, messages):
+    cache = _publishers.get(connection)
+    if cache is None or cache.broker is not connection.connection:
+        # New connection, or reconnected to the broker
+        cache = PublisherCache(connection.connection,
+                               cfg.CONF.metering_publisher_confirms)
+        _publishers[connection] = cache
+    try:
+        for topic, msg in messages:
+            cache.send(cfg.CONF, topic, msg)
+        cache.wait_confirms(cfg.CONF.metering_confirm_timeout)
+    except Exception:
+        # Start over with a new channel, whose state is known
+        del _publishers[connection]
+        try:
+            cache.channel.close()
+        except Exception as err:
+            LOG.debug('Failed to close the publishers channel: %s', err)
+        raise
+
+
+def cast(context, casts):
+    """Cast messages to their topics over a single pooled connection.
+
+    Falls back to rpc.cast when the rpc backend is not kombu.
+
+    :param context: Execution context of the messages
+    :param casts: (topic, msg) pairs, sent in order
+    """
+    if cfg.CONF.rpc_backend != impl_kombu.__name__:
+        for topic, msg in casts:
+            rpc.cast(context, topic, msg)
+        return
+
+    messages = []
+    for topic, msg in casts:
+        rpc_amqp._add_unique_id(msg)
+        rpc_amqp.pack_context(msg, context)
+        messages.append((topic, rpc_common.serialize_msg(msg)))
+
+    def _error_callback(exc):
+        LOG.exception('Failed to cast %d messages: %s', len(messages), exc)
+
+    pool = rpc_amqp.get_connection_pool(cfg.CONF, impl_kombu.Connection)
+    with rpc_amqp.ConnectionContext(cfg.CONF, pool) as conn:
+        # Messages sent again after a reconnection, or a confirm timeout,
+        # keep their unique id, so that the consumers drop the duplicates.
+        # Rejected messages are raised to the caller.
+        conn.connection.ensure(_error_callback, _send,
+                               conn.connection, messages)
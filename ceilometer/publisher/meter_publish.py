@@ -20,12 +20,15 @@
 
 import itertools
 
+import eventlet
 from oslo.config import cfg
 
 from ceilometer.collector import meter as meter_api
 from ceilometer.openstack.common import log
 from ceilometer.openstack.common import rpc
 from ceilometer import publisher
+from ceilometer.publisher import cached_cast
+from ceilometer import utils
 
 
 LOG = log.getLogger(__name__)
@@ -35,6 +38,58 @@ PUBLISH_OPTS = [
                default='metering',
                help='the topic ceilometer uses for metering messages',
                ),
+    cfg.StrOpt('metering_encoding',
+               default='',
+               help='encoding of the metering messages sent to the '
+               'metering topic: empty for a list of messages, understood '
+               'by every collector, or "columnar" for a compact layout '
+               'requiring collectors implementing version 1.1',
+               ),
+    cfg.ListOpt('metering_meter_topics',
+                default=[],
+                help='names of the meters also published to their own '
+                '<metering_topic>.<meter name> topic, "*" for all of them',
+                ),
+    cfg.FloatOpt('metering_linger',
+                 default=0,
+                 help='seconds to wait for more metering messages before '
+                 'casting them together to the metering topic, 0 to cast '
+                 'them immediately',
+                 ),
+    cfg.IntOpt('metering_linger_max_messages',
+               default=10000,
+               help='maximum number of metering messages waiting to be '
+               'cast, the oldest being dropped above it, 0 for no limit',
+               ),
+    cfg.BoolOpt('metering_cached_publishers',
+                default=False,
+                help='cast the metering messages through publishers cached '
+                'on the pooled connections instead of declaring one per '
+                'message, only supported by the kombu rpc backend',
+                ),
+    cfg.StrOpt('metering_compression',
+               default='',
+               help='compression of the metering messages: empty for '
+               'none, understood by every collector, or "zlib", requiring '
+               'collectors implementing version 1.2',
+               ),
+    cfg.IntOpt('metering_compression_level',
+               default=6,
+               help='zlib compression level of the metering messages, '
+               'from 1 (fastest) to 9 (smallest)',
+               ),
+    cfg.IntOpt('metering_compression_threshold',
+               default=1024,
+               help='size in bytes of the serialized metering data below '
+               'which it is sent uncompressed',
+               ),
+    cfg.BoolOpt('metering_collector_affinity',
+                default=False,
+                help='cast the metering messages of a resource to the same '
+                'collector, chosen by consistent hashing among the hosts '
+                'the zeromq matchmaker knows for the metering topic, '
+                'only supported by the zeromq rpc backend',
+                ),
 ]
 
 
@@ -48,12 +103,22 @@ register_opts(cfg.CONF)
 
 
 class MeterPublisher(publisher.PublisherBase):
-    def publish_counters(self, context, counters, source):
+
+    def __init__(self):
+        # (context, topic, meter) waiting for the linger delay
+        self._pending = []
+        self._flush_timer = None
+        self._collector_ring = utils.HashRing([])
+        self._priorities = meter_api.get_priorities(
+            cfg.CONF.metering_priorities)
+
+    def publish_counters(self, context, counters, source, priority=None):
         """Send a metering message for publishing
 
         :param context: Execution context from the service or RPC call
         :param counter: Counter from pipeline after transformation
         :param source: counter source
+        :param priority: priority class of the pipeline
         """
 
         meters = [
@@ -63,21 +128,187 @@ class MeterPublisher(publisher.PublisherBase):
             for counter in counters
         ]
 
-        topic = cfg.CONF.metering_topic
-        msg = {
+        topic = self._priority_topic(priority)
+        linger = cfg.CONF.metering_linger
+        if linger > 0:
+            self._pending.extend((context, topic, m) for m in meters)
+            self._trim_pending()
+            self._schedule_flush()
+        else:
+            self._cast(context, topic, meters)
+
+        self._cast_meter_topics(context, meters)
+
+    def _trim_pending(self):
+        """Drop the oldest messages waiting to be cast above the limit,
+        not to grow while the broker is unavailable.
+        """
+        limit = cfg.CONF.metering_linger_max_messages
+        excess = len(self._pending) - limit
+        if limit > 0 and excess > 0:
+            LOG.warning('Too many metering messages waiting to be cast, '
+                        'dropping the %d oldest', excess)
+            del self._pending[:excess]
+
+    def _schedule_flush(self):
+        if self._flush_timer is None and self._pending:
+            self._flush_timer = eventlet.spawn_after(
+                cfg.CONF.metering_linger, self._flush_lingering)
+
+    def _flush_lingering(self):
+        self._flush_timer = None
+        try:
+            self.flush_pending()
+        except Exception as err:
+            LOG.warning('Failed to publish %d metering messages, retrying '
+                        'in %ss', len(self._pending),
+                        cfg.CONF.metering_linger)
+            LOG.exception(err)
+
+    def flush_pending(self):
+        """Cast the metering messages waiting for the linger delay, with
+        the context they were published with.
+
+        The messages whose cast failed are queued again, to be cast after
+        the linger delay, up to metering_linger_max_messages, and the first
+        failure is raised.
+        """
+        pending, self._pending = self._pending, []
+        contexts = []
+        casts = {}
+        for context, topic, meter in pending:
+            key = id(context)
+            if key not in casts:
+                contexts.append((key, context))
+                casts[key] = {}
+            casts[key].setdefault(topic, []).append(meter)
+        failed = []
+        error = None
+        for key, context in contexts:
+            for topic, meters in sorted(casts[key].iteritems()):
+                try:
+                    self._cast(context, topic, meters)
+                except Exception as err:
+                    failed.extend((context, topic, m) for m in meters)
+                    error = error or err
+        if failed:
+            # Before the messages published while casting
+            self._pending[:0] = failed
+            self._trim_pending()
+            self._schedule_flush()
+            raise error
+
+    def flush(self):
+        """Cast the metering messages still waiting for the linger delay.
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self.flush_pending()
+
+    def _priority_topic(self, priority):
+        """Return the metering topic of a priority class."""
+        # Checked when loading the pipelines, unless spooled before
+        if priority and priority not in self._priorities:
+            LOG.warning('unknown priority class %s, casting to %s',
+                        priority, cfg.CONF.metering_topic)
+            priority = None
+        return meter_api.priority_topic(cfg.CONF.metering_topic, priority)
+
+    @staticmethod
+    def _metering_msg(data, encoding=None):
+        """Build a record_metering_data message, compressing large data."""
+        args = {'data': data}
+        version = '1.0'
+        if encoding:
+            args['encoding'] = encoding
+            version = '1.1'
+        compression = cfg.CONF.metering_compression
+        if compression:
+            compressed = meter_api.compress_data(
+                data, compression,
+                cfg.CONF.metering_compression_level,
+                cfg.CONF.metering_compression_threshold)
+            if compressed is not None:
+                args['data'] = compressed
+                args['compression'] = compression
+                version = '1.2'
+        return {
             'method': 'record_metering_data',
-            'version': '1.0',
-            'args': {'data': meters},
+            'version': version,
+            'args': args,
         }
-        LOG.debug('PUBLISH: %s', str(msg))
-        rpc.cast(context, topic, msg)
 
+    def _collectors(self):
+        """Return the hash ring of the collectors, None if not routing."""
+        if not cfg.CONF.metering_collector_affinity:
+            return None
+        # Only the zeromq backend has a matchmaker
+        get_matchmaker = getattr(rpc._get_impl(), '_get_matchmaker', None)
+        if get_matchmaker is None:
+            LOG.warning('metering_collector_affinity requires the zeromq '
+                        'rpc backend, casting to %s',
+                        cfg.CONF.metering_topic)
+            return None
+        hosts = set(host for key, host in get_matchmaker().queues(
+            'fanout~' + cfg.CONF.metering_topic))
+        if hosts != self._collector_ring.nodes:
+            LOG.info('metering collectors changed to %s',
+                     ', '.join(sorted(hosts)))
+            self._collector_ring = utils.HashRing(hosts)
+        return self._collector_ring
+
+    def _route(self, topic, meters):
+        """Split the metering messages by the topic they are cast to."""
+        partitions = cfg.CONF.metering_partitions
+        ring = self._collectors()
+        if ring is not None and ring.nodes:
+            route = lambda m: '%s.%s' % (topic,
+                                         ring.get_node(m['resource_id']))
+        elif partitions > 0:
+            route = lambda m: meter_api.partition_topic(topic,
+                                                        m['resource_id'],
+                                                        partitions)
+        else:
+            return [(topic, meters)]
+        routes = {}
+        for meter in meters:
+            routes.setdefault(route(meter), []).append(meter)
+        return sorted(routes.iteritems())
+
+    def _cast(self, context, topic, meters):
+        casts = []
+        for topic, topic_meters in self._route(topic, meters):
+            if cfg.CONF.metering_encoding == meter_api.COLUMNAR_ENCODING:
+                msg = MeterPublisher._metering_msg(
+                    meter_api.encode_meters(topic_meters),
+                    meter_api.COLUMNAR_ENCODING)
+            else:
+                msg = MeterPublisher._metering_msg(topic_meters)
+            LOG.debug('PUBLISH: %s', str(msg))
+            casts.append((topic, msg))
+        MeterPublisher._send(context, casts)
+
+    @staticmethod
+    def _cast_meter_topics(context, meters):
+        meter_topics = cfg.CONF.metering_meter_topics
+        if not meter_topics:
+            return
+        if '*' not in meter_topics:
+            meters = [m for m in meters if m['counter_name'] in meter_topics]
+        topic = cfg.CONF.metering_topic
+        casts = []
         for meter_name, meter_list in itertools.groupby(
                 sorted(meters, key=lambda m: m['counter_name']),
                 lambda m: m['counter_name']):
-            msg = {
-                'method': 'record_metering_data',
-                'version': '1.0',
-                'args': {'data': list(meter_list)},
-            }
-            rpc.cast(context, topic + '.' + meter_name, msg)
+            msg = MeterPublisher._metering_msg(list(meter_list))
+            casts.append((topic + '.' + meter_name, msg))
+        MeterPublisher._send(context, casts)
+
+    @staticmethod
+    def _send(context, casts):
+        if cfg.CONF.metering_cached_publishers:
+            cached_cast.cast(context, casts)
+        else:
+            for topic, msg in casts:
+                rpc.cast(context, topic, msg)
@@ -0,0 +1,272 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Store counters in a local spool and forward them to another publisher.
+
+The counters are appended to segment files in the spool directory, one
+JSON encoded batch per line. A background green thread replays the
+segments, oldest first, into the downstream publisher, and deletes each
+of them once all its batches have been delivered: the downstream
+publisher is flushed after each batch, so that the counters it holds are
+published before the batch is considered replayed. When the downstream
+publisher fails, the replay is retried later, so the counters are kept
+on disk while the message broker is unavailable.
+
+Counters are delivered at least once: after a crash, the batches of a
+partially replayed segment are published again.
+"""
+
+import os
+import time
+
+import eventlet
+from oslo.config import cfg
+from stevedore import driver
+
+from ceilometer import counter
+from ceilometer.openstack.common import context
+from ceilometer.openstack.common import jsonutils
+from ceilometer.openstack.common import log
+from ceilometer import publisher
+
+
+LOG = log.getLogger(__name__)
+
+PUBLISHER_NAMESPACE = 'ceilometer.publisher'
+
+SEGMENT_SUFFIX = '.spool'
+
+SPOOL_OPTS = [
+    cfg.StrOpt('spool_directory',
+               default='/var/lib/ceilometer/spool',
+               help='directory where the spool publisher stores counters',
+               ),
+    cfg.StrOpt('spool_downstream_publisher',
+               default='meter_publisher',
+               help='publisher the spooled counters are replayed into',
+               ),
+    cfg.IntOpt('spool_segment_size',
+               default=1024 * 1024,
+               help='size in bytes above which a new spool segment '
+               'is started',
+               ),
+    cfg.IntOpt('spool_max_size',
+               default=100 * 1024 * 1024,
+               help='maximum size in bytes of the spool, the oldest '
+               'segments being deleted above it',
+               ),
+    cfg.FloatOpt('spool_sync_interval',
+                 default=1,
+                 help='minimum seconds between two fsync of the spool',
+                 ),
+    cfg.FloatOpt('spool_replay_interval',
+                 default=10,
+                 help='seconds between two attempts to replay the spool',
+                 ),
+]
+
+
+def register_opts(config):
+    """Register the options for spooling counters.
+    """
+    config.register_opts(SPOOL_OPTS)
+
+
+register_opts(cfg.CONF)
+
+
+class SpoolPublisher(publisher.PublisherBase):
+
+    def __init__(self):
+        # The spool directory is only set up once used, every publisher
+        # being loaded by the agents whether a pipeline uses it or not
+        self.directory = None
+        self.segments = None
+        self._sizes = None
+        self._size = 0
+        self._next_segment = 0
+        self._active = None
+        self._active_name = None
+        self._last_sync = 0
+        self._replay_offsets = {}
+        self._replayer = None
+        self._downstream = None
+
+    @property
+    def downstream(self):
+        if self._downstream is None:
+            self._downstream = driver.DriverManager(
+                PUBLISHER_NAMESPACE,
+                cfg.CONF.spool_downstream_publisher,
+                invoke_on_load=True,
+            ).driver
+        return self._downstream
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        """Create the spool directory and find the segments left by a
+        previous run, unless already done.
+        """
+        if self.segments is not None:
+            return
+        directory = cfg.CONF.spool_directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        numbers = {}
+        for name in os.listdir(directory):
+            number = name[:-len(SEGMENT_SUFFIX)]
+            if name.endswith(SEGMENT_SUFFIX) and number.isdigit():
+                numbers[name] = int(number)
+            elif not name.startswith('.'):
+                LOG.warning('Ignoring %s in the spool directory', name)
+        # Segments left by a previous run are replayed first
+        self.segments = sorted(numbers, key=numbers.get)
+        # Sizes of the closed segments, and their total
+        self._sizes = dict((s, os.path.getsize(self._path(s)))
+                           for s in self.segments)
+        self._size = sum(self._sizes.itervalues())
+        self._next_segment = max(numbers.values() or [-1]) + 1
+
+    def publish_counters(self, context, counters, source, priority=None):
+        """Append the counters to the spool.
+
+        :param context: Execution context from the service or RPC call
+        :param counter: Counter from pipeline after transformation
+        :param source: counter source
+        :param priority: priority class of the pipeline, kept for the
+                         replay
+        """
+        self._load()
+        if self._replayer is None:
+            self._replayer = eventlet.spawn(self._replay_loop)
+        if not counters:
+            return
+        batch = {
+            'source': source,
+            'counters': [c._asdict() for c in counters],
+        }
+        if priority is not None:
+            batch['priority'] = priority
+        line = jsonutils.dumps(batch)
+        if self._active is None:
+            self._open_segment()
+        self._active.write(line + '\n')
+        now = time.time()
+        if now - self._last_sync >= cfg.CONF.spool_sync_interval:
+            self._sync()
+            self._last_sync = now
+        if self._active.tell() >= cfg.CONF.spool_segment_size:
+            self._close_segment()
+        self._evict()
+
+    def _open_segment(self):
+        self._active_name = '%020d%s' % (self._next_segment, SEGMENT_SUFFIX)
+        self._next_segment += 1
+        self._active = open(self._path(self._active_name), 'a')
+
+    def _sync(self):
+        self._active.flush()
+        os.fsync(self._active.fileno())
+
+    def _close_segment(self):
+        self._sync()
+        size = self._active.tell()
+        self._active.close()
+        self.segments.append(self._active_name)
+        self._sizes[self._active_name] = size
+        self._size += size
+        self._active = None
+        self._active_name = None
+
+    def size(self):
+        """Return the size in bytes of the spool."""
+        self._load()
+        size = self._size
+        if self._active is not None:
+            size += self._active.tell()
+        return size
+
+    def _remove_segment(self):
+        """Delete the oldest segment."""
+        name = self.segments.pop(0)
+        self._size -= self._sizes.pop(name)
+        self._replay_offsets.pop(name, None)
+        os.unlink(self._path(name))
+
+    def _evict(self):
+        while self.segments and self.size() > cfg.CONF.spool_max_size:
+            LOG.warning('Spool is full, dropping the counters of %s',
+                        self.segments[0])
+            self._remove_segment()
+
+    def flush(self):
+        """Write the counters of the active segment to the disk."""
+        if self._active is not None:
+            self._sync()
+
+    def _replay_loop(self):
+        while True:
+            eventlet.sleep(cfg.CONF.spool_replay_interval)
+            try:
+                self.replay()
+            except Exception as err:
+                LOG.warning('Failed to replay the spool into %s, '
+                            'retrying in %ss',
+                            cfg.CONF.spool_downstream_publisher,
+                            cfg.CONF.spool_replay_interval)
+                LOG.exception(err)
+
+    def replay(self):
+        """Publish the spooled counters into the downstream publisher.
+
+        Stops at the first failure of the downstream publisher, leaving
+        the counters not delivered in the spool.
+        """
+        self._load()
+        if self._active is not None:
+            self._close_segment()
+        ctxt = context.get_admin_context()
+        while self.segments:
+            name = self.segments[0]
+            offset = self._replay_offsets.get(name, 0)
+            with open(self._path(name)) as segment:
+                segment.seek(offset)
+                for line in iter(segment.readline, ''):
+                    try:
+                        batch = jsonutils.loads(line)
+                    except ValueError:
+                        # Partial write from a crash
+                        LOG.warning('Skipping corrupted batch in %s', name)
+                    else:
+                        kwargs = {}
+                        if 'priority' in batch:
+                            kwargs['priority'] = batch['priority']
+                        self.downstream.publish_counters(
+                            ctxt,
+                            [counter.Counter(**c)
+                             for c in batch['counters']],
+                            batch['source'],
+                            **kwargs
+                        )
+                        # Not delivered until flushed by the downstream
+                        self.downstream.flush()
+                    self._replay_offsets[name] = segment.tell()
+            # The segment may have been evicted while publishing
+            if self.segments and self.segments[0] == name:
+                self._remove_segment()
+            self._replay_offsets.pop(name, None)
@@ -0,0 +1,117 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Publish counters directly to the collectors over UDP.
+
+Delivery is not guaranteed: this publisher is meant for high-rate meters
+for which losing some samples is acceptable, and that should not load
+the message broker.
+"""
+
+import itertools
+import socket
+
+from oslo.config import cfg
+
+from ceilometer.collector import meter as meter_api
+from ceilometer.openstack.common import jsonutils
+from ceilometer.openstack.common import log
+from ceilometer.openstack.common import network_utils
+from ceilometer import publisher
+
+
+LOG = log.getLogger(__name__)
+
+DEFAULT_PORT = 4952
+
+# Keep below the maximum payload of an IPv4 UDP datagram.
+MAX_DATAGRAM_SIZE = 65000
+
+UDP_PUBLISH_OPTS = [
+    cfg.ListOpt('udp_collectors',
+                default=[],
+                help='host:port of the collectors the udp publisher '
+                'sends the metering messages to',
+                ),
+]
+
+
+def register_opts(config):
+    """Register the options for publishing metering messages over UDP.
+    """
+    config.register_opts(UDP_PUBLISH_OPTS)
+
+
+register_opts(cfg.CONF)
+
+
+def encode_datagrams(meters):
+    """Encode metering messages into datagrams small enough to be sent.
+    """
+    datagram = jsonutils.dumps({
+        'encoding': meter_api.COLUMNAR_ENCODING,
+        'data': meter_api.encode_meters(meters),
+    })
+    if len(datagram) <= MAX_DATAGRAM_SIZE:
+        return [datagram]
+    if len(meters) == 1:
+        LOG.warning('metering message too large to be sent over UDP: %s',
+                    meters[0]['message_id'])
+        return []
+    middle = len(meters) // 2
+    return encode_datagrams(meters[:middle]) + \
+        encode_datagrams(meters[middle:])
+
+
+class UDPPublisher(publisher.PublisherBase):
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._targets = None
+
+    def _next_target(self):
+        if self._targets is None:
+            self._targets = itertools.cycle([
+                network_utils.parse_host_port(target, DEFAULT_PORT)
+                for target in cfg.CONF.udp_collectors
+            ])
+        return next(self._targets)
+
+    def publish_counters(self, context, counters, source, priority=None):
+        """Send the metering messages to a collector.
+
+        :param context: Execution context from the service or RPC call
+        :param counter: Counter from pipeline after transformation
+        :param source: counter source
+        :param priority: priority class of the pipeline, ignored as the
+                         datagrams are not queued
+        """
+        if not cfg.CONF.udp_collectors:
+            LOG.warning('no collector configured for the udp publisher')
+            return
+
+        meters = [
+            meter_api.meter_message_from_counter(counter,
+                                                 cfg.CONF.metering_secret,
+                                                 source)
+            for counter in counters
+        ]
+        for datagram in encode_datagrams(meters):
+            target = self._next_target()
+            try:
+                self.socket.sendto(datagram, target)
+            except socket.error as err:
+                LOG.warning('Unable to send metering messages to %s:%d: %s',
+                            target[0], target[1], err)
@@ -38,6 +38,24 @@ STORAGE_OPTS = [
                default='mongodb://localhost:27017/ceilometer',
                help='Database connection string',
                ),
+    cfg.IntOpt('storage_association_cache_size',
+               default=10000,
+               help='number of user and project associations to a source '
+               'remembered by a storage connection to skip writing them '
+               'again, 0 to disable',
+               ),
+    cfg.IntOpt('storage_resource_cache_size',
+               default=10000,
+               help='number of resource owners and metadata, and of '
+               'resource and meter pairs, remembered by a storage '
+               'connection to skip unchanged resource updates, 0 to '
+               'disable',
+               ),
+    cfg.IntOpt('database_time_to_live',
+               default=-1,
+               help='number of seconds the samples are kept in the '
+               'database by ceilometer-expirer, -1 to keep them forever',
+               ),
 ]
 
 
@@ -22,8 +22,11 @@ import abc
 import datetime
 import math
 
+from ceilometer.openstack.common import log
 from ceilometer.openstack.common import timeutils
 
+LOG = log.getLogger(__name__)
+
 
 def iter_period(start, end, period):
     """Split a time from start to end in periods of a number of seconds. This
@@ -82,6 +85,38 @@ class Connection(object):
         All timestamps must be naive utc datetime object.
         """
 
+    def record_metering_batch(self, data):
+        """Write a list of metering data to the backend storage system.
+
+        :param data: a list of dictionaries such as returned by
+                     ceilometer.meter.meter_message_from_counter
+
+        Drivers able to write several samples at once override this, by
+        default they are written one at a time, those failing to be written
+        being logged and skipped.
+        """
+        for meter in data:
+            try:
+                self.record_metering_data(meter)
+            except Exception as err:
+                LOG.error('Failed to record metering data: %s', err)
+                LOG.exception(err)
+
+    def clear_expired_metering_data(self, ttl):
+        """Clear the metering data older than ttl.
+
+        :param ttl: Number of seconds to keep the metering data.
+        """
+        raise NotImplementedError('Clearing expired metering data not '
+                                  'implemented')
+
+    def compact_rollups(self):
+        """Merge the rows of the precomputed statistics of the samples.
+
+        Drivers maintaining such statistics override this, by default
+        there is nothing to merge.
+        """
+
     @abc.abstractmethod
     def get_users(self, source=None):
         """Return an iterable of user id strings.
@@ -140,3 +175,9 @@ class Connection(object):
     @abc.abstractmethod
     def clear(self):
         """Clear database."""
+
+    def get_cache_stats(self):
+        """Return the hits and misses of the caches skipping redundant
+        writes, as {'hits': ..., 'misses': ...} dictionaries by cache name.
+        """
+        return {}
@@ -0,0 +1,120 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Bounded caches used by the storage drivers to skip redundant writes.
+"""
+
+import hashlib
+
+from ceilometer.openstack.common import jsonutils
+
+
+def resource_key(data):
+    """Return the key of the resource state cached for a metering message.
+
+    The state of a resource is the one last recorded whatever its meter,
+    the meters are remembered apart with meter_key.
+    """
+    return data['resource_id']
+
+
+def meter_key(data):
+    """Return the key of the meter of a resource cached for a metering
+    message, so that recording a meter new to the resource is never
+    skipped.
+    """
+    return (data['resource_id'], data['counter_name'],
+            data['counter_type'], data['counter_unit'])
+
+
+def resource_digest(data):
+    """Return a digest of the owner, source and metadata of a resource."""
+    return hashlib.md5(jsonutils.dumps([data['user_id'],
+                                        data['project_id'],
+                                        data['source'],
+                                        data['resource_metadata']],
+                                       sort_keys=True)).hexdigest()
+
+
+def get_stats(**caches):
+    """Return the hits and misses of caches, by name."""
+    return dict((name, {'hits': c.hits, 'misses': c.misses})
+                for name, c in caches.iteritems())
+
+
+class BoundedCache(object):
+    """Mapping remembering the most recently used keys.
+
+    The keys are kept in two generations of at most half the size each.
+    When the current generation is full it replaces the previous one,
+    dropping the keys not used since, and keys found in the previous
+    generation are moved back to the current one.
+
+    :param size: Maximum number of keys, 0 disables the cache.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        self._current = {}
+        self._previous = {}
+
+    def __len__(self):
+        return len(self._current) + len(self._previous)
+
+    def get(self, key, default=None):
+        if key in self._current:
+            return self._current[key]
+        if key in self._previous:
+            value = self._previous.pop(key)
+            self._set(key, value)
+            return value
+        return default
+
+    def is_cached(self, key, value=True):
+        """Return whether key is cached with value, counting a hit if so
+        and a miss otherwise.
+        """
+        if self.get(key, self) == value:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __contains__(self, key):
+        return self.is_cached(key)
+
+    def _set(self, key, value):
+        if len(self._current) >= max(self.size // 2, 1):
+            self._previous = self._current
+            self._current = {}
+        self._current[key] = value
+
+    def set(self, key, value):
+        if self.size > 0:
+            self._previous.pop(key, None)
+            self._set(key, value)
+
+    def add(self, key):
+        """Remember a key, for caches used as sets."""
+        self.set(key, True)
+
+    def discard(self, key):
+        self._current.pop(key, None)
+        self._previous.pop(key, None)
@@ -60,6 +60,7 @@ from oslo.config import cfg
 
 from ceilometer.openstack.common import log, timeutils
 from ceilometer.storage import base
+from ceilometer.storage import cache
 from ceilometer.storage import models
 
 LOG = log.getLogger(__name__)
@@ -120,6 +121,15 @@ class Connection(base.Connection):
         '''
         opts = self._parse_connection_url(conf.database_connection)
         opts['table_prefix'] = conf.table_prefix
+        # (user or project, id, source) already recorded
+        self._associations = cache.BoundedCache(
+            conf.storage_association_cache_size)
+        # Digest of the resource last recorded
+        self._resources = cache.BoundedCache(
+            conf.storage_resource_cache_size)
+        # (resource, meter) already recorded
+        self._meters = cache.BoundedCache(
+            conf.storage_resource_cache_size)
 
         if opts['host'] == '__test__':
             url = os.environ.get('CEILOMETER_TEST_HBASE_URL')
@@ -155,6 +165,9 @@ class Connection(base.Connection):
 
     def clear(self):
         LOG.debug('Dropping HBase schema...')
+        self._associations.clear()
+        self._resources.clear()
+        self._meters.clear()
         for table in [self.PROJECT_TABLE,
                       self.USER_TABLE,
                       self.RESOURCE_TABLE,
@@ -168,6 +181,11 @@ class Connection(base.Connection):
             except:
                 LOG.debug('Cannot delete table but ignoring error')
 
+    def get_cache_stats(self):
+        return cache.get_stats(associations=self._associations,
+                               resources=self._resources,
+                               meters=self._meters)
+
     @staticmethod
     def _get_connection(conf):
         """Return a connection to the database.
@@ -208,41 +226,55 @@ class Connection(base.Connection):
                      ceilometer.meter.meter_message_from_counter
         """
         # Make sure we know about the user and project
-        if data['user_id']:
+        user_key = ('user', data['user_id'], data['source'])
+        if data['user_id'] and user_key not in self._associations:
             user = self.user.row(data['user_id'])
             sources = _load_hbase_list(user, 's')
             # Update if source is new
             if data['source'] not in sources:
                 user['f:s_%s' % data['source']] = "1"
                 self.user.put(data['user_id'], user)
+            self._associations.add(user_key)
 
-        project = self.project.row(data['project_id'])
-        sources = _load_hbase_list(project, 's')
-        # Update if source is new
-        if data['source'] not in sources:
-            project['f:s_%s' % data['source']] = "1"
-            self.project.put(data['project_id'], project)
+        project_key = ('project', data['project_id'], data['source'])
+        if project_key not in self._associations:
+            project = self.project.row(data['project_id'])
+            sources = _load_hbase_list(project, 's')
+            # Update if source is new
+            if data['source'] not in sources:
+                project['f:s_%s' % data['source']] = "1"
+                self.project.put(data['project_id'], project)
+            self._associations.add(project_key)
 
         # Record the updated resource metadata.
         received_timestamp = timeutils.utcnow()
 
-        resource = self.resource.row(data['resource_id'])
-        new_meter = "%s!%s!%s" % (
-            data['counter_name'], data['counter_type'], data['counter_unit'])
-        new_resource = {'f:resource_id': data['resource_id'],
-                        'f:project_id': data['project_id'],
-                        'f:user_id': data['user_id'],
-                        'f:metadata': json.dumps(data['resource_metadata']),
-                        'f:source': data["source"],
-                        'f:m_%s' % new_meter: "1",
-                        }
-        # Update if resource has new information
-        if new_resource != resource:
-            meters = _load_hbase_list(resource, 'm')
-            if new_meter not in meters:
-                new_resource['f:m_%s' % new_meter] = "1"
-
-            self.resource.put(data['resource_id'], new_resource)
+        resource_key = cache.resource_key(data)
+        digest = cache.resource_digest(data)
+        meter_key = cache.meter_key(data)
+        if not (self._resources.is_cached(resource_key, digest)
+                and meter_key in self._meters):
+            resource = self.resource.row(data['resource_id'])
+            new_meter = "%s!%s!%s" % (
+                data['counter_name'], data['counter_type'],
+                data['counter_unit'])
+            new_resource = {'f:resource_id': data['resource_id'],
+                            'f:project_id': data['project_id'],
+                            'f:user_id': data['user_id'],
+                            'f:metadata': json.dumps(
+                                data['resource_metadata']),
+                            'f:source': data["source"],
+                            'f:m_%s' % new_meter: "1",
+                            }
+            # Update if resource has new information
+            if new_resource != resource:
+                meters = _load_hbase_list(resource, 'm')
+                if new_meter not in meters:
+                    new_resource['f:m_%s' % new_meter] = "1"
+
+                self.resource.put(data['resource_id'], new_resource)
+            self._resources.set(resource_key, digest)
+            self._meters.add(meter_key)
 
         # Rowkey consists of reversed timestamp, meter and an md5 of
         # user+resource+project for purposes of uniqueness
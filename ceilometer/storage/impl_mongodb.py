@@ -32,6 +32,7 @@ import pymongo
 
 from ceilometer.openstack.common import log
 from ceilometer.storage import base
+from ceilometer.storage import cache
 from ceilometer.storage import models
 
 
@@ -226,6 +227,16 @@ class Connection(base.Connection):
         if 'username' in opts:
             self.db.authenticate(opts['username'], opts['password'])
 
+        # (user or project, id, source) already recorded
+        self._associations = cache.BoundedCache(
+            conf.storage_association_cache_size)
+        # Digest of the resource last recorded
+        self._resources = cache.BoundedCache(
+            conf.storage_resource_cache_size)
+        # (resource, meter) already recorded
+        self._meters = cache.BoundedCache(
+            conf.storage_resource_cache_size)
+
         # Establish indexes
         #
         # We need variations for user_id vs. project_id because of the
@@ -250,6 +261,9 @@ class Connection(base.Connection):
         pass
 
     def clear(self):
+        self._associations.clear()
+        self._resources.clear()
+        self._meters.clear()
         if self._mim_instance is not None:
             # Don't want to use drop_database() because
             # may end up running out of spidermonkey instances.
@@ -258,6 +272,11 @@ class Connection(base.Connection):
         else:
             self.conn.drop_database(self.db)
 
+    def get_cache_stats(self):
+        return cache.get_stats(associations=self._associations,
+                               resources=self._resources,
+                               meters=self._meters)
+
     def _parse_connection_url(self, url):
         opts = {}
         result = urlparse.urlparse(url)
@@ -283,37 +302,50 @@ class Connection(base.Connection):
                      ceilometer.meter.meter_message_from_counter
         """
         # Make sure we know about the user and project
-        self.db.user.update(
-            {'_id': data['user_id']},
-            {'$addToSet': {'source': data['source'],
-                           },
-             },
-            upsert=True,
-        )
-        self.db.project.update(
-            {'_id': data['project_id']},
-            {'$addToSet': {'source': data['source'],
-                           },
-             },
-            upsert=True,
-        )
-
-        # Record the updated resource metadata
-        self.db.resource.update(
-            {'_id': data['resource_id']},
-            {'$set': {'project_id': data['project_id'],
-                      'user_id': data['user_id'],
-                      'metadata': data['resource_metadata'],
-                      'source': data['source'],
-                      },
-             '$addToSet': {'meter': {'counter_name': data['counter_name'],
-                                     'counter_type': data['counter_type'],
-                                     'counter_unit': data['counter_unit'],
-                                     },
-                           },
-             },
-            upsert=True,
-        )
+        user_key = ('user', data['user_id'], data['source'])
+        if user_key not in self._associations:
+            self.db.user.update(
+                {'_id': data['user_id']},
+                {'$addToSet': {'source': data['source'],
+                               },
+                 },
+                upsert=True,
+            )
+            self._associations.add(user_key)
+        project_key = ('project', data['project_id'], data['source'])
+        if project_key not in self._associations:
+            self.db.project.update(
+                {'_id': data['project_id']},
+                {'$addToSet': {'source': data['source'],
+                               },
+                 },
+                upsert=True,
+            )
+            self._associations.add(project_key)
+
+        # Record the updated resource metadata, unless unchanged
+        resource_key = cache.resource_key(data)
+        digest = cache.resource_digest(data)
+        meter_key = cache.meter_key(data)
+        if not (self._resources.is_cached(resource_key, digest)
+                and meter_key in self._meters):
+            self.db.resource.update(
+                {'_id': data['resource_id']},
+                {'$set': {'project_id': data['project_id'],
+                          'user_id': data['user_id'],
+                          'metadata': data['resource_metadata'],
+                          'source': data['source'],
+                          },
+                 '$addToSet': {'meter': {'counter_name': data['counter_name'],
+                                         'counter_type': data['counter_type'],
+                                         'counter_unit': data['counter_unit'],
+                                         },
+                               },
+                 },
+                upsert=True,
+            )
+            self._resources.set(resource_key, digest)
+            self._meters.add(meter_key)
 
         # Record the raw data for the event. Use a copy so we do not
         # modify a data structure owned by our caller (the driver adds
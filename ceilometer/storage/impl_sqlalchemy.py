@@ -19,21 +19,80 @@
 
 from __future__ import absolute_import
 
+import calendar
+import collections
 import copy
+import datetime
+import importlib
+import math
 import os
+
+from oslo.config import cfg
+import sqlalchemy
 from sqlalchemy import func
+from sqlalchemy.ext import compiler
+from sqlalchemy import Integer
+from sqlalchemy import orm
+from sqlalchemy import sql
+from sqlalchemy.sql import expression
 
 from ceilometer.openstack.common import log
 from ceilometer.openstack.common import timeutils
+from ceilometer import storage
 from ceilometer.storage import base
+from ceilometer.storage import cache
 from ceilometer.storage import models as api_models
 from ceilometer.storage.sqlalchemy import migration
 from ceilometer.storage.sqlalchemy.models import Meter, Project, Resource
+from ceilometer.storage.sqlalchemy.models import LazyJSON
+from ceilometer.storage.sqlalchemy.models import MeterPartition, MetaKV
+from ceilometer.storage.sqlalchemy.models import MeterRollup, merge_rollup
+from ceilometer.storage.sqlalchemy.models import meta_kv_rows
+from ceilometer.storage.sqlalchemy.models import meta_value_column
+from ceilometer.storage.sqlalchemy.models import ResourceMeter
+from ceilometer.storage.sqlalchemy.models import ROLLUP_GRANULARITIES
+from ceilometer.storage.sqlalchemy.models import rollup_period_start
+from ceilometer.storage.sqlalchemy.models import sample_rollups
 from ceilometer.storage.sqlalchemy.models import Source, User, Base
+from ceilometer.storage.sqlalchemy.models import sourceassoc, table_args
 import ceilometer.storage.sqlalchemy.session as sqlalchemy_session
 
 LOG = log.getLogger(__name__)
 
+# The partitions have the indexes of the meter table
+meter_indexes = importlib.import_module(
+    'ceilometer.storage.sqlalchemy.migrate_repo.versions.'
+    '007_add_meter_indexes')
+
+# Number of samples fetched at once by get_samples
+SAMPLES_CHUNK_SIZE = 1000
+
+# Number of rollup rows deleted at once when they are compacted
+ROLLUP_CHUNK_SIZE = 500
+
+# A Monday, when the first weekly partition starts
+PARTITION_ORIGIN = datetime.datetime(1970, 1, 5)
+
+# Tables of the partitions, created on demand
+PARTITION_METADATA = sqlalchemy.MetaData()
+
+# Statistics merged from the rollups and the samples
+RollupStatistics = collections.namedtuple(
+    'RollupStatistics', ['count', 'sum', 'min', 'max', 'avg', 'tsmin',
+                         'tsmax'])
+
+
+class LazyResource(api_models.Resource):
+    """A resource whose metadata are decoded on first access."""
+
+    metadata = LazyJSON('metadata')
+
+
+class LazySample(api_models.Sample):
+    """A sample whose metadata are decoded on first access."""
+
+    resource_metadata = LazyJSON('resource_metadata')
+
 
 class SQLAlchemyStorage(base.StorageEngine):
     """Put the data into a SQLAlchemy database.
@@ -50,10 +109,12 @@ class SQLAlchemyStorage(base.StorageEngine):
           - the raw incoming data
           - { id: meter id
               counter_name: counter name
+              source_id: source id          (->source.id)
               user_id: user uuid            (->user.id)
               project_id: project uuid      (->project.id)
               resource_id: resource uuid    (->resource.id)
               resource_metadata: metadata dictionaries
+              metadata_hash: digest of the metadata (->meta_kv)
               counter_type: counter type
               counter_unit: counter unit
               counter_volume: counter volume
@@ -65,20 +126,69 @@ class SQLAlchemyStorage(base.StorageEngine):
           - the metadata for resources
           - { id: resource uuid
               resource_metadata: metadata dictionaries
+              metadata_hash: digest of the metadata (->meta_kv)
               project_id: project uuid      (->project.id)
               user_id: user uuid            (->user.id)
               }
+        - resource_meter
+          - the meters recorded for each resource
+          - { id: resource meter id
+              resource_id: resource uuid    (->resource.id)
+              counter_name: counter name
+              counter_type: counter type
+              counter_unit: counter unit
+              }
+        - meta_kv
+          - the flattened keys and values of the metadata
+          - { metadata_hash: digest of the metadata
+              meta_key: flattened key
+              value_text: string value
+              value_int: integer value
+              value_float: float value
+              value_bool: boolean value
+              }
+        - meter_rollup
+          - the statistics of the samples by hour and by day
+          - { id: rollup id
+              granularity: duration of the period in seconds
+              period_start: datetime
+              counter_name: counter name
+              resource_id: resource uuid
+              user_id: user uuid
+              project_id: project uuid
+              source_id: source id
+              sample_count: number of samples
+              volume_sum: sum of the volumes
+              volume_min: minimum volume
+              volume_max: maximum volume
+              first_timestamp: datetime of the first sample
+              last_timestamp: datetime of the last sample
+              compacted: whether the only row of its period and key
+              }
+        - meter_partition
+          - the tables holding the samples of a period, when partitioned
+          - { id: table name
+              period_start: datetime
+              period_end: datetime
+              }
         - sourceassoc
-          - the relationships
-          - { meter_id: meter id            (->meter.id)
-              project_id: project uuid      (->project.id)
+          - the relationships of the users, projects and resources to
+            their sources
+          - { project_id: project uuid      (->project.id)
               resource_id: resource uuid    (->resource.id)
               user_id: user uuid            (->user.id)
               source_id: source id          (->source.id)
               }
     """
 
-    OPTIONS = []
+    OPTIONS = [
+        cfg.IntOpt('sql_meter_partition_days',
+                   default=0,
+                   help='store the samples in a table per period of this '
+                   'number of days, e.g. 1 for daily or 7 for weekly '
+                   'tables, 0 to store them all in the meter table',
+                   ),
+    ]
 
     def register_opts(self, conf):
         """Register any configuration options used by this engine."""
@@ -91,37 +201,247 @@ class SQLAlchemyStorage(base.StorageEngine):
         return Connection(conf)
 
 
-def make_query_from_filter(query, event_filter, require_meter=True):
+def make_query_from_filter(query, event_filter, require_meter=True,
+                           meter=Meter):
     """Return a query dictionary based on the settings in the filter.
 
     :param filter: EventFilter instance
     :param require_meter: If true and the filter does not have a meter,
                           raise an error.
+    :param meter: The Meter model, its alias on the partitions, or the
+                  MeterRollup model when the filter has no time range nor
+                  metaquery.
     """
 
-    if event_filter.meter:
-        query = query.filter(Meter.counter_name == event_filter.meter)
-    elif require_meter:
+    if not event_filter.meter and require_meter:
         raise RuntimeError('Missing required meter specifier')
+    for condition in _filter_conditions(meter, event_filter):
+        query = query.filter(condition)
+    return query
+
+
+def _filter_conditions(meter, event_filter):
+    """Return the conditions of the settings in the filter.
+
+    :param meter: The Meter model, or the columns of a meter table.
+    """
+    conditions = []
+    if event_filter.meter:
+        conditions.append(meter.counter_name == event_filter.meter)
     if event_filter.source:
-        query = query.filter(Meter.sources.any(id=event_filter.source))
+        conditions.append(meter.source_id == event_filter.source)
     if event_filter.start:
-        ts_start = event_filter.start
-        query = query.filter(Meter.timestamp >= ts_start)
+        conditions.append(meter.timestamp >= event_filter.start)
     if event_filter.end:
-        ts_end = event_filter.end
-        query = query.filter(Meter.timestamp < ts_end)
+        conditions.append(meter.timestamp < event_filter.end)
     if event_filter.user:
-        query = query.filter_by(user_id=event_filter.user)
+        conditions.append(meter.user_id == event_filter.user)
     if event_filter.project:
-        query = query.filter_by(project_id=event_filter.project)
+        conditions.append(meter.project_id == event_filter.project)
     if event_filter.resource:
-        query = query.filter_by(resource_id=event_filter.resource)
-
+        conditions.append(meter.resource_id == event_filter.resource)
     if event_filter.metaquery:
-        raise NotImplementedError('metaquery not implemented')
+        conditions.append(_metaquery_filter(meter.metadata_hash,
+                                            event_filter.metaquery))
+    return conditions
 
-    return query
+
+def _metaquery_filter(column, metaquery):
+    """Return the condition on a metadata digest column matching the
+    metadata of metaquery.
+    """
+    conditions = []
+    for key, value in sorted(metaquery.iteritems()):
+        if key.startswith('metadata.'):
+            key = key[len('metadata.'):]
+        value_column = meta_value_column(value)
+        if value_column is None:
+            if not isinstance(value, basestring):
+                raise NotImplementedError('metaquery on %s values not '
+                                          'implemented' % type(value))
+            # Too long to be recorded, never matches
+            value_column = 'value_text'
+        conditions.append(column.in_(sql.select(
+            [MetaKV.metadata_hash]).where(sql.and_(
+                MetaKV.meta_key == key,
+                getattr(MetaKV, value_column) == value))))
+    return sql.and_(*conditions)
+
+
+def _json_text(column):
+    """Select the json-encoded string of a column, left for the caller to
+    decode.
+    """
+    return sql.type_coerce(column.__clause_element__(),
+                           sqlalchemy.String).label(column.key)
+
+
+def _epoch(dialect, column):
+    """Return the expression of the seconds since the epoch of a naive
+    UTC datetime column, None if the dialect is not supported.
+    """
+    if dialect == 'sqlite':
+        return sql.cast(func.strftime('%s', column), Integer)
+    # Literal constants, so that the expression is rendered the same way
+    # in the select list and in the GROUP BY clause
+    if dialect == 'mysql':
+        # UNIX_TIMESTAMP() would convert from the session time zone
+        return func.timestampdiff(
+            sql.literal_column('SECOND'),
+            sql.literal_column("'1970-01-01 00:00:00'"),
+            column)
+    if dialect == 'postgresql':
+        return sql.extract('epoch', column.op('AT TIME ZONE')(
+            sql.literal_column("'UTC'")))
+
+
+def _period_bucket(dialect, column, start, period):
+    """Return the expression of the index of the period of a datetime
+    column, None if the dialect is not supported.
+
+    The values are compared at the second.
+
+    :param start: When the first period starts.
+    :param period: The duration of the periods, in seconds.
+    """
+    epoch = _epoch(dialect, column)
+    if epoch is None:
+        return None
+    offset = epoch - sql.literal_column(
+        str(calendar.timegm(start.utctimetuple())))
+    period = sql.literal_column(str(int(period)))
+    if dialect == 'sqlite':
+        # Integer division
+        return offset / period
+    return func.floor(offset / period)
+
+
+def _merge_statistics(results):
+    """Return the statistics of the samples of several statistics query
+    results.
+    """
+    results = [r for r in results if r.count]
+    if not results:
+        return RollupStatistics(0, None, None, None, None, None, None)
+    count = sum(int(r.count) for r in results)
+    total = sum(r.sum for r in results)
+    return RollupStatistics(count=count,
+                            sum=total,
+                            min=min(r.min for r in results),
+                            max=max(r.max for r in results),
+                            avg=total / float(count),
+                            tsmin=min(r.tsmin for r in results),
+                            tsmax=max(r.tsmax for r in results))
+
+
+def _insert_ignore(connection, table, rows):
+    """Insert rows with a single executemany, skipping those whose
+    primary key is already recorded.
+
+    ON CONFLICT DO NOTHING is used from PostgreSQL 9.5, the rows already
+    recorded are looked up first with older servers and other databases.
+    """
+    dialect = connection.dialect.name
+    if dialect == 'mysql':
+        connection.execute(table.insert().prefix_with('IGNORE'), rows)
+    elif dialect == 'sqlite':
+        connection.execute(table.insert().prefix_with('OR IGNORE'), rows)
+    elif (dialect == 'postgresql'
+          and (connection.dialect.server_version_info or ()) >= (9, 5)):
+        # No ON CONFLICT construct in SQLAlchemy, the statement is built
+        # as text with typed bind parameters
+        keys = sorted(rows[0])
+        connection.execute(sql.text(
+            '%s ON CONFLICT DO NOTHING' % table.insert().compile(
+                column_keys=keys),
+            bindparams=[sql.bindparam(k, type_=table.c[k].type)
+                        for k in keys]), rows)
+    else:
+        key = list(table.primary_key.columns)[0]
+        existing = set(r[0] for r in connection.execute(
+            sql.select([key]).where(key.in_(set(r[key.name]
+                                                for r in rows)))))
+        rows = [r for r in rows if r[key.name] not in existing]
+        if rows:
+            connection.execute(table.insert(), rows)
+
+
+class _InsertFromSelect(expression.Executable, expression.ClauseElement):
+    """INSERT INTO table (columns) SELECT ..., not supported by this
+    version of SQLAlchemy.
+    """
+
+    def __init__(self, table, columns, select):
+        self.table = table
+        self.columns = columns
+        self.select = select
+
+
+@compiler.compiles(_InsertFromSelect)
+def _compile_insert_from_select(element, compiler, **kw):
+    return 'INSERT INTO %s (%s) %s' % (
+        compiler.process(element.table, asfrom=True),
+        ', '.join(element.columns),
+        compiler.process(element.select))
+
+
+def _insert_missing(connection, table, rows, columns):
+    """Insert the rows whose values of columns are not already recorded,
+    for the tables without a unique key on them.
+
+    :param columns: The columns, the first one being used to look the
+                    recorded rows up.
+    """
+    lookup = table.c[columns[0]]
+    existing = set(tuple(r) for r in connection.execute(
+        sql.select([table.c[c] for c in columns]).where(
+            lookup.in_(set(r[lookup.name] for r in rows)))))
+    missing = {}
+    for row in rows:
+        missing.setdefault(tuple(row[c] for c in columns), row)
+    for values in existing:
+        missing.pop(values, None)
+    if missing:
+        connection.execute(table.insert(), missing.values())
+
+
+def _meter_row(data, metadata_hash=None):
+    """Return the values of the meter row of a metering message."""
+    return {
+        'counter_name': data['counter_name'],
+        'counter_type': data['counter_type'],
+        'counter_unit': data['counter_unit'],
+        'counter_volume': data['counter_volume'],
+        'source_id': data['source'] or None,
+        'user_id': str(data['user_id']) if data['user_id'] else None,
+        'project_id': (str(data['project_id'])
+                       if data['project_id'] else None),
+        'resource_id': str(data['resource_id']),
+        'resource_metadata': data['resource_metadata'],
+        'metadata_hash': metadata_hash,
+        'timestamp': data['timestamp'] or timeutils.utcnow(),
+        'message_signature': data['message_signature'],
+        'message_id': data['message_id'],
+    }
+
+
+def _partition_start(timestamp, days):
+    """Return when the partition of the samples of a timestamp starts."""
+    offset = (timestamp - PARTITION_ORIGIN).days // days * days
+    return PARTITION_ORIGIN + datetime.timedelta(days=offset)
+
+
+def _partition_table(name):
+    """Return the table of a partition, with the columns of the meter
+    table.
+    """
+    if name in PARTITION_METADATA.tables:
+        return PARTITION_METADATA.tables[name]
+    return sqlalchemy.Table(
+        name, PARTITION_METADATA,
+        *[sqlalchemy.Column(c.name, c.type, primary_key=c.primary_key)
+          for c in Meter.__table__.columns],
+        **(table_args() or {}))
 
 
 class Connection(base.Connection):
@@ -133,74 +453,519 @@ class Connection(base.Connection):
             url = os.environ.get('CEILOMETER_TEST_SQL_URL', url)
         LOG.info('connecting to %s', url)
         self.session = sqlalchemy_session.get_session(url, conf)
+        # (user or project, id, source) already recorded
+        self._associations = cache.BoundedCache(
+            conf.storage_association_cache_size)
+        # Digest of the resource last recorded
+        self._resources = cache.BoundedCache(
+            conf.storage_resource_cache_size)
+        # (resource, meter) already recorded
+        self._meters = cache.BoundedCache(
+            conf.storage_resource_cache_size)
+        # Digests of the metadata recorded in meta_kv
+        self._metadata = cache.BoundedCache(
+            conf.storage_resource_cache_size)
+        # Ids of the sources already recorded
+        self._sources = cache.BoundedCache(
+            conf.storage_association_cache_size)
+        self._partition_days = conf.sql_meter_partition_days
+        # Names of the partitions known to exist
+        self._partitions = set()
 
     def upgrade(self, version=None):
         migration.db_sync(self.session.get_bind(), version=version)
 
     def clear(self):
+        self._associations.clear()
+        self._resources.clear()
+        self._meters.clear()
+        self._metadata.clear()
+        self._sources.clear()
         engine = self.session.get_bind()
+        for partition in self.session.query(MeterPartition.id).all():
+            _partition_table(partition.id).drop(engine, checkfirst=True)
+        self._partitions.clear()
         for table in reversed(Base.metadata.sorted_tables):
             engine.execute(table.delete())
 
+    def _get_partition(self, timestamp):
+        """Return the table of the partition of the samples of a timestamp,
+        creating it if needed.
+        """
+        start = _partition_start(timestamp, self._partition_days)
+        name = start.strftime('meter_%Y%m%d')
+        table = _partition_table(name)
+        if name in self._partitions:
+            return table
+        engine = self.session.get_bind()
+        if not engine.has_table(name):
+            LOG.info('creating the samples partition %s', name)
+            # Except on MySQL, the indexes created once are attached to the
+            # table and created with it afterwards
+            indexes = not table.indexes
+            try:
+                table.create(engine)
+            except sqlalchemy.exc.SQLAlchemyError:
+                # Unless created by another connection in the meantime
+                if not engine.has_table(name):
+                    raise
+                indexes = False
+            if indexes:
+                for table_name, index, columns in meter_indexes.INDEXES:
+                    if table_name == 'meter':
+                        meter_indexes.create_index(
+                            engine, table, index.replace('meter', name, 1),
+                            columns)
+                for column in ('source_id', 'metadata_hash'):
+                    meter_indexes.create_index(
+                        engine, table, 'ix_%s_%s' % (name, column),
+                        (column,))
+        _insert_ignore(engine, MeterPartition.__table__, [{
+            'id': name,
+            'period_start': start,
+            'period_end': start + datetime.timedelta(
+                days=self._partition_days),
+        }])
+        self._partitions.add(name)
+        return table
+
+    def _meter(self, event_filter):
+        """Return the Meter model to query the samples matching a filter,
+        still to be applied by the caller.
+
+        When partitioned, it is aliased to the union of the samples of the
+        meter table, holding those recorded before, and of the partitions
+        overlapping the time range matching the filter, selected from each
+        table to use its indexes.
+        """
+        query = self.session.query(MeterPartition.id)
+        if event_filter.start:
+            query = query.filter(
+                MeterPartition.period_end > event_filter.start)
+        if event_filter.end:
+            query = query.filter(
+                MeterPartition.period_start < event_filter.end)
+        tables = [_partition_table(p.id)
+                  for p in query.order_by(MeterPartition.period_start)]
+        if not tables:
+            return Meter
+        columns = [c.name for c in Meter.__table__.columns]
+        return orm.aliased(Meter, sql.union_all(*[
+            sql.select([t.c[c] for c in columns],
+                       sql.and_(*_filter_conditions(t.c, event_filter)))
+            for t in [Meter.__table__] + tables]).alias('meter_partitions'))
+
+    def clear_expired_metering_data(self, ttl):
+        """Clear the samples older than ttl seconds.
+
+        When partitioned, the partitions are dropped once all their samples
+        are expired. The rollups are deleted with the samples, those of the
+        day the samples kept start are computed again. The meta_kv rows are
+        kept, the digests of the metadata being cached by the collectors
+        which would not record them again.
+
+        :param ttl: Number of seconds to keep the samples.
+        """
+        end = timeutils.utcnow() - datetime.timedelta(seconds=ttl)
+        engine = self.session.get_bind()
+        for partition in self.session.query(MeterPartition.id).filter(
+                MeterPartition.period_end <= end).all():
+            LOG.info('dropping the expired samples partition %s',
+                     partition.id)
+            _partition_table(partition.id).drop(engine, checkfirst=True)
+            engine.execute(MeterPartition.__table__.delete().where(
+                MeterPartition.id == partition.id))
+            self._partitions.discard(partition.id)
+        engine.execute(Meter.__table__.delete().where(
+            Meter.timestamp < end))
+        # The samples of the partitions partially expired are kept
+        horizon = end
+        if self._partition_days:
+            first = self.session.query(
+                sql.func.min(MeterPartition.period_start)).scalar()
+            if first is not None:
+                horizon = min(horizon, first)
+        self._rebuild_rollups(
+            rollup_period_start(horizon, 86400),
+            rollup_period_start(end, 86400) + datetime.timedelta(days=1))
+
+    def _rebuild_rollups(self, start, end):
+        """Delete the rollups of the periods starting before end, and
+        compute again from the samples those of the periods between start
+        and end, both aligned on a day.
+
+        The rollups of the periods partially expired then match the
+        samples kept. They are computed by the database, with an INSERT
+        ... SELECT per period.
+        """
+        meter = self._meter(storage.EventFilter(start=start, end=end))
+        keys = ('counter_name', 'resource_id', 'user_id', 'project_id',
+                'source_id')
+        table = MeterRollup.__table__
+        self.session.flush()
+        with self.session.begin():
+            connection = self.session.connection()
+            connection.execute(table.delete().where(
+                table.c.period_start < end))
+            for granularity in ROLLUP_GRANULARITIES:
+                increment = datetime.timedelta(seconds=granularity)
+                period_start = start
+                while period_start < end:
+                    query = self.session.query(
+                        sql.literal(granularity, type_=Integer),
+                        sql.literal(period_start,
+                                    type_=table.c.period_start.type),
+                        *[getattr(meter, k) for k in keys] + [
+                            func.count(meter.counter_volume),
+                            func.sum(meter.counter_volume),
+                            func.min(meter.counter_volume),
+                            func.max(meter.counter_volume),
+                            func.min(meter.timestamp),
+                            func.max(meter.timestamp),
+                            sql.literal(True,
+                                        type_=table.c.compacted.type)])
+                    query = query.filter(
+                        meter.timestamp >= period_start).filter(
+                            meter.timestamp < period_start + increment)
+                    query = query.filter(meter.counter_volume.isnot(None))
+                    connection.execute(_InsertFromSelect(
+                        table,
+                        ('granularity', 'period_start') + keys + (
+                            'sample_count', 'volume_sum', 'volume_min',
+                            'volume_max', 'first_timestamp',
+                            'last_timestamp', 'compacted'),
+                        query.group_by(*[getattr(meter, k)
+                                         for k in keys]).statement))
+                    period_start += increment
+
     def record_metering_data(self, data):
         """Write the data to the backend storage system.
 
         :param data: a dictionary such as returned by
                      ceilometer.meter.meter_message_from_counter
         """
-        if data['source']:
-            source = self.session.query(Source).get(data['source'])
-            if not source:
-                source = Source(id=data['source'])
-                self.session.add(source)
+        # Sources already recorded are only loaded to be associated
+        source_id = data['source']
+        if source_id and source_id not in self._sources:
+            source = self._get_source(source_id)
         else:
             source = None
 
-        # create/update user && project, add/update their sources list
-        if data['user_id']:
+        # create/update user && project, add/update their sources list,
+        # unless they are already known to be recorded
+        user_key = ('user', data['user_id'], data['source'])
+        if data['user_id'] and user_key not in self._associations:
             user = self.session.merge(User(id=str(data['user_id'])))
+            source = source or self._get_source(source_id)
             if not filter(lambda x: x.id == source.id, user.sources):
                 user.sources.append(source)
         else:
             user = None
 
-        if data['project_id']:
+        project_key = ('project', data['project_id'], data['source'])
+        if data['project_id'] and project_key not in self._associations:
             project = self.session.merge(Project(id=str(data['project_id'])))
+            source = source or self._get_source(source_id)
             if not filter(lambda x: x.id == source.id, project.sources):
                 project.sources.append(source)
         else:
             project = None
 
-        # Record the updated resource metadata
+        # Record the updated resource metadata, unless unchanged
         rmetadata = data['resource_metadata']
+        metadata_hash, meta_rows = meta_kv_rows(rmetadata)
 
-        resource = self.session.merge(Resource(id=str(data['resource_id'])))
-        if not filter(lambda x: x.id == source.id, resource.sources):
-            resource.sources.append(source)
-        resource.project = project
-        resource.user = user
-        # Current metadata being used and when it was last updated.
-        resource.resource_metadata = rmetadata
+        resource_key = cache.resource_key(data)
+        digest = cache.resource_digest(data)
+        meter_key = cache.meter_key(data)
+        if (self._resources.is_cached(resource_key, digest)
+                and meter_key in self._meters):
+            resource = None
+        else:
+            resource = self.session.merge(
+                Resource(id=str(data['resource_id'])))
+            source = source or self._get_source(source_id)
+            if not filter(lambda x: x.id == source.id, resource.sources):
+                resource.sources.append(source)
+            self._set_owner(resource, user, project, data)
+            # Current metadata being used and when it was last updated.
+            resource.resource_metadata = rmetadata
+            resource.metadata_hash = metadata_hash
+            self._record_resource_meter(data)
         # autoflush didn't catch this one, requires manual flush
         self.session.flush()
+        if source is not None:
+            self._sources.add(source_id)
+        if user is not None:
+            self._associations.add(user_key)
+        if project is not None:
+            self._associations.add(project_key)
+        if resource is not None:
+            self._resources.set(resource_key, digest)
+            self._meters.add(meter_key)
+
+        # Record the flattened metadata, unless already there
+        if (metadata_hash is not None
+                and not self._metadata.is_cached(metadata_hash)):
+            if meta_rows:
+                _insert_ignore(self.session.get_bind(), MetaKV.__table__,
+                               meta_rows)
+            self._metadata.add(metadata_hash)
 
         # Record the raw data for the event.
+        row = _meter_row(data, metadata_hash)
+        # Merged with the other rows of their periods by compact_rollups
+        rollups = [MeterRollup(compacted=False, **r)
+                   for r in sample_rollups(row)]
+        if self._partition_days:
+            table = self._get_partition(row['timestamp'])
+            with self.session.begin(subtransactions=True):
+                self.session.execute(table.insert(), row)
+                self.session.add_all(rollups)
+            return
+        # Flushed with the sample, in the same transaction
+        self.session.add_all(rollups)
         meter = Meter(counter_type=data['counter_type'],
                       counter_unit=data['counter_unit'],
-                      counter_name=data['counter_name'], resource=resource)
+                      counter_name=data['counter_name'])
+        if resource is None:
+            meter.resource_id = str(data['resource_id'])
+        else:
+            meter.resource = resource
         self.session.add(meter)
-        if not filter(lambda x: x.id == source.id, meter.sources):
-            meter.sources.append(source)
-        meter.project = project
-        meter.user = user
-        meter.timestamp = data['timestamp']
+        meter.source_id = data['source'] or None
+        self._set_owner(meter, user, project, data)
+        meter.timestamp = row['timestamp']
         meter.resource_metadata = rmetadata
+        meter.metadata_hash = metadata_hash
         meter.counter_volume = data['counter_volume']
         meter.message_signature = data['message_signature']
         meter.message_id = data['message_id']
 
         return
 
+    def compact_rollups(self):
+        """Merge the rows of the rollups holding the statistics of the same
+        period, one period at a time.
+        """
+        table = MeterRollup.__table__
+        periods = self.session.query(
+            MeterRollup.granularity,
+            MeterRollup.period_start).filter(
+                sql.not_(MeterRollup.compacted)).distinct().all()
+        for granularity, period_start in periods:
+            with self.session.begin():
+                connection = self.session.connection()
+                rollups = {}
+                ids = []
+                # Locked, not to lose the samples added to the rows
+                for row in connection.execute(sql.select(
+                        [table],
+                        sql.and_(table.c.granularity == granularity,
+                                 table.c.period_start == period_start),
+                        for_update=True)):
+                    ids.append(row.id)
+                    merge_rollup(rollups, row)
+                for offset in xrange(0, len(ids), ROLLUP_CHUNK_SIZE):
+                    connection.execute(table.delete().where(table.c.id.in_(
+                        ids[offset:offset + ROLLUP_CHUNK_SIZE])))
+                connection.execute(table.insert(), [
+                    dict(r, compacted=True) for r in rollups.values()])
+
+    def record_metering_batch(self, data):
+        """Write a list of metering data to the backend storage system.
+
+        The samples are inserted with a single executemany, the users,
+        projects, sources and resources are inserted unless already
+        recorded, in a single transaction.
+
+        :param data: a list of dictionaries such as returned by
+                     ceilometer.meter.meter_message_from_counter
+        """
+        if not data:
+            return
+        sources = {}
+        users = {}
+        projects = {}
+        resources = {}
+        resource_meters = []
+        associations = []
+        metadata_hashes = []
+        meta_rows = {}
+        # Cache entries set once the transaction is committed
+        association_keys = []
+        resource_digests = {}
+        meter_keys = set()
+        for meter in data:
+            metadata_hash, rows = meta_kv_rows(meter['resource_metadata'])
+            metadata_hashes.append(metadata_hash)
+            if (metadata_hash is not None
+                    and metadata_hash not in meta_rows
+                    and not self._metadata.is_cached(metadata_hash)):
+                meta_rows[metadata_hash] = rows
+
+            source = meter['source'] or None
+            if source and source not in self._sources:
+                sources[source] = {'id': source}
+            for kind, owners in (('user', users), ('project', projects)):
+                owner = meter['%s_id' % kind]
+                key = (kind, owner, meter['source'])
+                if owner and key not in self._associations:
+                    owners[str(owner)] = {'id': str(owner)}
+                    association_keys.append(key)
+                    if source:
+                        associations.append(('%s_id' % kind, str(owner),
+                                             source))
+
+            # Record the updated resource metadata, unless unchanged since
+            # the previous sample of the resource, in the batch or not
+            resource_id = str(meter['resource_id'])
+            resource_key = cache.resource_key(meter)
+            digest = cache.resource_digest(meter)
+            if resource_key in resource_digests:
+                changed = resource_digests[resource_key] != digest
+            else:
+                changed = not self._resources.is_cached(resource_key,
+                                                        digest)
+            if changed:
+                resources[resource_id] = {
+                    'resource': resource_id,
+                    'user_id': (str(meter['user_id'])
+                                if meter['user_id'] else None),
+                    'project_id': (str(meter['project_id'])
+                                   if meter['project_id'] else None),
+                    'resource_metadata': meter['resource_metadata'],
+                    'metadata_hash': metadata_hash,
+                }
+                resource_digests[resource_key] = digest
+                if source:
+                    associations.append(('resource_id', resource_id,
+                                         source))
+            meter_key = cache.meter_key(meter)
+            if meter_key not in meter_keys and meter_key not in self._meters:
+                resource_meters.append({
+                    'resource_id': resource_id,
+                    'counter_name': meter['counter_name'],
+                    'counter_type': meter['counter_type'],
+                    'counter_unit': meter['counter_unit'],
+                })
+                meter_keys.add(meter_key)
+
+        # Tables are not created within the transaction
+        meters = {}
+        rollups = {}
+        for meter, metadata_hash in zip(data, metadata_hashes):
+            row = _meter_row(meter, metadata_hash)
+            for rollup in sample_rollups(row):
+                merge_rollup(rollups, rollup)
+            if self._partition_days:
+                table = self._get_partition(row['timestamp'])
+            else:
+                table = Meter.__table__
+            meters.setdefault(table, []).append(row)
+
+        # The ORM changes not flushed yet are written first
+        self.session.flush()
+        with self.session.begin():
+            connection = self.session.connection()
+            for model, rows in ((Source, sources),
+                                (User, users),
+                                (Project, projects)):
+                if rows:
+                    _insert_ignore(connection, model.__table__,
+                                   rows.values())
+            rows = [r for kv in meta_rows.values() for r in kv]
+            if rows:
+                _insert_ignore(connection, MetaKV.__table__, rows)
+            if resources:
+                table = Resource.__table__
+                _insert_ignore(connection, table, [
+                    {'id': r['resource'],
+                     'user_id': r['user_id'],
+                     'project_id': r['project_id'],
+                     'resource_metadata': r['resource_metadata'],
+                     'metadata_hash': r['metadata_hash']}
+                    for r in resources.values()])
+                # Existing resources were not updated by the insert
+                connection.execute(
+                    table.update().where(
+                        table.c.id == sql.bindparam('resource')),
+                    resources.values())
+            if resource_meters:
+                _insert_missing(connection, ResourceMeter.__table__,
+                                resource_meters,
+                                ('resource_id', 'counter_name',
+                                 'counter_type', 'counter_unit'))
+            for column in ('user_id', 'project_id', 'resource_id'):
+                rows = [{column: owner_id, 'source_id': source_id}
+                        for c, owner_id, source_id in associations
+                        if c == column]
+                if rows:
+                    _insert_missing(connection, sourceassoc, rows,
+                                    (column, 'source_id'))
+            for table, rows in meters.iteritems():
+                connection.execute(table.insert(), rows)
+            # Merged with the other rows of their periods by compact_rollups
+            if rollups:
+                connection.execute(MeterRollup.__table__.insert(), [
+                    dict(r, compacted=False) for r in rollups.values()])
+
+        for source in sources:
+            self._sources.add(source)
+        for key in association_keys:
+            self._associations.add(key)
+        for key, digest in resource_digests.iteritems():
+            self._resources.set(key, digest)
+        for key in meter_keys:
+            self._meters.add(key)
+        for metadata_hash in meta_rows:
+            self._metadata.add(metadata_hash)
+
+    def _record_resource_meter(self, data):
+        """Add the meter of the data to the meters of its resource, unless
+        already there.
+        """
+        values = dict(resource_id=str(data['resource_id']),
+                      counter_name=data['counter_name'],
+                      counter_type=data['counter_type'],
+                      counter_unit=data['counter_unit'])
+        if not self.session.query(ResourceMeter.id).filter_by(
+                **values).first():
+            self.session.add(ResourceMeter(**values))
+
+    def get_cache_stats(self):
+        return cache.get_stats(associations=self._associations,
+                               resources=self._resources,
+                               meters=self._meters,
+                               metadata=self._metadata,
+                               sources=self._sources)
+
+    def _get_source(self, source_id):
+        """Return the source of an id, added to the session unless
+        already recorded, None without id.
+        """
+        if not source_id:
+            return None
+        source = self.session.query(Source).get(source_id)
+        if source is None:
+            source = Source(id=source_id)
+            self.session.add(source)
+        return source
+
+    @staticmethod
+    def _set_owner(obj, user, project, data):
+        # Users and projects already recorded are not loaded, only their
+        # foreign keys are set.
+        if user is None:
+            obj.user_id = str(data['user_id']) if data['user_id'] else None
+        else:
+            obj.user = user
+        if project is None:
+            obj.project_id = (str(data['project_id'])
+                              if data['project_id'] else None)
+        else:
+            obj.project = project
+
     def get_users(self, source=None):
         """Return an iterable of user id strings.
 
@@ -234,36 +999,57 @@ class Connection(base.Connection):
         :param metaquery: Optional dict with metadata to match on.
         :param resource: Optional resource filter.
         """
-        query = self.session.query(Meter,).group_by(Meter.resource_id)
+        meter = self._meter(storage.EventFilter(
+            user=user, project=project, start=start_timestamp,
+            end=end_timestamp, resource=resource, source=source,
+            metaquery=metaquery))
+        query = self.session.query(
+            meter.resource_id,
+            meter.project_id,
+            meter.user_id,
+            _json_text(meter.resource_metadata),
+        ).group_by(meter.resource_id)
         if user is not None:
-            query = query.filter(Meter.user_id == user)
+            query = query.filter(meter.user_id == user)
         if source is not None:
-            query = query.filter(Meter.sources.any(id=source))
+            query = query.filter(meter.source_id == source)
         if start_timestamp:
-            query = query.filter(Meter.timestamp >= start_timestamp)
+            query = query.filter(meter.timestamp >= start_timestamp)
         if end_timestamp:
-            query = query.filter(Meter.timestamp < end_timestamp)
+            query = query.filter(meter.timestamp < end_timestamp)
         if project is not None:
-            query = query.filter(Meter.project_id == project)
+            query = query.filter(meter.project_id == project)
         if resource is not None:
-            query = query.filter(Meter.resource_id == resource)
+            query = query.filter(meter.resource_id == resource)
         if metaquery:
-            raise NotImplementedError('metaquery not implemented')
-
-        for meter in query.all():
-            yield api_models.Resource(
-                resource_id=meter.resource_id,
-                project_id=meter.project_id,
-                user_id=meter.user_id,
-                metadata=meter.resource_metadata,
-                meter=[
-                    api_models.ResourceMeter(
-                        counter_name=m.counter_name,
-                        counter_type=m.counter_type,
-                        counter_unit=m.counter_unit,
-                    )
-                    for m in meter.resource.meters
-                ],
+            query = query.filter(_metaquery_filter(meter.metadata_hash,
+                                                   metaquery))
+
+        resources = query.all()
+
+        # The meters of all the resources found, in a single query
+        resource_ids = query.with_entities(meter.resource_id).subquery()
+        meters = {}
+        for m in self.session.query(
+                ResourceMeter.resource_id,
+                ResourceMeter.counter_name,
+                ResourceMeter.counter_type,
+                ResourceMeter.counter_unit).filter(
+                    ResourceMeter.resource_id.in_(resource_ids)).distinct():
+            meters.setdefault(m.resource_id, []).append(
+                api_models.ResourceMeter(
+                    counter_name=m.counter_name,
+                    counter_type=m.counter_type,
+                    counter_unit=m.counter_unit,
+                ))
+
+        for row in resources:
+            yield LazyResource(
+                resource_id=row.resource_id,
+                project_id=row.project_id,
+                user_id=row.user_id,
+                metadata=row.resource_metadata,
+                meter=meters.get(row.resource_id, []),
             )
 
     def get_meters(self, user=None, project=None, resource=None, source=None,
@@ -276,7 +1062,14 @@ class Connection(base.Connection):
         :param source: Optional source filter.
         :param metaquery: Optional dict with metadata to match on.
         """
-        query = self.session.query(Resource)
+        query = self.session.query(
+            Resource.id,
+            Resource.project_id,
+            Resource.user_id,
+            ResourceMeter.counter_name,
+            ResourceMeter.counter_type,
+            ResourceMeter.counter_unit,
+        ).join(ResourceMeter, ResourceMeter.resource_id == Resource.id)
         if user is not None:
             query = query.filter(Resource.user_id == user)
         if source is not None:
@@ -285,43 +1078,58 @@ class Connection(base.Connection):
             query = query.filter(Resource.id == resource)
         if project is not None:
             query = query.filter(Resource.project_id == project)
-        query = query.options(
-            sqlalchemy_session.sqlalchemy.orm.joinedload('meters'))
         if metaquery:
-            raise NotImplementedError('metaquery not implemented')
-
-        for resource in query.all():
-            meter_names = set()
-            for meter in resource.meters:
-                if meter.counter_name in meter_names:
-                    continue
-                meter_names.add(meter.counter_name)
-                yield api_models.Meter(
-                    name=meter.counter_name,
-                    type=meter.counter_type,
-                    unit=meter.counter_unit,
-                    resource_id=resource.id,
-                    project_id=resource.project_id,
-                    user_id=resource.user_id,
-                )
+            query = query.filter(_metaquery_filter(Resource.metadata_hash,
+                                                   metaquery))
+        query = query.distinct().order_by(Resource.id,
+                                          ResourceMeter.counter_name)
+
+        # A meter is listed once per resource, even if recorded with
+        # several types or units
+        last = None
+        for row in query:
+            if (row.id, row.counter_name) == last:
+                continue
+            last = (row.id, row.counter_name)
+            yield api_models.Meter(
+                name=row.counter_name,
+                type=row.counter_type,
+                unit=row.counter_unit,
+                resource_id=row.id,
+                project_id=row.project_id,
+                user_id=row.user_id,
+            )
 
     def get_samples(self, event_filter):
         """Return an iterable of api_models.Samples
         """
-        query = self.session.query(Meter)
+        meter = self._meter(event_filter)
+        # Plain rows instead of Meter entities, which are neither tracked
+        # by the session nor all loaded before the first one is returned
+        query = self.session.query(
+            meter.source_id,
+            meter.counter_name,
+            meter.counter_type,
+            meter.counter_unit,
+            meter.counter_volume,
+            meter.user_id,
+            meter.project_id,
+            meter.resource_id,
+            meter.timestamp,
+            _json_text(meter.resource_metadata),
+            meter.message_id,
+            meter.message_signature)
         query = make_query_from_filter(query, event_filter,
-                                       require_meter=False)
-        samples = query.all()
+                                       require_meter=False, meter=meter)
+        # Server side cursor, where supported by the database driver
+        query = query.execution_options(stream_results=True)
 
-        for s in samples:
+        for s in query.yield_per(SAMPLES_CHUNK_SIZE):
             # Remove the id generated by the database when
             # the event was inserted. It is an implementation
             # detail that should not leak outside of the driver.
-            yield api_models.Sample(
-                # Replace 'sources' with 'source' to meet the caller's
-                # expectation, Meter.sources contains one and only one
-                # source in the current implementation.
-                source=s.sources[0].id,
+            yield LazySample(
+                source=s.source_id,
                 counter_name=s.counter_name,
                 counter_type=s.counter_type,
                 counter_unit=s.counter_unit,
@@ -335,26 +1143,17 @@ class Connection(base.Connection):
                 message_signature=s.message_signature,
             )
 
-    def _make_volume_query(self, event_filter, counter_volume_func):
-        """Returns complex Meter counter_volume query for max and sum."""
-        subq = self.session.query(Meter.id)
-        subq = make_query_from_filter(subq, event_filter, require_meter=False)
-        subq = subq.subquery()
-        mainq = self.session.query(Resource.id, counter_volume_func)
-        mainq = mainq.join(Meter).group_by(Resource.id)
-        return mainq.filter(Meter.id.in_(subq))
-
-    def _make_stats_query(self, event_filter):
+    def _make_stats_query(self, event_filter, meter=Meter):
         query = self.session.query(
-            func.min(Meter.timestamp).label('tsmin'),
-            func.max(Meter.timestamp).label('tsmax'),
-            func.avg(Meter.counter_volume).label('avg'),
-            func.sum(Meter.counter_volume).label('sum'),
-            func.min(Meter.counter_volume).label('min'),
-            func.max(Meter.counter_volume).label('max'),
-            func.count(Meter.counter_volume).label('count'))
+            func.min(meter.timestamp).label('tsmin'),
+            func.max(meter.timestamp).label('tsmax'),
+            func.avg(meter.counter_volume).label('avg'),
+            func.sum(meter.counter_volume).label('sum'),
+            func.min(meter.counter_volume).label('min'),
+            func.max(meter.counter_volume).label('max'),
+            func.count(meter.counter_volume).label('count'))
 
-        return make_query_from_filter(query, event_filter)
+        return make_query_from_filter(query, event_filter, meter=meter)
 
     @staticmethod
     def _stats_result_to_model(result, period, period_start, period_end):
@@ -382,25 +1181,40 @@ class Connection(base.Connection):
         The filter must have a meter value set.
 
         """
+        meter = self._meter(event_filter)
+        rollups = self._get_rollup_statistics(event_filter, period, meter)
+        if rollups is not None:
+            for stats in rollups:
+                yield stats
+            return
+
         if not period or not event_filter.start or not event_filter.end:
-            res = self._make_stats_query(event_filter).all()[0]
+            res = self._make_stats_query(event_filter, meter).all()[0]
 
         if not period:
             yield self._stats_result_to_model(res, 0, res.tsmin, res.tsmax)
             return
 
-        query = self._make_stats_query(event_filter)
+        start = event_filter.start or res.tsmin
+        end = event_filter.end or res.tsmax
+        bucket = _period_bucket(self.session.get_bind().dialect.name,
+                                meter.timestamp, start, period)
+        if bucket is not None:
+            for stats in self._get_period_statistics(event_filter, start,
+                                                     end, period, bucket,
+                                                     meter):
+                yield stats
+            return
+
+        query = self._make_stats_query(event_filter, meter)
         # HACK(jd) This is an awful method to compute stats by period, but
         # since we're trying to be SQL agnostic we have to write portable
         # code, so here it is, admire! We're going to do one request to get
-        # stats by period. We would like to use GROUP BY, but there's no
-        # portable way to manipulate timestamp in SQL, so we can't.
-        for period_start, period_end in base.iter_period(
-                event_filter.start or res.tsmin,
-                event_filter.end or res.tsmax,
-                period):
-            q = query.filter(Meter.timestamp >= period_start)
-            q = q.filter(Meter.timestamp < period_end)
+        # stats by period. It is only used for the dialects whose timestamps
+        # can't be grouped by period.
+        for period_start, period_end in base.iter_period(start, end, period):
+            q = query.filter(meter.timestamp >= period_start)
+            q = q.filter(meter.timestamp < period_end)
             r = q.all()[0]
             # Don't return results that didn't have any event
             if r.count:
@@ -411,3 +1225,127 @@ class Connection(base.Connection):
                     period_start=period_start,
                     period_end=period_end,
                 )
+
+    def _get_rollup_statistics(self, event_filter, period, meter=Meter):
+        """Return the statistics computed from the rollups, and from the
+        samples at the edges of the time range not covering a whole rollup
+        period, None if the rollups can't be used.
+
+        With a period, it must be a multiple of the duration of the rollup
+        periods and the time range must start at the beginning of one. The
+        rollups are only indexed on the meter and the time: filtered on the
+        owner or the resource, the samples are read instead.
+        """
+        if (event_filter.metaquery or not event_filter.meter
+                or event_filter.user or event_filter.project
+                or event_filter.resource):
+            return None
+        start = event_filter.start
+        end = event_filter.end
+        if period:
+            if not start or not end:
+                return None
+            granularities = [g for g in ROLLUP_GRANULARITIES
+                             if not period % g
+                             and rollup_period_start(start, g) == start]
+        else:
+            # The longest periods the time range is aligned on, hours
+            # otherwise
+            granularities = [g for g in ROLLUP_GRANULARITIES
+                             if all(rollup_period_start(t, g) == t
+                                    for t in (start, end) if t)]
+            granularities.append(ROLLUP_GRANULARITIES[-1])
+        if not granularities:
+            return None
+        granularity = granularities[0]
+        increment = datetime.timedelta(seconds=granularity)
+
+        rollup_start = start and rollup_period_start(start, granularity)
+        if rollup_start and rollup_start < start:
+            rollup_start += increment
+        rollup_end = end and rollup_period_start(end, granularity)
+        if rollup_start and rollup_end and rollup_start >= rollup_end:
+            return None
+
+        def edge_statistics(edge_start, edge_end):
+            edge_filter = copy.copy(event_filter)
+            edge_filter.start = edge_start
+            edge_filter.end = edge_end
+            return self._make_stats_query(edge_filter, meter).all()[0]
+
+        rollup_filter = copy.copy(event_filter)
+        rollup_filter.start = rollup_filter.end = None
+        query = self.session.query(
+            func.min(MeterRollup.first_timestamp).label('tsmin'),
+            func.max(MeterRollup.last_timestamp).label('tsmax'),
+            func.sum(MeterRollup.volume_sum).label('sum'),
+            func.min(MeterRollup.volume_min).label('min'),
+            func.max(MeterRollup.volume_max).label('max'),
+            func.sum(MeterRollup.sample_count).label('count'))
+        query = make_query_from_filter(query, rollup_filter,
+                                       meter=MeterRollup)
+        query = query.filter(MeterRollup.granularity == granularity)
+        if rollup_start:
+            query = query.filter(MeterRollup.period_start >= rollup_start)
+        if rollup_end:
+            query = query.filter(MeterRollup.period_start < rollup_end)
+
+        if not period:
+            results = [query.all()[0]]
+            if start and start < rollup_start:
+                results.append(edge_statistics(start, rollup_start))
+            if end and rollup_end < end:
+                results.append(edge_statistics(rollup_end, end))
+            res = _merge_statistics(results)
+            return [self._stats_result_to_model(res, 0, res.tsmin,
+                                                res.tsmax)]
+
+        bucket = _period_bucket(self.session.get_bind().dialect.name,
+                                MeterRollup.period_start, start, period)
+        if bucket is None:
+            return None
+        buckets = {}
+        for r in query.add_columns(bucket.label('bucket')).group_by(bucket):
+            buckets[int(r.bucket)] = [r]
+        # The samples after the last whole rollup period are all in the
+        # last period
+        if rollup_end < end:
+            index = int(timeutils.delta_seconds(start, rollup_end) // period)
+            buckets.setdefault(index, []).append(
+                edge_statistics(rollup_end, end))
+        increment = datetime.timedelta(seconds=period)
+        statistics = []
+        for index in sorted(buckets):
+            res = _merge_statistics(buckets[index])
+            if res.count:
+                period_start = start + index * increment
+                statistics.append(self._stats_result_to_model(
+                    result=res,
+                    period=int(period),
+                    period_start=period_start,
+                    period_end=period_start + increment,
+                ))
+        return statistics
+
+    def _get_period_statistics(self, event_filter, start, end, period,
+                               bucket, meter=Meter):
+        """Return the statistics of all the periods from a single query
+        grouping the meters by period.
+        """
+        periods = int(math.ceil(timeutils.delta_seconds(start, end)
+                                / float(period)))
+        if not periods:
+            return
+        increment = datetime.timedelta(seconds=period)
+        query = self._make_stats_query(event_filter, meter)
+        query = query.add_columns(bucket.label('bucket'))
+        query = query.filter(meter.timestamp >= start)
+        query = query.filter(meter.timestamp < start + periods * increment)
+        for r in query.group_by(bucket).order_by(bucket):
+            period_start = start + int(r.bucket) * increment
+            yield self._stats_result_to_model(
+                result=r,
+                period=int(period),
+                period_start=period_start,
+                period_end=period_start + increment,
+            )
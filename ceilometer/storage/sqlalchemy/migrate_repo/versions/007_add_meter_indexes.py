@@ -0,0 +1,65 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from sqlalchemy import *
+
+meta = MetaData()
+
+# Composite indexes matching the filters of the meter queries: an
+# equality on the leading columns and a range on the timestamp. The
+# sources of each sample are also looked up by meter id.
+INDEXES = [
+    ('meter', 'ix_meter_counter_name_timestamp',
+     ('counter_name', 'timestamp')),
+    ('meter', 'ix_meter_resource_id_timestamp',
+     ('resource_id', 'timestamp')),
+    ('meter', 'ix_meter_user_id_timestamp',
+     ('user_id', 'timestamp')),
+    ('meter', 'ix_meter_project_id_counter_name_timestamp',
+     ('project_id', 'counter_name', 'timestamp')),
+    ('sourceassoc', 'ix_sourceassoc_meter_id',
+     ('meter_id',)),
+]
+
+# Number of characters of the string columns indexed by MySQL, which keeps
+# the composite keys below the 767 bytes limit of InnoDB with utf8.
+MYSQL_PREFIX_LENGTH = 100
+
+
+def create_index(migrate_engine, table, name, columns):
+    if migrate_engine.name == 'mysql':
+        # The mysql_length of Index applies to a single column only
+        migrate_engine.execute('CREATE INDEX %s ON %s (%s)' % (
+            name, table.name,
+            ', '.join('%s(%d)' % (c, MYSQL_PREFIX_LENGTH)
+                      if isinstance(table.c[c].type, String) else c
+                      for c in columns)))
+    else:
+        Index(name, *[table.c[c] for c in columns]).create(migrate_engine)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for table_name, name, columns in INDEXES:
+        create_index(migrate_engine, Table(table_name, meta, autoload=True),
+                     name, columns)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for table_name, name, columns in INDEXES:
+        table = Table(table_name, meta, autoload=True)
+        Index(name, *[table.c[c] for c in columns]).drop()
@@ -0,0 +1,60 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from sqlalchemy import *
+
+meta = MetaData()
+
+# Indexes of the meter associations of sourceassoc, see 001 and 007
+SOURCEASSOC_METER_INDEXES = [
+    ('idx_sm', ('source_id', 'meter_id')),
+    ('ix_sourceassoc_meter_id', ('meter_id',)),
+]
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    meter = Table('meter', meta, autoload=True)
+    sourceassoc = Table('sourceassoc', meta, autoload=True)
+
+    source_id = Column('source_id', String(255))
+    meter.create_column(source_id)
+    migrate_engine.execute(meter.update().values(
+        source_id=select([func.min(sourceassoc.c.source_id)]).where(
+            sourceassoc.c.meter_id == meter.c.id).as_scalar()))
+    Index('ix_meter_source_id', meter.c.source_id).create()
+
+    # Only the users, projects and resources are associated to their
+    # sources from now on
+    migrate_engine.execute(sourceassoc.delete().where(
+        sourceassoc.c.meter_id.isnot(None)))
+    for name, columns in SOURCEASSOC_METER_INDEXES:
+        Index(name, *[sourceassoc.c[c] for c in columns]).drop()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    meter = Table('meter', meta, autoload=True)
+    sourceassoc = Table('sourceassoc', meta, autoload=True)
+
+    for name, columns in SOURCEASSOC_METER_INDEXES:
+        Index(name, *[sourceassoc.c[c] for c in columns]).create()
+    migrate_engine.execute(
+        'INSERT INTO sourceassoc (meter_id, source_id) '
+        'SELECT id, source_id FROM meter WHERE source_id IS NOT NULL')
+
+    Index('ix_meter_source_id', meter.c.source_id).drop()
+    meter.drop_column('source_id')
@@ -0,0 +1,45 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from sqlalchemy import *
+
+meta = MetaData()
+
+resource_meter = Table(
+    'resource_meter', meta,
+    Column('id', Integer, primary_key=True),
+    Column('resource_id', String(255), index=True),
+    Column('counter_name', String(255)),
+    Column('counter_type', String(255)),
+    Column('counter_unit', String(255)),
+    mysql_engine='InnoDB',
+    mysql_charset='utf8',
+)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    resource_meter.create()
+    migrate_engine.execute(
+        'INSERT INTO resource_meter '
+        '(resource_id, counter_name, counter_type, counter_unit) '
+        'SELECT DISTINCT resource_id, counter_name, counter_type, '
+        'counter_unit FROM meter')
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    resource_meter.drop()
@@ -0,0 +1,41 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from sqlalchemy import *
+
+meta = MetaData()
+
+meter_partition = Table(
+    'meter_partition', meta,
+    Column('id', String(255), primary_key=True),
+    Column('period_start', DateTime, index=True),
+    Column('period_end', DateTime, index=True),
+    mysql_engine='InnoDB',
+    mysql_charset='utf8',
+)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    meter_partition.create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    # The samples of the partitions are lost
+    for name, in migrate_engine.execute(select([meter_partition.c.id])):
+        Table(name, meta, autoload=True).drop()
+    meter_partition.drop()
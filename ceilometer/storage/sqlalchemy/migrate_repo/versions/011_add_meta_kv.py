@@ -0,0 +1,176 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import importlib
+import json
+
+from sqlalchemy import *
+
+meter_indexes = importlib.import_module(
+    'ceilometer.storage.sqlalchemy.migrate_repo.versions.'
+    '007_add_meter_indexes')
+
+meta = MetaData()
+
+meta_kv = Table(
+    'meta_kv', meta,
+    Column('metadata_hash', String(32), primary_key=True),
+    Column('meta_key', String(200), primary_key=True),
+    Column('value_text', String(255)),
+    Column('value_int', BigInteger),
+    Column('value_float', Float(53)),
+    Column('value_bool', Boolean),
+    mysql_engine='InnoDB',
+    mysql_charset='utf8',
+)
+
+META_INDEXES = [
+    ('ix_meta_kv_meta_key_value_text', ('meta_key', 'value_text')),
+    ('ix_meta_kv_meta_key_value_int', ('meta_key', 'value_int')),
+    ('ix_meta_kv_meta_key_value_float', ('meta_key', 'value_float')),
+    ('ix_meta_kv_meta_key_value_bool', ('meta_key', 'value_bool')),
+]
+
+# Number of rows whose metadata are recorded at once
+CHUNK_SIZE = 1000
+
+META_KEY_LENGTH = 200
+META_TEXT_LENGTH = 255
+
+
+def get_tables(migrate_engine):
+    """Return the tables of the samples, the partitions included, and the
+    resource table.
+    """
+    # Reflected again on each run, the tables are altered
+    tables = MetaData(bind=migrate_engine)
+    partition = Table('meter_partition', tables, autoload=True)
+    names = ['meter'] + [name for name, in migrate_engine.execute(
+        select([partition.c.id]))]
+    return ([Table(name, tables, autoload=True) for name in names],
+            Table('resource', tables, autoload=True))
+
+
+def flatten(metadata, prefix=''):
+    """Yield the (key, value) pairs of the metadata, the keys of the nested
+    dictionaries being joined by dots.
+    """
+    for key, value in sorted(metadata.iteritems()):
+        if isinstance(value, dict):
+            for pair in flatten(value, '%s%s.' % (prefix, key)):
+                yield pair
+        else:
+            yield '%s%s' % (prefix, key), value
+
+
+def value_column(value):
+    """Return the meta_kv column of a value, None if not recorded."""
+    if isinstance(value, bool):
+        return 'value_bool'
+    if isinstance(value, (int, long)):
+        if -2 ** 63 <= value < 2 ** 63:
+            return 'value_int'
+    elif isinstance(value, float):
+        return 'value_float'
+    elif isinstance(value, basestring):
+        if len(value) <= META_TEXT_LENGTH:
+            return 'value_text'
+    return None
+
+
+def meta_kv_rows(metadata):
+    """Return the digest of the metadata and their meta_kv rows."""
+    if not metadata:
+        return None, []
+    digest = hashlib.md5(json.dumps(metadata, sort_keys=True)).hexdigest()
+    rows = []
+    for key, value in flatten(metadata):
+        column = value_column(value)
+        if column is not None and len(key) <= META_KEY_LENGTH:
+            row = {'metadata_hash': digest,
+                   'meta_key': key,
+                   'value_text': None,
+                   'value_int': None,
+                   'value_float': None,
+                   'value_bool': None}
+            row[column] = value
+            rows.append(row)
+    return digest, rows
+
+
+def record_metadata(migrate_engine, table, digests):
+    """Set the metadata digests of the rows of a table and record their
+    metadata, unless already in digests.
+    """
+    last = None
+    while True:
+        query = select([table.c.id, table.c.resource_metadata]).order_by(
+            table.c.id).limit(CHUNK_SIZE)
+        if last is not None:
+            query = query.where(table.c.id > last)
+        rows = migrate_engine.execute(query).fetchall()
+        if not rows:
+            return
+        last = rows[-1].id
+        updates = []
+        meta_rows = []
+        for row in rows:
+            metadata = (json.loads(row.resource_metadata)
+                        if row.resource_metadata else None)
+            digest, kv_rows = meta_kv_rows(metadata)
+            if digest is None:
+                continue
+            updates.append({'row_id': row.id, 'digest': digest})
+            if digest not in digests:
+                digests.add(digest)
+                meta_rows.extend(kv_rows)
+        if updates:
+            migrate_engine.execute(
+                table.update().where(table.c.id == bindparam('row_id')).values(
+                    metadata_hash=bindparam('digest')),
+                updates)
+        if meta_rows:
+            migrate_engine.execute(meta_kv.insert(), meta_rows)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    meta_kv.create()
+    # Not attached to meta_kv, which would create them with the table
+    table = Table('meta_kv', MetaData(bind=migrate_engine), autoload=True)
+    for name, columns in META_INDEXES:
+        meter_indexes.create_index(migrate_engine, table, name, columns)
+
+    meters, resource = get_tables(migrate_engine)
+    digests = set()
+    for table in meters + [resource]:
+        table.create_column(Column('metadata_hash', String(32)))
+        if table is not resource:
+            Index('ix_%s_metadata_hash' % table.name,
+                  table.c.metadata_hash).create()
+        record_metadata(migrate_engine, table, digests)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    meters, resource = get_tables(migrate_engine)
+    for table in meters:
+        Index('ix_%s_metadata_hash' % table.name,
+              table.c.metadata_hash).drop()
+    for table in meters + [resource]:
+        table.drop_column('metadata_hash')
+    meta_kv.drop()
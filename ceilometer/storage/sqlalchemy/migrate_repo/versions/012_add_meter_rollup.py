@@ -0,0 +1,158 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import importlib
+
+from sqlalchemy import *
+
+meter_indexes = importlib.import_module(
+    'ceilometer.storage.sqlalchemy.migrate_repo.versions.'
+    '007_add_meter_indexes')
+
+meta = MetaData()
+
+meter_rollup = Table(
+    'meter_rollup', meta,
+    Column('id', Integer, primary_key=True),
+    Column('granularity', Integer),
+    Column('period_start', DateTime),
+    Column('counter_name', String(255)),
+    Column('resource_id', String(255)),
+    Column('user_id', String(255)),
+    Column('project_id', String(255)),
+    Column('source_id', String(255)),
+    Column('sample_count', Integer),
+    Column('volume_sum', Float(53)),
+    Column('volume_min', Float(53)),
+    Column('volume_max', Float(53)),
+    Column('first_timestamp', DateTime),
+    Column('last_timestamp', DateTime),
+    Column('compacted', Boolean, index=True),
+    mysql_engine='InnoDB',
+    mysql_charset='utf8',
+)
+
+ROLLUP_INDEXES = [
+    ('ix_meter_rollup_counter_name_granularity_period_start',
+     ('counter_name', 'granularity', 'period_start')),
+]
+
+# Number of samples read, and of rollups written, at once
+CHUNK_SIZE = 1000
+
+# Duration of the rollup periods in seconds, a day and an hour
+GRANULARITIES = (86400, 3600)
+
+KEY = ('granularity', 'period_start', 'counter_name', 'resource_id',
+       'user_id', 'project_id', 'source_id')
+
+
+def get_meter_tables(migrate_engine):
+    """Return the tables of the samples, the partitions included."""
+    tables = MetaData(bind=migrate_engine)
+    partition = Table('meter_partition', tables, autoload=True)
+    names = ['meter'] + [name for name, in migrate_engine.execute(
+        select([partition.c.id]))]
+    return [Table(name, tables, autoload=True) for name in names]
+
+
+def period_start(timestamp, granularity):
+    if granularity == 86400:
+        return datetime.datetime(timestamp.year, timestamp.month,
+                                 timestamp.day)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def chunk_rollups(rows):
+    """Return the rollups of a chunk of samples, by key."""
+    rollups = {}
+    for row in rows:
+        volume = row.counter_volume
+        if volume is None:
+            continue
+        for granularity in GRANULARITIES:
+            rollup = {'granularity': granularity,
+                      'period_start': period_start(row.timestamp,
+                                                   granularity),
+                      'counter_name': row.counter_name,
+                      'resource_id': row.resource_id,
+                      'user_id': row.user_id,
+                      'project_id': row.project_id,
+                      'source_id': row.source_id}
+            key = tuple(rollup[c] for c in KEY)
+            current = rollups.get(key)
+            if current is None:
+                rollup.update(sample_count=1,
+                              volume_sum=volume,
+                              volume_min=volume,
+                              volume_max=volume,
+                              first_timestamp=row.timestamp,
+                              last_timestamp=row.timestamp,
+                              compacted=False)
+                rollups[key] = rollup
+                continue
+            current['sample_count'] += 1
+            current['volume_sum'] += volume
+            current['volume_min'] = min(current['volume_min'], volume)
+            current['volume_max'] = max(current['volume_max'], volume)
+            current['first_timestamp'] = min(current['first_timestamp'],
+                                             row.timestamp)
+            current['last_timestamp'] = max(current['last_timestamp'],
+                                            row.timestamp)
+    return rollups.values()
+
+
+def add_rollups(migrate_engine, table):
+    """Write the rollups of the samples of a table, one chunk at a time.
+
+    The rows of the same period written by several chunks are left to be
+    merged by the rollup compactor.
+    """
+    last = None
+    while True:
+        query = select([table.c.id, table.c.counter_name,
+                        table.c.resource_id, table.c.user_id,
+                        table.c.project_id, table.c.source_id,
+                        table.c.counter_volume, table.c.timestamp])
+        query = query.order_by(table.c.id).limit(CHUNK_SIZE)
+        if last is not None:
+            query = query.where(table.c.id > last)
+        rows = migrate_engine.execute(query).fetchall()
+        if not rows:
+            return
+        last = rows[-1].id
+        rollups = chunk_rollups(rows)
+        if rollups:
+            migrate_engine.execute(meter_rollup.insert(), rollups)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    meter_rollup.create()
+    # Not attached to meter_rollup, which would create them with the table
+    table = Table('meter_rollup', MetaData(bind=migrate_engine),
+                  autoload=True)
+    for name, columns in ROLLUP_INDEXES:
+        meter_indexes.create_index(migrate_engine, table, name, columns)
+
+    for table in get_meter_tables(migrate_engine):
+        add_rollups(migrate_engine, table)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    meter_rollup.drop()
@@ -18,17 +18,21 @@
 SQLAlchemy models for Ceilometer data.
 """
 
+import datetime
+import hashlib
 import json
 import urlparse
 
 from oslo.config import cfg
 from sqlalchemy import Column, Integer, String, Table, ForeignKey, DateTime, \
-    Float
+    Float, BigInteger, Boolean
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from sqlalchemy.types import TypeDecorator, VARCHAR
 
+from ceilometer.openstack.common import jsonutils
 from ceilometer.openstack.common import timeutils
+from ceilometer import utils
 
 sql_opts = [
     cfg.StrOpt('mysql_engine',
@@ -63,6 +67,26 @@ class JSONEncodedDict(TypeDecorator):
         return value
 
 
+class LazyJSON(object):
+    """Attribute of a model set to a json-encoded string, decoded on first
+    access.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.name]
+        if isinstance(value, basestring):
+            value = obj.__dict__[self.name] = json.loads(value)
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
 class CeilometerBase(object):
     """Base class for Ceilometer Models."""
     __table_args__ = table_args()
@@ -78,6 +102,7 @@ class CeilometerBase(object):
 Base = declarative_base(cls=CeilometerBase)
 
 
+# The meters have their own source_id, meter_id is no longer set
 sourceassoc = Table('sourceassoc', Base.metadata,
                     Column('meter_id', Integer,
                            ForeignKey("meter.id")),
@@ -102,11 +127,13 @@ class Meter(Base):
     __tablename__ = 'meter'
     id = Column(Integer, primary_key=True)
     counter_name = Column(String(255))
-    sources = relationship("Source", secondary=lambda: sourceassoc)
+    source_id = Column(String(255), ForeignKey('source.id'))
     user_id = Column(String(255), ForeignKey('user.id'))
     project_id = Column(String(255), ForeignKey('project.id'))
     resource_id = Column(String(255), ForeignKey('resource.id'))
-    resource_metadata = Column(JSONEncodedDict)
+    # Only loaded when accessed, most queries don't need the metadata
+    resource_metadata = deferred(Column(JSONEncodedDict))
+    metadata_hash = Column(String(32), index=True)
     counter_type = Column(String(255))
     counter_unit = Column(String(255))
     counter_volume = Column(Float(53))
@@ -135,7 +162,177 @@ class Resource(Base):
     __tablename__ = 'resource'
     id = Column(String(255), primary_key=True)
     sources = relationship("Source", secondary=lambda: sourceassoc)
-    resource_metadata = Column(JSONEncodedDict)
+    resource_metadata = deferred(Column(JSONEncodedDict))
+    metadata_hash = Column(String(32))
     user_id = Column(String(255), ForeignKey('user.id'))
     project_id = Column(String(255), ForeignKey('project.id'))
     meters = relationship("Meter", backref='resource')
+
+
+class ResourceMeter(Base):
+    """Meters recorded for a resource, maintained when samples are written
+    so that resources and meters are listed without reading the samples.
+    """
+
+    __tablename__ = 'resource_meter'
+    id = Column(Integer, primary_key=True)
+    resource_id = Column(String(255), ForeignKey('resource.id'), index=True)
+    counter_name = Column(String(255))
+    counter_type = Column(String(255))
+    counter_unit = Column(String(255))
+
+
+class MeterPartition(Base):
+    """Tables holding the samples of a period, when the samples are
+    partitioned by time.
+    """
+
+    __tablename__ = 'meter_partition'
+    id = Column(String(255), primary_key=True)
+    period_start = Column(DateTime, index=True)
+    period_end = Column(DateTime, index=True)
+
+
+# Longest metadata keys and text values recorded in meta_kv
+META_KEY_LENGTH = 200
+META_TEXT_LENGTH = 255
+
+META_VALUE_COLUMNS = ('value_text', 'value_int', 'value_float', 'value_bool')
+
+
+class MetaKV(Base):
+    """Flattened keys and values of the metadata of the samples and
+    resources, by digest of the metadata.
+    """
+
+    __tablename__ = 'meta_kv'
+    metadata_hash = Column(String(32), primary_key=True)
+    meta_key = Column(String(META_KEY_LENGTH), primary_key=True)
+    value_text = Column(String(META_TEXT_LENGTH))
+    value_int = Column(BigInteger)
+    value_float = Column(Float(53))
+    value_bool = Column(Boolean)
+
+
+def meta_value_column(value):
+    """Return the name of the meta_kv column recording a metadata value,
+    None if it is not recorded.
+    """
+    if isinstance(value, bool):
+        return 'value_bool'
+    if isinstance(value, (int, long)):
+        if -2 ** 63 <= value < 2 ** 63:
+            return 'value_int'
+    elif isinstance(value, float):
+        return 'value_float'
+    elif isinstance(value, basestring):
+        if len(value) <= META_TEXT_LENGTH:
+            return 'value_text'
+    return None
+
+
+def meta_kv_rows(metadata):
+    """Return the digest of a metadata dictionary and the values of its
+    meta_kv rows, one per flattened key of a recorded value.
+    """
+    if not metadata:
+        return None, []
+    digest = hashlib.md5(jsonutils.dumps(metadata,
+                                         sort_keys=True)).hexdigest()
+    rows = []
+    for key, value in utils.recursive_keypairs(metadata):
+        column = meta_value_column(value)
+        if column is not None and len(key) <= META_KEY_LENGTH:
+            row = dict.fromkeys(META_VALUE_COLUMNS)
+            row.update({'metadata_hash': digest,
+                        'meta_key': key,
+                        column: value})
+            rows.append(row)
+    return digest, rows
+
+
+# Durations of the periods of the rollups, in seconds
+ROLLUP_GRANULARITIES = (86400, 3600)
+
+ROLLUP_KEY = ('granularity', 'period_start', 'counter_name', 'resource_id',
+              'user_id', 'project_id', 'source_id')
+
+
+class MeterRollup(Base):
+    """Statistics of the samples of a meter of a resource over an hour or
+    a day, maintained when samples are written.
+
+    Several rows may hold the statistics of the same period until they are
+    merged, the queries aggregate them.
+    """
+
+    __tablename__ = 'meter_rollup'
+    id = Column(Integer, primary_key=True)
+    granularity = Column(Integer)
+    period_start = Column(DateTime)
+    counter_name = Column(String(255))
+    resource_id = Column(String(255))
+    user_id = Column(String(255))
+    project_id = Column(String(255))
+    source_id = Column(String(255))
+    sample_count = Column(Integer)
+    volume_sum = Column(Float(53))
+    volume_min = Column(Float(53))
+    volume_max = Column(Float(53))
+    first_timestamp = Column(DateTime)
+    last_timestamp = Column(DateTime)
+    # Whether the row is the only one of its period and key
+    compacted = Column(Boolean, index=True)
+
+
+def rollup_period_start(timestamp, granularity):
+    """Return when the rollup period of a timestamp starts."""
+    if granularity == 86400:
+        return datetime.datetime(timestamp.year, timestamp.month,
+                                 timestamp.day)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def merge_rollup(rollups, rollup):
+    """Merge a rollup row into rollups, a dictionary of rollup rows by
+    key.
+    """
+    key = tuple(rollup[c] for c in ROLLUP_KEY)
+    current = rollups.get(key)
+    if current is None:
+        rollups[key] = dict((c, rollup[c]) for c in ROLLUP_KEY + (
+            'sample_count', 'volume_sum', 'volume_min', 'volume_max',
+            'first_timestamp', 'last_timestamp'))
+        return
+    current['sample_count'] += rollup['sample_count']
+    current['volume_sum'] += rollup['volume_sum']
+    current['volume_min'] = min(current['volume_min'], rollup['volume_min'])
+    current['volume_max'] = max(current['volume_max'], rollup['volume_max'])
+    current['first_timestamp'] = min(current['first_timestamp'],
+                                     rollup['first_timestamp'])
+    current['last_timestamp'] = max(current['last_timestamp'],
+                                    rollup['last_timestamp'])
+
+
+def sample_rollups(row):
+    """Return the rollup rows of a sample, given the values of its meter
+    row, none if it has no volume.
+    """
+    volume = row['counter_volume']
+    if volume is None:
+        return []
+    return [{'granularity': granularity,
+             'period_start': rollup_period_start(row['timestamp'],
+                                                 granularity),
+             'counter_name': row['counter_name'],
+             'resource_id': row['resource_id'],
+             'user_id': row['user_id'],
+             'project_id': row['project_id'],
+             'source_id': row['source_id'],
+             'sample_count': 1,
+             'volume_sum': volume,
+             'volume_min': volume,
+             'volume_max': volume,
+             'first_timestamp': row['timestamp'],
+             'last_timestamp': row['timestamp']}
+            for granularity in ROLLUP_GRANULARITIES]
@@ -21,7 +21,10 @@
 """Utilities and helper functions."""
 
 
+import bisect
+import hashlib
 import os
+import struct
 
 
 def read_cached_file(filename, cache_info, reload_func=None):
@@ -42,3 +45,44 @@ def read_cached_file(filename, cache_info, reload_func=None):
         if reload_func:
             reload_func(cache_info['data'])
     return cache_info['data']
+
+
+def recursive_keypairs(d, separator='.'):
+    """Yield the (name, value) pairs of a nested dictionary, the names of
+    the nested keys being joined by separator.
+    """
+    for name, value in sorted(d.iteritems()):
+        if isinstance(value, dict):
+            for subname, subvalue in recursive_keypairs(value, separator):
+                yield ('%s%s%s' % (name, separator, subname), subvalue)
+        else:
+            yield name, value
+
+
+def stable_hash(key):
+    """Return a hash of key which does not change between processes."""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return struct.unpack('>I', hashlib.md5(str(key)).digest()[:4])[0]
+
+
+class HashRing(object):
+    """Consistent hash ring distributing keys over nodes.
+
+    Each node is placed at `replicas` points of the ring, so that adding
+    or removing a node only moves the keys it gains or loses.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.nodes = frozenset(nodes)
+        self._ring = sorted((stable_hash('%s-%d' % (node, i)), node)
+                            for node in self.nodes
+                            for i in xrange(replicas))
+        self._hashes = [h for h, node in self._ring]
+
+    def get_node(self, key):
+        """Return the node of key, or None for an empty ring."""
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._hashes, stable_hash(key))
+        return self._ring[index % len(self._ring)][1]
@@ -82,7 +82,9 @@ setuptools.setup(
              'bin/ceilometer-agent-central',
              'bin/ceilometer-api',
              'bin/ceilometer-collector',
-             'bin/ceilometer-dbsync'],
+             'bin/ceilometer-dbsync',
+             'bin/ceilometer-expirer',
+             'bin/ceilometer-rollup-compactor'],
 
     py_modules=[],
 
@@ -141,6 +143,8 @@ setuptools.setup(
 
     [ceilometer.publisher]
     meter_publisher = ceilometer.publisher.meter_publish:MeterPublisher
+    udp = ceilometer.publisher.udp:UDPPublisher
+    spool = ceilometer.publisher.spool:SpoolPublisher
 
     [paste.filter_factory]
     swift=ceilometer.objectstore.swift_middleware:filter_factory
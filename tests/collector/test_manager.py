@@ -18,8 +18,11 @@
 """Tests for ceilometer/agent/manager.py
 """
 
+import copy
 from datetime import datetime
+import socket
 
+import eventlet
 from mock import patch
 from mock import MagicMock
 from oslo.config import cfg
@@ -27,7 +30,12 @@ from stevedore import extension
 from stevedore.tests import manager as test_manager
 
 from ceilometer.collector import meter
+from ceilometer.collector import pool
+from ceilometer import counter
 from ceilometer.collector import service
+from ceilometer.openstack.common import jsonutils
+from ceilometer.openstack.common.rpc import dispatcher as rpc_dispatcher
+from ceilometer.publisher import udp
 from ceilometer.storage import base
 from ceilometer.tests import base as tests_base
 from ceilometer.compute import notifications
@@ -100,6 +108,22 @@ class TestCollectorService(tests_base.TestCase):
         with patch('ceilometer.openstack.common.rpc.create_connection'):
             self.srv.start()
 
+    @patch('ceilometer.pipeline.setup_pipeline', MagicMock())
+    def test_compact_rollups_timer(self):
+        cfg.CONF.database_connection = 'log://localhost'
+        with patch('ceilometer.openstack.common.rpc.create_connection'):
+            with patch.object(self.srv.tg, 'add_timer') as add_timer:
+                self.srv.start()
+        interval = cfg.CONF.rollup_compaction_interval
+        add_timer.assert_any_call(interval, self.srv.compact_rollups,
+                                  initial_delay=interval)
+
+    def test_compact_rollups_error(self):
+        self.srv.storage_conn = MagicMock()
+        self.srv.storage_conn.compact_rollups.side_effect = Exception()
+        self.srv.compact_rollups()
+        self.srv.storage_conn.compact_rollups.assert_called_once_with()
+
     def test_valid_message(self):
         msg = {'counter_name': 'test',
                'resource_id': self.id(),
@@ -111,7 +135,7 @@ class TestCollectorService(tests_base.TestCase):
         )
 
         self.srv.storage_conn = self.mox.CreateMock(base.Connection)
-        self.srv.storage_conn.record_metering_data(msg)
+        self.srv.storage_conn.record_metering_batch([msg])
         self.mox.ReplayAll()
 
         self.srv.record_metering_data(self.ctx, msg)
@@ -131,6 +155,9 @@ class TestCollectorService(tests_base.TestCase):
             def record_metering_data(self, data):
                 self.called = True
 
+            def record_metering_batch(self, data):
+                self.called = True
+
         self.srv.storage_conn = ErrorConnection()
 
         self.srv.record_metering_data(self.ctx, msg)
@@ -154,7 +181,7 @@ class TestCollectorService(tests_base.TestCase):
         expected['timestamp'] = datetime(2012, 7, 2, 13, 53, 40)
 
         self.srv.storage_conn = self.mox.CreateMock(base.Connection)
-        self.srv.storage_conn.record_metering_data(expected)
+        self.srv.storage_conn.record_metering_batch([expected])
         self.mox.ReplayAll()
 
         self.srv.record_metering_data(self.ctx, msg)
@@ -176,7 +203,7 @@ class TestCollectorService(tests_base.TestCase):
         expected['timestamp'] = datetime(2012, 9, 30, 23, 31, 50, 262000)
 
         self.srv.storage_conn = self.mox.CreateMock(base.Connection)
-        self.srv.storage_conn.record_metering_data(expected)
+        self.srv.storage_conn.record_metering_batch([expected])
         self.mox.ReplayAll()
 
         self.srv.record_metering_data(self.ctx, msg)
@@ -197,6 +224,361 @@ class TestCollectorService(tests_base.TestCase):
                                  notifications.Instance(),
                                  ),
              ])
+        self.srv._build_event_type_index()
         self.srv.process_notification(TEST_NOTICE)
+        self.srv.notification_pool.waitall()
         self.assertTrue(
             self.srv.pipeline_manager.publisher.called)
+
+    def _setup_handlers(self, handlers):
+        self.srv.pipeline_manager = MagicMock()
+        self.srv.notification_manager = test_manager.TestExtensionManager(
+            [extension.Extension(name, None, None, handler)
+             for name, handler in handlers])
+        self.srv._build_event_type_index()
+
+    def test_process_notification_single_publish_context(self):
+        self._setup_handlers([('instance', notifications.Instance()),
+                              ('memory', notifications.Memory()),
+                              ('vcpus', notifications.VCpus())])
+        self.srv.process_notification(TEST_NOTICE)
+        self.srv.notification_pool.waitall()
+        self.assertEqual(self.srv.pipeline_manager.publisher.call_count, 1)
+        publish = self.srv.pipeline_manager.publisher.return_value.\
+            __enter__.return_value
+        self.assertEqual(publish.call_count, 1)
+        counters = publish.call_args[0][0]
+        self.assertEqual(set(c.name for c in counters),
+                         set(['instance', 'memory', 'vcpus']))
+
+    def test_process_notification_wildcard(self):
+        handler = MagicMock()
+        handler.get_event_types.return_value = ['compute.instance.*']
+        handler.process_notification.return_value = [MagicMock()]
+        other = MagicMock()
+        other.get_event_types.return_value = ['image.send']
+        self._setup_handlers([('wild', handler), ('other', other)])
+        self.srv.process_notification(TEST_NOTICE)
+        handler.process_notification.assert_called_once_with(TEST_NOTICE)
+        self.assertFalse(other.process_notification.called)
+        self.assertIs(
+            self.srv._handlers_for_event_type('compute.instance.exists'),
+            self.srv._handlers_for_event_type('compute.instance.exists'))
+
+    def test_process_notification_unhandled_event_type(self):
+        self._setup_handlers([('instance', notifications.Instance())])
+        notice = dict(TEST_NOTICE, event_type='identity.user.created')
+        self.srv.process_notification(notice)
+        self.srv.notification_pool.waitall()
+        self.assertFalse(self.srv.pipeline_manager.publisher.called)
+        self.assertNotIn('identity.user.created',
+                         self.srv._event_type_index)
+        self.assertEqual(len(self.srv._wildcard_index), 0)
+
+    def test_wildcard_event_types_bounded(self):
+        handler = MagicMock()
+        handler.get_event_types.return_value = ['compute.instance.*']
+        self._setup_handlers([('wild', handler)])
+        size = service.EVENT_TYPE_CACHE_SIZE
+        for i in range(size * 2):
+            self.assertEqual(
+                len(self.srv._handlers_for_event_type(
+                    'compute.instance.%d' % i)), 1)
+        self.assertTrue(len(self.srv._wildcard_index) <= size)
+
+    def test_process_notification_handler_error(self):
+        failing = MagicMock()
+        failing.get_event_types.return_value = [TEST_NOTICE['event_type']]
+        failing.process_notification.side_effect = Exception('boom')
+        self._setup_handlers([('failing', failing),
+                              ('instance', notifications.Instance())])
+        self.srv.process_notification(TEST_NOTICE)
+        self.srv.notification_pool.waitall()
+        publish = self.srv.pipeline_manager.publisher.return_value.\
+            __enter__.return_value
+        self.assertEqual([c.name for c in publish.call_args[0][0]],
+                         ['instance'])
+
+    def test_process_notification_ordered_per_resource(self):
+        published = []
+
+        def publish(counters):
+            # Yield to let the other resources be processed meanwhile
+            eventlet.sleep(0)
+            published.extend(c.volume for c in counters)
+
+        handler = MagicMock()
+        handler.get_event_types.return_value = [TEST_NOTICE['event_type']]
+        handler.process_notification.side_effect = lambda n: [
+            counter.Counter(name='test', type=counter.TYPE_GAUGE,
+                            unit='', volume=n['payload']['seq'],
+                            user_id=None, project_id=None,
+                            resource_id=n['payload']['seq'] % 2,
+                            timestamp=None, resource_metadata={})]
+        self._setup_handlers([('test', handler)])
+        self.srv._publish_counters = publish
+        for seq in range(10):
+            notice = copy.deepcopy(TEST_NOTICE)
+            notice['payload']['seq'] = seq
+            self.srv.process_notification(notice)
+        self.srv.notification_pool.waitall()
+        self.assertEqual([s for s in published if s % 2], range(1, 10, 2))
+        self.assertEqual([s for s in published if not s % 2], range(0, 10, 2))
+
+    def test_record_metering_data_stats(self):
+        msg = {'counter_name': 'test',
+               'resource_id': self.id(),
+               'counter_volume': 1,
+               'timestamp': '2012-07-02T13:53:40Z',
+               }
+        msg['message_signature'] = meter.compute_signature(
+            msg,
+            cfg.CONF.metering_secret,
+        )
+        self.srv.storage_conn = MagicMock()
+        self.srv.record_metering_data(self.ctx, [msg, dict(msg)])
+        for stage in ('verify', 'normalize'):
+            self.assertEqual(self.srv.write_stats.histograms[stage].count, 2)
+        for stage in ('decode', 'store'):
+            self.assertEqual(self.srv.write_stats.histograms[stage].count, 1)
+        self.srv.storage_conn.record_metering_batch.assert_called_once_with(
+            [msg, msg])
+
+    def test_record_metering_data_batch_failure(self):
+        msgs = []
+        for i in range(3):
+            msg = {'counter_name': 'test',
+                   'resource_id': self.id(),
+                   'counter_volume': i,
+                   }
+            msg['message_signature'] = meter.compute_signature(
+                msg,
+                cfg.CONF.metering_secret,
+            )
+            msgs.append(msg)
+        self.srv.storage_conn = MagicMock()
+        self.srv.storage_conn.record_metering_batch.side_effect = \
+            Exception('boom')
+        self.srv.storage_conn.record_metering_data.side_effect = \
+            [None, Exception('boom'), None]
+        self.srv.record_metering_data(self.ctx, msgs)
+        self.assertEqual(
+            [c[0][0] for c in
+             self.srv.storage_conn.record_metering_data.call_args_list],
+            msgs)
+
+    def test_periodic_tasks_self_metering(self):
+        self.srv.pipeline_manager = MagicMock()
+        self.srv.storage_conn = MagicMock()
+        self.srv.storage_conn.get_cache_stats.return_value = {
+            'resources': {'hits': 3, 'misses': 1},
+            'associations': {'hits': 0, 'misses': 0},
+        }
+        self.srv.write_stats.histograms['store'].add(3)
+        cfg.CONF.set_override('collector_self_metering', True)
+        try:
+            self.srv.periodic_tasks(self.ctx)
+        finally:
+            cfg.CONF.clear_override('collector_self_metering')
+        publish = self.srv.pipeline_manager.publisher.return_value.\
+            __enter__.return_value
+        counters = publish.call_args[0][0]
+        self.assertEqual([c.name for c in counters],
+                         ['collector.write.store',
+                          'collector.cache.resources'])
+        self.assertEqual(counters[0].volume, 3)
+        self.assertEqual(counters[1].volume, 75)
+        self.assertEqual(counters[1].resource_metadata,
+                         {'hits': 3, 'misses': 1})
+        self.assertEqual(self.srv.write_stats.histograms['store'].count, 0)
+
+    def test_periodic_tasks_no_self_metering(self):
+        self.srv.pipeline_manager = MagicMock()
+        self.srv.storage_conn = MagicMock()
+        self.srv.storage_conn.get_cache_stats.return_value = {}
+        self.srv.write_stats.histograms['store'].add(3)
+        self.srv.periodic_tasks(self.ctx)
+        self.assertFalse(self.srv.pipeline_manager.publisher.called)
+
+    def test_record_metering_data_columnar(self):
+        msg = {'counter_name': 'test',
+               'resource_id': self.id(),
+               'counter_volume': 1,
+               'resource_metadata': {'key': 'value'},
+               }
+        msg['message_signature'] = meter.compute_signature(
+            msg,
+            cfg.CONF.metering_secret,
+        )
+        self.srv.storage_conn = self.mox.CreateMock(base.Connection)
+        self.srv.storage_conn.record_metering_batch([msg, msg])
+        self.mox.ReplayAll()
+
+        self.srv.record_metering_data(self.ctx,
+                                      meter.encode_meters([msg, msg]),
+                                      encoding='columnar')
+        self.mox.VerifyAll()
+
+    def test_record_metering_data_unknown_encoding(self):
+        self.srv.storage_conn = MagicMock()
+        self.srv.record_metering_data(self.ctx, 'garbage',
+                                      encoding='unknown')
+        self.assertFalse(self.srv.storage_conn.record_metering_batch.called)
+
+    def test_record_metering_data_compressed(self):
+        msg = {'counter_name': 'test',
+               'resource_id': self.id(),
+               'counter_volume': 1,
+               'resource_metadata': {'key': 'value'},
+               }
+        msg['message_signature'] = meter.compute_signature(
+            msg,
+            cfg.CONF.metering_secret,
+        )
+        self.srv.storage_conn = self.mox.CreateMock(base.Connection)
+        self.srv.storage_conn.record_metering_batch([msg, msg])
+        self.mox.ReplayAll()
+
+        self.srv.record_metering_data(
+            self.ctx,
+            meter.compress_data(meter.encode_meters([msg, msg]), 'zlib'),
+            encoding='columnar',
+            compression='zlib')
+        self.mox.VerifyAll()
+
+    def test_record_metering_data_corrupted_compression(self):
+        self.srv.storage_conn = MagicMock()
+        self.srv.record_metering_data(self.ctx, 'garbage',
+                                      compression='zlib')
+        self.srv.record_metering_data(self.ctx, [],
+                                      compression='unknown')
+        self.assertFalse(self.srv.storage_conn.record_metering_batch.called)
+
+    def test_record_metering_data_dispatch_version(self):
+        self.srv.storage_conn = MagicMock()
+        dispatcher = rpc_dispatcher.RpcDispatcher([self.srv])
+        dispatcher.dispatch(self.ctx, '1.1', 'record_metering_data',
+                            data=meter.encode_meters([]),
+                            encoding='columnar')
+        dispatcher.dispatch(self.ctx, '1.0', 'record_metering_data',
+                            data=[])
+        dispatcher.dispatch(self.ctx, '1.2', 'record_metering_data',
+                            data=meter.compress_data([], 'zlib'),
+                            compression='zlib')
+
+    def test_metering_topics(self):
+        self.assertEqual(self.srv._metering_topics(), ['metering'])
+        cfg.CONF.set_override('metering_partitions', 3)
+        try:
+            self.assertEqual(self.srv._metering_topics(),
+                             ['metering', 'metering.p0', 'metering.p1',
+                              'metering.p2'])
+            cfg.CONF.set_override('metering_consumed_partitions', ['2'])
+            self.srv.conn = MagicMock()
+            self.srv._setup_metering_workers()
+        finally:
+            cfg.CONF.clear_override('metering_partitions')
+            cfg.CONF.clear_override('metering_consumed_partitions')
+        self.assertEqual([c[0][0] for c in
+                          self.srv.conn.create_worker.call_args_list],
+                         ['metering', 'metering.p2'])
+
+    def test_priority_lanes(self):
+        cfg.CONF.set_override('metering_priorities', ['critical:4'])
+        cfg.CONF.set_override('metering_partitions', 2)
+        try:
+            srv = service.CollectorService('the-host', 'the-topic')
+            srv.conn = MagicMock()
+            srv._setup_metering_workers()
+        finally:
+            cfg.CONF.clear_override('metering_priorities')
+            cfg.CONF.clear_override('metering_partitions')
+        self.assertEqual(srv.metering_pool.weights,
+                         {'critical': 4, 'default': 1})
+        self.assertEqual([c[0][0] for c in
+                          srv.conn.create_worker.call_args_list],
+                         ['metering-critical', 'metering-critical.p0',
+                          'metering-critical.p1', 'metering',
+                          'metering.p0', 'metering.p1'])
+        endpoint = srv.conn.create_worker.call_args_list[0][0][1].callbacks[0]
+        self.assertEqual(endpoint.priority, 'critical')
+
+    def test_priority_lane_records(self):
+        msg = {'counter_name': 'test',
+               'resource_id': self.id(),
+               'counter_volume': 1,
+               }
+        msg['message_signature'] = meter.compute_signature(
+            msg,
+            cfg.CONF.metering_secret,
+        )
+        self.srv.storage_conn = MagicMock()
+        self.srv.metering_pool = pool.WeightedFairPool(
+            {'critical': 4, 'default': 1}, 2, 10)
+        lane = service.MeteringLane(self.srv, 'critical')
+        dispatcher = rpc_dispatcher.RpcDispatcher([lane])
+        dispatcher.dispatch(self.ctx, '1.2', 'record_metering_data',
+                            data=[msg])
+        self.srv.metering_pool.waitall()
+        self.srv.storage_conn.record_metering_batch.assert_called_once_with(
+            [msg])
+        self.assertEqual(self.srv.metering_pool.done['critical'], 1)
+
+    def test_udp_loopback(self):
+        self.srv.udp_socket = socket.socket(socket.AF_INET,
+                                            socket.SOCK_DGRAM)
+        self.srv.udp_socket.bind(('127.0.0.1', 0))
+        self.srv.udp_socket.settimeout(5)
+        self.srv.storage_conn = MagicMock()
+        cfg.CONF.set_override('udp_collectors', [
+            '127.0.0.1:%d' % self.srv.udp_socket.getsockname()[1]])
+        try:
+            udp.UDPPublisher().publish_counters(None, [
+                counter.Counter(name='test', type=counter.TYPE_GAUGE,
+                                unit='', volume=1, user_id=None,
+                                project_id=None, resource_id=self.id(),
+                                timestamp='2012-07-02T13:53:40Z',
+                                resource_metadata={})], 'test')
+            self.srv.receive_udp()
+        finally:
+            cfg.CONF.clear_override('udp_collectors')
+            self.srv.udp_socket.close()
+        recorded, = \
+            self.srv.storage_conn.record_metering_batch.call_args[0][0]
+        self.assertEqual(recorded['resource_id'], self.id())
+        self.assertEqual(recorded['timestamp'],
+                         datetime(2012, 7, 2, 13, 53, 40))
+
+    def test_udp_invalid_datagram(self):
+        self.srv.udp_socket = socket.socket(socket.AF_INET,
+                                            socket.SOCK_DGRAM)
+        self.srv.udp_socket.bind(('127.0.0.1', 0))
+        self.srv.udp_socket.settimeout(5)
+        self.srv.storage_conn = MagicMock()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sender.sendto('garbage', self.srv.udp_socket.getsockname())
+            self.srv.receive_udp()
+        finally:
+            sender.close()
+            self.srv.udp_socket.close()
+        self.assertFalse(self.srv.storage_conn.record_metering_batch.called)
+
+    def test_udp_malformed_datagrams(self):
+        self.srv.udp_socket = socket.socket(socket.AF_INET,
+                                            socket.SOCK_DGRAM)
+        self.srv.udp_socket.bind(('127.0.0.1', 0))
+        self.srv.udp_socket.settimeout(5)
+        self.srv.storage_conn = MagicMock()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for datagram in ({'encoding': 'columnar', 'data': {'count': 1}},
+                             {'data': [1, 'garbage']},
+                             {'data': {'counter_name': 'test'}}):
+                sender.sendto(jsonutils.dumps(datagram),
+                              self.srv.udp_socket.getsockname())
+                self.srv.receive_udp()
+        finally:
+            sender.close()
+            self.srv.udp_socket.close()
+        self.assertFalse(self.srv.storage_conn.record_metering_batch.called)
@@ -182,3 +182,124 @@ def test_meter_message_from_counter_field():
     for f in TEST_COUNTER._fields:
         msg_f = name_map.get(f, f)
         yield compare, f, getattr(TEST_COUNTER, f), msg_f, msg[msg_f]
+
+
+def _make_meters():
+    meters = []
+    for i in range(6):
+        c = TEST_COUNTER._replace(
+            name='counter%d' % (i % 2),
+            volume=i,
+            resource_id='resource%d' % (i % 3),
+            resource_metadata={'index': i % 2, 'tags': ['a', 'b']},
+        )
+        meters.append(meter.meter_message_from_counter(c, 'not-so-secret',
+                                                       'src'))
+    return meters
+
+
+def test_encode_meters_string_table():
+    encoded = meter.encode_meters(_make_meters())
+    assert encoded['count'] == 6
+    assert sorted(encoded['strings']) == sorted(set(encoded['strings']))
+    assert len(encoded['metadata']) == 2
+    assert encoded['columns']['counter_volume'] == range(6)
+
+
+def test_encode_decode_meters():
+    meters = _make_meters()
+    wire = jsonutils.loads(jsonutils.dumps(meter.encode_meters(meters)))
+    decoded = meter.decode_meters(wire)
+    assert decoded == jsonutils.loads(jsonutils.dumps(meters))
+    for msg in decoded:
+        assert meter.verify_signature(msg, 'not-so-secret')
+
+
+def test_decode_meters_distinct_metadata():
+    decoded = meter.decode_meters(meter.encode_meters(_make_meters()))
+    assert decoded[0]['resource_metadata'] is not \
+        decoded[2]['resource_metadata']
+
+
+def test_encode_meters_empty():
+    assert meter.decode_meters(meter.encode_meters([])) == []
+
+
+def test_decode_meters_malformed():
+    payload = meter.encode_meters(_make_meters())
+    for malformed in ([],
+                      {'count': 1},
+                      dict(payload, count=7),
+                      dict(payload, metadata=['garbage']),
+                      dict(payload, strings=None),
+                      dict(payload, columns=dict(payload['columns'],
+                                                 counter_name=[99] * 6)),
+                      dict(payload, columns=dict(payload['columns'],
+                                                 resource_metadata=[-1] * 6)),
+                      ):
+        try:
+            meter.decode_meters(malformed)
+        except ValueError:
+            pass
+        else:
+            assert False, 'ValueError not raised for %r' % (malformed,)
+
+
+def test_encode_meters_different_fields():
+    meters = _make_meters()
+    del meters[1]['timestamp']
+    try:
+        meter.encode_meters(meters)
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError not raised'
+
+
+def test_compress_decompress_data():
+    meters = jsonutils.loads(jsonutils.dumps(_make_meters()))
+    compressed = meter.compress_data(meters, 'zlib')
+    assert len(compressed) < len(jsonutils.dumps(meters))
+    assert meter.decompress_data(compressed, 'zlib') == meters
+
+
+def test_compress_data_threshold():
+    assert meter.compress_data([1, 2], 'zlib', threshold=100) is None
+
+
+def test_compress_data_unknown():
+    try:
+        meter.compress_data([], 'lz4')
+    except ValueError:
+        pass
+    else:
+        assert False, 'ValueError not raised'
+
+
+def test_partition_topic():
+    topics = set(meter.partition_topic('metering', 'resource-%d' % i, 4)
+                 for i in range(100))
+    assert topics == set(['metering.p0', 'metering.p1',
+                          'metering.p2', 'metering.p3'])
+    assert meter.partition_topic('metering', u'resource', 4) == \
+        meter.partition_topic('metering', 'resource', 4)
+
+
+def test_get_priorities():
+    assert meter.get_priorities([]) == {'default': 1}
+    assert meter.get_priorities(['critical:4', 'default:2', 'low']) == \
+        {'critical': 4, 'default': 2, 'low': 1}
+    for values in (['critical:high'], ['critical:0']):
+        try:
+            meter.get_priorities(values)
+        except ValueError:
+            pass
+        else:
+            assert False, 'ValueError not raised'
+
+
+def test_priority_topic():
+    assert meter.priority_topic('metering', None) == 'metering'
+    assert meter.priority_topic('metering', 'default') == 'metering'
+    assert meter.priority_topic('metering', 'critical') == \
+        'metering-critical'
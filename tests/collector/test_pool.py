@@ -0,0 +1,142 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/collector/pool.py
+"""
+
+import eventlet
+from eventlet import event as eventlet_event
+
+from ceilometer.collector import pool
+from ceilometer.tests import base
+
+
+class TestOrderedGreenPool(base.TestCase):
+
+    def setUp(self):
+        super(TestOrderedGreenPool, self).setUp()
+        self.pool = pool.OrderedGreenPool(4, 8)
+        self.done = []
+
+    def _job(self, key, value):
+        eventlet.sleep(0)
+        self.done.append((key, value))
+
+    def test_ordering_per_key(self):
+        for i in range(20):
+            self.pool.submit(i % 3, self._job, i % 3, i)
+        self.pool.waitall()
+        self.assertEqual(len(self.done), 20)
+        for key in range(3):
+            self.assertEqual([v for k, v in self.done if k == key],
+                             range(key, 20, 3))
+
+    def test_keys_run_concurrently(self):
+        event = eventlet_event.Event()
+        self.pool.submit('a', event.wait)
+        self.pool.submit('b', self._job, 'b', 1)
+        self.pool.submit('b', event.send)
+        self.pool.waitall()
+        self.assertEqual(self.done, [('b', 1)])
+
+    def test_max_in_flight(self):
+        event = eventlet_event.Event()
+        self.pool.submit('a', event.wait)
+        for i in range(7):
+            self.pool.submit('a', self._job, 'a', i)
+        self.assertEqual(self.pool.running(), 8)
+        submitter = eventlet.spawn(self.pool.submit, 8, self._job, 8, 8)
+        eventlet.sleep(0)
+        self.assertEqual(self.pool.running(), 8)
+        event.send()
+        submitter.wait()
+        self.pool.waitall()
+        self.assertEqual(len(self.done), 8)
+        self.assertIn((8, 8), self.done)
+        self.assertEqual(self.pool.running(), 0)
+
+    def test_error_does_not_stop_key(self):
+        def fail():
+            raise Exception('boom')
+        self.pool.submit('a', fail)
+        self.pool.submit('a', self._job, 'a', 1)
+        self.pool.waitall()
+        self.assertEqual(self.done, [('a', 1)])
+        self.assertEqual(self.pool.running(), 0)
+
+
+class TestWeightedFairPool(base.TestCase):
+
+    def setUp(self):
+        super(TestWeightedFairPool, self).setUp()
+        self.pool = pool.WeightedFairPool({'critical': 3, 'default': 1},
+                                          1, 100)
+        self.done = []
+
+    def _job(self, lane, value):
+        self.done.append((lane, value))
+
+    def test_weights(self):
+        # The only worker starts once all the jobs are submitted
+        for i in range(8):
+            self.pool.submit('default', self._job, 'default', i)
+            self.pool.submit('critical', self._job, 'critical', i)
+        self.pool.waitall()
+        lanes = [lane for lane, value in self.done]
+        self.assertEqual(lanes[:8].count('critical'), 6)
+        for lane in ('critical', 'default'):
+            self.assertEqual([v for l, v in self.done if l == lane],
+                             range(8))
+        self.assertEqual(self.pool.done, {'critical': 8, 'default': 8})
+
+    def test_idle_lane_has_no_credit(self):
+        for i in range(9):
+            self.pool.submit('critical', self._job, 'critical', i)
+        self.pool.waitall()
+        for i in range(4):
+            self.pool.submit('default', self._job, 'default', i)
+            self.pool.submit('critical', self._job, 'critical', i)
+        self.pool.waitall()
+        lanes = [lane for lane, value in self.done[9:]]
+        self.assertEqual(lanes[:3], ['default', 'critical', 'critical'])
+
+    def test_max_in_flight_per_lane(self):
+        self.pool = pool.WeightedFairPool({'critical': 3, 'default': 1},
+                                          1, 2)
+        event = eventlet_event.Event()
+        self.pool.submit('default', event.wait)
+        self.pool.submit('default', self._job, 'default', 1)
+        submitter = eventlet.spawn(self.pool.submit, 'default',
+                                   self._job, 'default', 2)
+        eventlet.sleep(0)
+        self.assertEqual(self.pool.running('default'), 1)
+        # Other lanes are not blocked
+        self.pool.submit('critical', self._job, 'critical', 1)
+        self.assertEqual(self.pool.running('critical'), 1)
+        event.send()
+        submitter.wait()
+        self.pool.waitall()
+        self.assertEqual(sorted(self.done), [('critical', 1),
+                                             ('default', 1),
+                                             ('default', 2)])
+
+    def test_error_does_not_stop_lane(self):
+        def fail():
+            raise Exception('boom')
+        self.pool.submit('default', fail)
+        self.pool.submit('default', self._job, 'default', 1)
+        self.pool.waitall()
+        self.assertEqual(self.done, [('default', 1)])
+        self.assertEqual(self.pool.running(), 0)
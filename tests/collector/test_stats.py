@@ -0,0 +1,127 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/collector/stats.py
+"""
+
+import mock
+
+from ceilometer.collector import stats
+from ceilometer.tests import base
+
+
+class TestHistogram(base.TestCase):
+
+    def setUp(self):
+        super(TestHistogram, self).setUp()
+        self.histogram = stats.Histogram()
+
+    def test_empty(self):
+        self.assertEqual(self.histogram.count, 0)
+        self.assertEqual(self.histogram.average, 0.0)
+        self.assertEqual(self.histogram.percentile(99), 0.0)
+
+    def test_add(self):
+        for duration in (0.5, 3, 3, 40, 7000):
+            self.histogram.add(duration)
+        self.assertEqual(self.histogram.count, 5)
+        self.assertEqual(self.histogram.max, 7000)
+        self.assertEqual(self.histogram.average, 7046.5 / 5)
+        self.assertEqual(self.histogram.counts[0], 1)
+        self.assertEqual(self.histogram.counts[2], 2)
+        self.assertEqual(self.histogram.counts[-1], 1)
+
+    def test_percentile(self):
+        for duration in range(100):
+            self.histogram.add(duration)
+        self.assertEqual(self.histogram.percentile(50), 50)
+        self.assertEqual(self.histogram.percentile(99), 99)
+        self.assertEqual(self.histogram.percentile(1), 1)
+
+    def test_reset(self):
+        self.histogram.add(1)
+        self.histogram.reset()
+        self.assertEqual(self.histogram.count, 0)
+        self.assertEqual(sum(self.histogram.counts), 0)
+
+
+class TestWriteStats(base.TestCase):
+
+    def setUp(self):
+        super(TestWriteStats, self).setUp()
+        self.stats = stats.WriteStats(['verify', 'store'], 0.5)
+
+    def test_time(self):
+        with mock.patch('time.time', side_effect=[10.0, 10.25]):
+            with self.stats.time('store'):
+                pass
+        self.assertEqual(self.stats.histograms['store'].count, 1)
+        self.assertEqual(self.stats.histograms['store'].max, 250)
+        self.assertEqual(self.stats.histograms['verify'].count, 0)
+
+    def test_time_error(self):
+        try:
+            with self.stats.time('store'):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.stats.histograms['store'].count, 1)
+
+    def test_slow_write(self):
+        with mock.patch('time.time', side_effect=[10.0, 11.0]):
+            with mock.patch.object(stats.LOG, 'warning') as warning:
+                with self.stats.write('cpu/resource'):
+                    pass
+        self.assertEqual(self.stats.slow_writes, 1)
+        self.assertEqual(warning.call_count, 1)
+
+    def test_fast_write(self):
+        with mock.patch('time.time', side_effect=[10.0, 10.1]):
+            with self.stats.write('cpu/resource'):
+                pass
+        self.assertEqual(self.stats.slow_writes, 0)
+
+    def test_profile_slow_write(self):
+        self.stats.profile_rate = 2
+        with mock.patch.object(stats.LOG, 'warning') as warning:
+            with mock.patch('time.time', side_effect=[10.0, 11.0]):
+                with self.stats.write('cpu/resource'):
+                    pass
+            self.assertEqual(warning.call_count, 1)
+            with mock.patch('time.time', side_effect=[10.0, 11.0]):
+                with self.stats.write('cpu/resource'):
+                    pass
+            self.assertEqual(warning.call_count, 3)
+        self.assertIn('function calls', warning.call_args[0][2])
+
+    def test_profile_one_write_at_a_time(self):
+        self.stats.profile_rate = 1
+        with mock.patch.object(stats.cProfile, 'Profile') as profile:
+            with self.stats.write('cpu/resource'):
+                with self.stats.write('cpu/other'):
+                    pass
+            self.assertEqual(profile.call_count, 1)
+            with self.stats.write('cpu/resource'):
+                pass
+            self.assertEqual(profile.call_count, 2)
+
+    def test_report(self):
+        self.stats.histograms['store'].add(4)
+        self.stats.histograms['store'].add(6)
+        self.assertEqual(self.stats.report(),
+                         'verify=0/0.0/0.0/0.0ms '
+                         'store=2/5.0/6.0/6.0ms slow=0')
+        self.stats.reset()
+        self.assertEqual(self.stats.histograms['store'].count, 0)
@@ -0,0 +1,207 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/publisher/cached_cast.py
+"""
+
+import collections
+import socket
+
+from amqp import serialization
+import mock
+from oslo.config import cfg
+
+from ceilometer.openstack.common import context
+from ceilometer.openstack.common import rpc
+from ceilometer.openstack.common.rpc import impl_kombu
+from ceilometer.publisher import cached_cast
+from ceilometer.tests import base
+
+
+class FakeChannel(object):
+
+    _METHOD_MAP = {}
+
+    def __init__(self):
+        self.events = collections.defaultdict(set)
+        self.confirm_select = mock.Mock()
+        self.confirms = []
+
+    def drain_events(self, timeout=None):
+        if not self.confirms:
+            raise socket.timeout('timed out')
+        event, tag, multiple = self.confirms.pop(0)
+        for callback in self.events[event]:
+            callback(tag, multiple)
+
+
+class TestPublisherCache(base.TestCase):
+
+    def setUp(self):
+        super(TestPublisherCache, self).setUp()
+        self.channel = FakeChannel()
+        self.broker = mock.Mock()
+        self.broker.channel.return_value = self.channel
+        self.broker.drain_events.side_effect = self.channel.drain_events
+        self.stubs.Set(impl_kombu, 'TopicPublisher', mock.MagicMock())
+
+    def test_publisher_declared_once(self):
+        cache = cached_cast.PublisherCache(self.broker)
+        cache.send(cfg.CONF, 'metering', {'a': 1})
+        cache.send(cfg.CONF, 'metering', {'a': 2})
+        cache.send(cfg.CONF, 'metering.cpu', {'a': 3})
+        self.assertEqual(impl_kombu.TopicPublisher.call_count, 2)
+        self.assertFalse(self.channel.confirm_select.called)
+        cache.wait_confirms()
+
+    def test_confirms(self):
+        cache = cached_cast.PublisherCache(self.broker, confirms=True)
+        self.assertTrue(self.channel.confirm_select.called)
+        for i in range(4):
+            cache.send(cfg.CONF, 'metering', {'a': i})
+        self.assertEqual(cache.unconfirmed, set([1, 2, 3, 4]))
+        self.channel.confirms = [('basic_ack', 1, False),
+                                 ('basic_ack', 3, True),
+                                 ('basic_ack', 4, False)]
+        cache.wait_confirms(timeout=1)
+        self.assertEqual(cache.unconfirmed, set())
+        self.assertEqual(self.channel.confirms, [])
+
+    def test_confirms_nack(self):
+        cache = cached_cast.PublisherCache(self.broker, confirms=True)
+        for i in range(4):
+            cache.send(cfg.CONF, 'metering', {'a': i})
+        self.channel.confirms = [('basic_ack', 1, False),
+                                 ('basic_nack', 3, True),
+                                 ('basic_ack', 4, False)]
+        try:
+            cache.wait_confirms(timeout=1)
+        except cached_cast.MessagesRejected as e:
+            self.assertEqual(e.count, 2)
+        else:
+            self.fail('MessagesRejected not raised')
+        self.assertEqual(cache.unconfirmed, set())
+        # The next batch starts over
+        cache.send(cfg.CONF, 'metering', {'a': 5})
+        self.channel.confirms = [('basic_ack', 5, False)]
+        cache.wait_confirms(timeout=1)
+
+    def test_confirms_nack_dispatch(self):
+        cached_cast.PublisherCache(self.broker, confirms=True)
+        method = self.channel._METHOD_MAP[cached_cast.BASIC_NACK]
+        self.assertNotIn(cached_cast.BASIC_NACK, FakeChannel._METHOD_MAP)
+        nacks = []
+        self.channel.events['basic_nack'] = set([
+            lambda tag, multiple: nacks.append((tag, multiple))])
+        args = serialization.AMQPWriter()
+        args.write_longlong(7)
+        args.write_bit(True)
+        method(self.channel, serialization.AMQPReader(args.getvalue()))
+        self.assertEqual(nacks, [(7, True)])
+
+    def test_confirms_timeout(self):
+        cache = cached_cast.PublisherCache(self.broker, confirms=True)
+        cache.send(cfg.CONF, 'metering', {'a': 1})
+        cache.send(cfg.CONF, 'metering', {'a': 2})
+        self.channel.confirms = [('basic_ack', 1, False)]
+        self.assertRaises(socket.timeout, cache.wait_confirms, timeout=0.1)
+        self.assertEqual(cache.unconfirmed, set([2]))
+        timeouts = [c[1]['timeout']
+                    for c in self.broker.drain_events.call_args_list]
+        self.assertTrue(all(0 <= t <= 0.1 for t in timeouts))
+
+    def test_confirms_unsupported(self):
+        del self.channel.confirm_select
+        cache = cached_cast.PublisherCache(self.broker, confirms=True)
+        self.assertFalse(cache.confirms)
+
+
+class TestCachedCast(base.TestCase):
+
+    def setUp(self):
+        super(TestCachedCast, self).setUp()
+        cfg.CONF.set_override('fake_rabbit', True)
+        self.stubs.Set(impl_kombu.Connection, 'pool', None)
+        self.ctxt = context.get_admin_context()
+        self.received = []
+
+    def tearDown(self):
+        cfg.CONF.clear_override('fake_rabbit')
+        super(TestCachedCast, self).tearDown()
+
+    def _consume(self, topic):
+        def callback(msg):
+            self.received.append(msg)
+        conn = rpc.create_connection(new=True)
+        conn.connection.declare_topic_consumer(topic, callback)
+        return conn
+
+    def test_cast(self):
+        conn = self._consume('metering')
+        declared = []
+        publisher_init = impl_kombu.TopicPublisher.__init__
+
+        def faux_init(publisher, conf, channel, topic, **kwargs):
+            declared.append(topic)
+            publisher_init(publisher, conf, channel, topic, **kwargs)
+        self.stubs.Set(impl_kombu.TopicPublisher, '__init__', faux_init)
+
+        cached_cast.cast(self.ctxt, [('metering', {'args': {'n': 1}}),
+                                     ('metering', {'args': {'n': 2}})])
+        cached_cast.cast(self.ctxt, [('metering', {'args': {'n': 3}})])
+        self.assertEqual(declared, ['metering'])
+        conn.connection.consume(limit=3)
+        conn.close()
+        self.assertEqual([m['args']['n'] for m in self.received], [1, 2, 3])
+        self.assertIn('_unique_id', self.received[0])
+        self.assertIn('_context_is_admin', self.received[0])
+
+    def test_reconnect(self):
+        cached_cast.cast(self.ctxt, [('metering', {'args': {}})])
+        pool = impl_kombu.Connection.pool
+        connection = pool.get()
+        cache = cached_cast._publishers[connection]
+        connection.reconnect()
+        pool.put(connection)
+        cached_cast.cast(self.ctxt, [('metering', {'args': {}})])
+        self.assertIsNot(cached_cast._publishers[connection], cache)
+
+    def test_failure_closes_channel(self):
+        cached_cast.cast(self.ctxt, [('metering', {'args': {}})])
+        pool = impl_kombu.Connection.pool
+        connection = pool.get()
+        cache = cached_cast._publishers[connection]
+        pool.put(connection)
+        self.stubs.Set(cache, 'wait_confirms', mock.Mock(
+            side_effect=cached_cast.MessagesRejected(1)))
+        with mock.patch.object(cache.channel, 'close') as close:
+            self.assertRaises(cached_cast.MessagesRejected,
+                              cached_cast.cast, self.ctxt,
+                              [('metering', {'args': {}})])
+        close.assert_called_once_with()
+        self.assertNotIn(connection, cached_cast._publishers)
+
+    def test_other_backend(self):
+        cfg.CONF.set_override('rpc_backend', 'fake')
+        casts = []
+        self.stubs.Set(rpc, 'cast',
+                       lambda ctxt, topic, msg: casts.append((topic, msg)))
+        try:
+            cached_cast.cast(self.ctxt, [('metering', {'a': 1}),
+                                         ('metering.cpu', {'a': 2})])
+        finally:
+            cfg.CONF.clear_override('rpc_backend')
+        self.assertEqual(casts, [('metering', {'a': 1}),
+                                 ('metering.cpu', {'a': 2})])
@@ -20,12 +20,16 @@
 
 import datetime
 
+import eventlet
 from oslo.config import cfg
 
 from ceilometer.openstack.common import rpc
+from ceilometer.openstack.common.rpc import matchmaker
 from ceilometer.tests import base
 
+from ceilometer.collector import meter
 from ceilometer import counter
+from ceilometer.publisher import cached_cast
 from ceilometer.publisher import meter_publish
 
 
@@ -96,11 +100,16 @@ class TestPublish(base.TestCase):
         super(TestPublish, self).setUp()
         self.published = []
         self.stubs.Set(rpc, 'cast', self.faux_cast)
+        cfg.CONF.set_override('metering_meter_topics', ['*'])
         publisher = meter_publish.MeterPublisher()
         publisher.publish_counters(None,
                                    self.test_data,
                                    'test')
 
+    def tearDown(self):
+        cfg.CONF.clear_override('metering_meter_topics')
+        super(TestPublish, self).tearDown()
+
     def test_published(self):
         self.assertEqual(len(self.published), 4)
         for topic, rpc_call in self.published:
@@ -118,3 +127,386 @@ class TestPublish(base.TestCase):
         self.assertIn(cfg.CONF.metering_topic + '.' + 'test', topics)
         self.assertIn(cfg.CONF.metering_topic + '.' + 'test2', topics)
         self.assertIn(cfg.CONF.metering_topic + '.' + 'test3', topics)
+
+
+class TestPublishMeterTopics(base.TestCase):
+
+    def faux_cast(self, context, topic, msg):
+        self.published.append((topic, msg))
+
+    def setUp(self):
+        super(TestPublishMeterTopics, self).setUp()
+        self.published = []
+        self.stubs.Set(rpc, 'cast', self.faux_cast)
+
+    def tearDown(self):
+        cfg.CONF.clear_override('metering_meter_topics')
+        cfg.CONF.clear_override('metering_linger')
+        cfg.CONF.clear_override('metering_linger_max_messages')
+        super(TestPublishMeterTopics, self).tearDown()
+
+    def test_no_meter_topics_by_default(self):
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data, 'test')
+        self.assertEqual([topic for topic, msg in self.published],
+                         [cfg.CONF.metering_topic])
+        self.assertEqual(len(self.published[0][1]['args']['data']), 5)
+
+    def test_limited_meter_topics(self):
+        cfg.CONF.set_override('metering_meter_topics', ['test2', 'other'])
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data, 'test')
+        self.assertEqual([topic for topic, msg in self.published],
+                         [cfg.CONF.metering_topic,
+                          cfg.CONF.metering_topic + '.test2'])
+        self.assertEqual(len(self.published[1][1]['args']['data']), 2)
+
+    def test_linger(self):
+        cfg.CONF.set_override('metering_linger', 60)
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data[:2], 'test')
+        publisher.publish_counters(None, TestPublish.test_data[2:], 'test')
+        self.assertEqual(self.published, [])
+        publisher._flush_timer.cancel()
+        publisher.flush_pending()
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(len(self.published[0][1]['args']['data']), 5)
+        publisher.flush_pending()
+        self.assertEqual(len(self.published), 1)
+
+    def test_linger_timer(self):
+        cfg.CONF.set_override('metering_linger', 0.01)
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data[:2], 'test')
+        publisher.publish_counters(None, TestPublish.test_data[2:], 'test')
+        eventlet.sleep(0.05)
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(len(self.published[0][1]['args']['data']), 5)
+
+    def test_linger_cast_error(self):
+        def failing_cast(context, topic, msg):
+            raise Exception('broker unavailable')
+        self.stubs.Set(rpc, 'cast', failing_cast)
+        cfg.CONF.set_override('metering_linger', 60)
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data, 'test')
+        publisher._flush_timer.cancel()
+        publisher._flush_timer = None
+        self.assertRaises(Exception, publisher.flush_pending)
+        # Queued again, and cast once the broker is back
+        self.assertEqual(len(publisher._pending), 5)
+        self.assertIsNotNone(publisher._flush_timer)
+        publisher._flush_timer.cancel()
+        self.stubs.Set(rpc, 'cast', self.faux_cast)
+        publisher.flush()
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(len(self.published[0][1]['args']['data']), 5)
+        self.assertEqual(publisher._pending, [])
+
+    def test_linger_max_messages(self):
+        def failing_cast(context, topic, msg):
+            raise Exception('broker unavailable')
+        self.stubs.Set(rpc, 'cast', failing_cast)
+        cfg.CONF.set_override('metering_linger', 60)
+        cfg.CONF.set_override('metering_linger_max_messages', 4)
+        counters = [c._replace(volume=i)
+                    for i, c in enumerate(TestPublish.test_data)]
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, counters[:3], 'test')
+        self.assertRaises(Exception, publisher.flush)
+        publisher.publish_counters(None, counters[3:], 'test')
+        self.assertRaises(Exception, publisher.flush)
+        self.assertEqual([m['counter_volume']
+                          for c, t, m in publisher._pending], [1, 2, 3, 4])
+        publisher._flush_timer.cancel()
+
+    def test_linger_per_context(self):
+        contexts = []
+        self.stubs.Set(rpc, 'cast',
+                       lambda context, topic, msg: contexts.append(
+                           (context, len(msg['args']['data']))))
+        cfg.CONF.set_override('metering_linger', 60)
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters('ctxt1', TestPublish.test_data[:2],
+                                   'test')
+        publisher.publish_counters('ctxt2', TestPublish.test_data[2:],
+                                   'test')
+        publisher.flush()
+        self.assertEqual(contexts, [('ctxt1', 2), ('ctxt2', 3)])
+        self.assertIsNone(publisher._flush_timer)
+
+
+class TestPublishColumnar(base.TestCase):
+
+    def faux_cast(self, context, topic, msg):
+        self.published.append((topic, msg))
+
+    def setUp(self):
+        super(TestPublishColumnar, self).setUp()
+        self.published = []
+        self.stubs.Set(rpc, 'cast', self.faux_cast)
+        cfg.CONF.set_override('metering_encoding', 'columnar')
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None,
+                                   TestPublish.test_data,
+                                   'test')
+
+    def tearDown(self):
+        cfg.CONF.clear_override('metering_encoding')
+        super(TestPublishColumnar, self).tearDown()
+
+    def test_published(self):
+        topic, msg = self.published[0]
+        self.assertEqual(topic, cfg.CONF.metering_topic)
+        self.assertEqual(msg['version'], '1.1')
+        self.assertEqual(msg['args']['encoding'], 'columnar')
+        meters = meter.decode_meters(msg['args']['data'])
+        self.assertEqual([m['counter_name'] for m in meters],
+                         [c.name for c in TestPublish.test_data])
+
+
+class TestPublishCompressed(base.TestCase):
+
+    def faux_cast(self, context, topic, msg):
+        self.published.append((topic, msg))
+
+    def setUp(self):
+        super(TestPublishCompressed, self).setUp()
+        self.published = []
+        self.stubs.Set(rpc, 'cast', self.faux_cast)
+        cfg.CONF.set_override('metering_compression', 'zlib')
+
+    def tearDown(self):
+        cfg.CONF.clear_override('metering_compression')
+        cfg.CONF.clear_override('metering_compression_threshold')
+        cfg.CONF.clear_override('metering_encoding')
+        super(TestPublishCompressed, self).tearDown()
+
+    def test_published(self):
+        cfg.CONF.set_override('metering_compression_threshold', 0)
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data, 'test')
+        topic, msg = self.published[0]
+        self.assertEqual(msg['version'], '1.2')
+        self.assertEqual(msg['args']['compression'], 'zlib')
+        self.assertNotIn('encoding', msg['args'])
+        meters = meter.decompress_data(msg['args']['data'], 'zlib')
+        self.assertEqual([m['counter_name'] for m in meters],
+                         [c.name for c in TestPublish.test_data])
+
+    def test_published_columnar(self):
+        cfg.CONF.set_override('metering_compression_threshold', 0)
+        cfg.CONF.set_override('metering_encoding', 'columnar')
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data, 'test')
+        topic, msg = self.published[0]
+        self.assertEqual(msg['version'], '1.2')
+        self.assertEqual(msg['args']['encoding'], 'columnar')
+        meters = meter.decode_meters(
+            meter.decompress_data(msg['args']['data'], 'zlib'))
+        self.assertEqual(len(meters), len(TestPublish.test_data))
+
+    def test_below_threshold(self):
+        cfg.CONF.set_override('metering_compression_threshold', 1000000)
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data, 'test')
+        topic, msg = self.published[0]
+        self.assertEqual(msg['version'], '1.0')
+        self.assertNotIn('compression', msg['args'])
+        self.assertEqual(len(msg['args']['data']), 5)
+
+
+class TestPublishCachedPublishers(base.TestCase):
+
+    def faux_cast(self, context, casts):
+        self.published.append(casts)
+
+    def setUp(self):
+        super(TestPublishCachedPublishers, self).setUp()
+        self.published = []
+        self.stubs.Set(cached_cast, 'cast', self.faux_cast)
+        cfg.CONF.set_override('metering_cached_publishers', True)
+        cfg.CONF.set_override('metering_meter_topics', ['*'])
+
+    def tearDown(self):
+        cfg.CONF.clear_override('metering_cached_publishers')
+        cfg.CONF.clear_override('metering_meter_topics')
+        super(TestPublishCachedPublishers, self).tearDown()
+
+    def test_published(self):
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data, 'test')
+        self.assertEqual(len(self.published), 2)
+        self.assertEqual([topic for topic, msg in self.published[0]],
+                         [cfg.CONF.metering_topic])
+        # All the per meter topics are cast in one go
+        self.assertEqual([topic for topic, msg in self.published[1]],
+                         [cfg.CONF.metering_topic + '.test',
+                          cfg.CONF.metering_topic + '.test2',
+                          cfg.CONF.metering_topic + '.test3'])
+
+
+class TestPublishCollectorAffinity(base.TestCase):
+
+    def faux_cast(self, context, topic, msg):
+        self.published.append((topic, msg))
+
+    def setUp(self):
+        super(TestPublishCollectorAffinity, self).setUp()
+        self.published = []
+        self.stubs.Set(rpc, 'cast', self.faux_cast)
+        self.ring = {'metering': ['c1', 'c2', 'c3']}
+        self.stubs.Set(rpc, '_get_impl', lambda: self)
+        cfg.CONF.set_override('metering_collector_affinity', True)
+        self.counters = [
+            counter.Counter(name='test', type=counter.TYPE_CUMULATIVE,
+                            unit='', volume=i, user_id='user',
+                            project_id='project',
+                            resource_id='resource-%d' % (i % 20),
+                            timestamp=datetime.datetime.utcnow().isoformat(),
+                            resource_metadata={})
+            for i in range(100)]
+
+    def tearDown(self):
+        cfg.CONF.clear_override('metering_collector_affinity')
+        super(TestPublishCollectorAffinity, self).tearDown()
+
+    def _get_matchmaker(self):
+        return matchmaker.MatchMakerRing(self.ring)
+
+    def _collectors_of_resources(self):
+        collectors = {}
+        for topic, msg in self.published:
+            for m in msg['args']['data']:
+                collectors.setdefault(m['resource_id'], set()).add(topic)
+        return collectors
+
+    def test_resource_affinity(self):
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, self.counters[:50], 'test')
+        publisher.publish_counters(None, self.counters[50:], 'test')
+        collectors = self._collectors_of_resources()
+        self.assertEqual(len(collectors), 20)
+        for topics in collectors.values():
+            self.assertEqual(len(topics), 1)
+        self.assertEqual(set(topic for topic, msg in self.published),
+                         set(['metering.c1', 'metering.c2', 'metering.c3']))
+        self.assertEqual(sum(len(msg['args']['data'])
+                             for topic, msg in self.published), 100)
+
+    def test_membership_change(self):
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, self.counters, 'test')
+        before = self._collectors_of_resources()
+        self.published = []
+        self.ring['metering'] = ['c1', 'c2']
+        publisher.publish_counters(None, self.counters, 'test')
+        after = self._collectors_of_resources()
+        self.assertNotIn('metering.c3', [t for t, msg in self.published])
+        for resource, topics in before.items():
+            if topics != set(['metering.c3']):
+                self.assertEqual(after[resource], topics)
+
+    def test_no_collector(self):
+        self.ring['metering'] = []
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, self.counters, 'test')
+        self.assertEqual([topic for topic, msg in self.published],
+                         ['metering'])
+
+    def test_other_backend(self):
+        self.stubs.Set(rpc, '_get_impl', lambda: object())
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, self.counters, 'test')
+        self.assertEqual([topic for topic, msg in self.published],
+                         ['metering'])
+
+
+class TestPublishPartitions(base.TestCase):
+
+    def faux_cast(self, context, topic, msg):
+        self.published.append((topic, msg))
+
+    def setUp(self):
+        super(TestPublishPartitions, self).setUp()
+        self.published = []
+        self.stubs.Set(rpc, 'cast', self.faux_cast)
+        cfg.CONF.set_override('metering_partitions', 4)
+
+    def tearDown(self):
+        cfg.CONF.clear_override('metering_partitions')
+        super(TestPublishPartitions, self).tearDown()
+
+    def test_partitioned(self):
+        counters = [
+            counter.Counter(name='test', type=counter.TYPE_CUMULATIVE,
+                            unit='', volume=i, user_id='user',
+                            project_id='project',
+                            resource_id='resource-%d' % (i % 20),
+                            timestamp=datetime.datetime.utcnow().isoformat(),
+                            resource_metadata={})
+            for i in range(100)]
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, counters, 'test')
+        self.assertEqual([topic for topic, msg in self.published],
+                         ['metering.p0', 'metering.p1',
+                          'metering.p2', 'metering.p3'])
+        for topic, msg in self.published:
+            for m in msg['args']['data']:
+                self.assertEqual(
+                    meter.partition_topic('metering', m['resource_id'], 4),
+                    topic)
+
+
+class TestPublishPriority(base.TestCase):
+
+    def faux_cast(self, context, topic, msg):
+        self.published.append((topic, msg))
+
+    def setUp(self):
+        super(TestPublishPriority, self).setUp()
+        self.published = []
+        self.stubs.Set(rpc, 'cast', self.faux_cast)
+        cfg.CONF.set_override('metering_priorities', ['critical:4'])
+
+    def tearDown(self):
+        cfg.CONF.clear_override('metering_priorities')
+        cfg.CONF.clear_override('metering_partitions')
+        cfg.CONF.clear_override('metering_linger')
+        super(TestPublishPriority, self).tearDown()
+
+    def test_priority_topic(self):
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data, 'test',
+                                   priority='critical')
+        publisher.publish_counters(None, TestPublish.test_data, 'test')
+        self.assertEqual([topic for topic, msg in self.published],
+                         ['metering-critical', 'metering'])
+
+    def test_unknown_priority(self):
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data, 'test',
+                                   priority='best-effort')
+        self.assertEqual([topic for topic, msg in self.published],
+                         ['metering'])
+
+    def test_partitioned_priority(self):
+        cfg.CONF.set_override('metering_partitions', 2)
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data, 'test',
+                                   priority='critical')
+        for topic, msg in self.published:
+            self.assertIn(topic, ['metering-critical.p0',
+                                  'metering-critical.p1'])
+
+    def test_linger_per_priority(self):
+        cfg.CONF.set_override('metering_linger', 60)
+        publisher = meter_publish.MeterPublisher()
+        publisher.publish_counters(None, TestPublish.test_data[:2], 'test',
+                                   priority='critical')
+        publisher.publish_counters(None, TestPublish.test_data[2:], 'test')
+        publisher._flush_timer.cancel()
+        publisher.flush_pending()
+        self.assertEqual([(topic, len(msg['args']['data']))
+                          for topic, msg in self.published],
+                         [('metering', 3), ('metering-critical', 2)])
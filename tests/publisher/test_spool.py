@@ -0,0 +1,214 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/publisher/spool.py
+"""
+
+import os
+import shutil
+import tempfile
+
+import eventlet
+import mock
+from oslo.config import cfg
+
+from ceilometer import counter
+from ceilometer.publisher import spool
+from ceilometer.tests import base
+
+
+class FakePublisher(object):
+
+    def __init__(self):
+        self.published = []
+        self.priorities = []
+        self.fail = False
+        self.pending = []
+        self.linger = False
+
+    def publish_counters(self, context, counters, source, priority=None):
+        if self.fail:
+            raise Exception('broker unavailable')
+        self.pending.extend((c.volume, source) for c in counters)
+        self.priorities.append(priority)
+        if not self.linger:
+            self.flush()
+
+    def flush(self):
+        if self.fail:
+            raise Exception('broker unavailable')
+        self.published.extend(self.pending)
+        self.pending = []
+
+
+class TestSpoolPublisher(base.TestCase):
+
+    @staticmethod
+    def _counters(start, count):
+        return [counter.Counter(name='test',
+                                type=counter.TYPE_CUMULATIVE,
+                                unit='',
+                                volume=i,
+                                user_id='test',
+                                project_id='test',
+                                resource_id='test_run_tasks',
+                                timestamp='2013-05-21T10:00:00',
+                                resource_metadata={'name': 'TestPublish'})
+                for i in range(start, start + count)]
+
+    def setUp(self):
+        super(TestSpoolPublisher, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        cfg.CONF.set_override('spool_directory', self.directory)
+        self.stubs.Set(eventlet, 'spawn', lambda func: None)
+        self.downstream = FakePublisher()
+        self.publisher = self._make_publisher()
+
+    def tearDown(self):
+        for opt in ('spool_directory', 'spool_segment_size',
+                    'spool_max_size'):
+            cfg.CONF.clear_override(opt)
+        shutil.rmtree(self.directory)
+        super(TestSpoolPublisher, self).tearDown()
+
+    def _make_publisher(self):
+        publisher = spool.SpoolPublisher()
+        publisher._downstream = self.downstream
+        return publisher
+
+    def _segments(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_directory_created_on_publish(self):
+        directory = os.path.join(self.directory, 'spool')
+        cfg.CONF.set_override('spool_directory', directory)
+        publisher = self._make_publisher()
+        self.assertFalse(os.path.exists(directory))
+        publisher.publish_counters(None, self._counters(0, 1), 'src')
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+    def test_foreign_files(self):
+        for name in ('backup.spool', 'README'):
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write('not a batch\n')
+        publisher = self._make_publisher()
+        publisher.publish_counters(None, self._counters(0, 1), 'src')
+        publisher.replay()
+        self.assertEqual(self.downstream.published, [(0, 'src')])
+        self.assertEqual(self._segments(), ['README', 'backup.spool'])
+
+    def test_publish_and_replay(self):
+        self.publisher.publish_counters(None, self._counters(0, 3), 'src')
+        self.publisher.publish_counters(None, self._counters(3, 2), 'src2')
+        self.assertEqual(self.downstream.published, [])
+        self.publisher.replay()
+        self.assertEqual(self.downstream.published,
+                         [(0, 'src'), (1, 'src'), (2, 'src'),
+                          (3, 'src2'), (4, 'src2')])
+        self.assertEqual(self._segments(), [])
+        self.assertEqual(self.publisher.size(), 0)
+
+    def test_replay_priority(self):
+        self.publisher.publish_counters(None, self._counters(0, 2), 'test',
+                                        priority='critical')
+        self.publisher.publish_counters(None, self._counters(2, 2), 'test')
+        self.publisher.replay()
+        self.assertEqual(self.downstream.priorities, ['critical', None])
+
+    def test_replay_failure(self):
+        cfg.CONF.set_override('spool_segment_size', 1)
+        self.publisher.publish_counters(None, self._counters(0, 1), 'src')
+        self.publisher.publish_counters(None, self._counters(1, 1), 'src')
+        self.downstream.fail = True
+        self.assertRaises(Exception, self.publisher.replay)
+        self.assertEqual(len(self._segments()), 2)
+        self.downstream.fail = False
+        self.publisher.replay()
+        self.assertEqual(self.downstream.published, [(0, 'src'), (1, 'src')])
+        self.assertEqual(self._segments(), [])
+
+    def test_partial_replay_no_duplicate(self):
+        self.publisher.publish_counters(None, self._counters(0, 1), 'src')
+        self.publisher.publish_counters(None, self._counters(1, 1), 'src')
+        calls = []
+
+        def fail_second(context, counters, source):
+            calls.append(counters)
+            if len(calls) == 2:
+                raise Exception('broker unavailable')
+            self.downstream.published.extend((c.volume, source)
+                                             for c in counters)
+        self.downstream.publish_counters = fail_second
+        self.assertRaises(Exception, self.publisher.replay)
+        del self.downstream.publish_counters
+        self.publisher.replay()
+        self.assertEqual(self.downstream.published, [(0, 'src'), (1, 'src')])
+
+    def test_replay_not_delivered(self):
+        self.publisher.publish_counters(None, self._counters(0, 1), 'src')
+        self.downstream.linger = True
+        self.downstream.flush = mock.Mock(
+            side_effect=Exception('broker unavailable'))
+        self.assertRaises(Exception, self.publisher.replay)
+        self.assertEqual(len(self._segments()), 1)
+        del self.downstream.flush
+        self.publisher.replay()
+        self.assertEqual(self.downstream.published[-1], (0, 'src'))
+        self.assertEqual(self._segments(), [])
+
+    def test_size(self):
+        cfg.CONF.set_override('spool_segment_size', 1)
+        for i in range(3):
+            self.publisher.publish_counters(None, self._counters(i, 1),
+                                            'src')
+        sizes = [os.path.getsize(os.path.join(self.directory, s))
+                 for s in self._segments()]
+        self.assertEqual(self.publisher.size(), sum(sizes))
+        self.assertEqual(self._make_publisher().size(), sum(sizes))
+        self.publisher.replay()
+        self.assertEqual(self.publisher.size(), 0)
+
+    def test_segments(self):
+        cfg.CONF.set_override('spool_segment_size', 1)
+        for i in range(3):
+            self.publisher.publish_counters(None, self._counters(i, 1),
+                                            'src')
+        self.assertEqual(len(self._segments()), 3)
+
+    def test_eviction(self):
+        cfg.CONF.set_override('spool_segment_size', 1)
+        self.publisher.publish_counters(None, self._counters(0, 1), 'src')
+        cfg.CONF.set_override('spool_max_size', self.publisher.size() * 2)
+        for i in range(1, 4):
+            self.publisher.publish_counters(None, self._counters(i, 1),
+                                            'src')
+        self.assertEqual(len(self._segments()), 2)
+        self.publisher.replay()
+        self.assertEqual(self.downstream.published, [(2, 'src'), (3, 'src')])
+
+    def test_recovery(self):
+        cfg.CONF.set_override('spool_segment_size', 1)
+        self.publisher.publish_counters(None, self._counters(0, 1), 'src')
+        self.publisher.publish_counters(None, self._counters(1, 1), 'src')
+        with open(os.path.join(self.directory, self._segments()[-1]),
+                  'a') as segment:
+            segment.write('{"source": "src", "coun')
+        publisher = self._make_publisher()
+        publisher.publish_counters(None, self._counters(2, 1), 'src')
+        self.assertEqual(len(self._segments()), 3)
+        publisher.replay()
+        self.assertEqual(self.downstream.published,
+                         [(0, 'src'), (1, 'src'), (2, 'src')])
+        self.assertEqual(self._segments(), [])
@@ -0,0 +1,108 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/publisher/udp.py
+"""
+
+import datetime
+import socket
+
+from oslo.config import cfg
+
+from ceilometer.collector import meter
+from ceilometer import counter
+from ceilometer.openstack.common import jsonutils
+from ceilometer.publisher import udp
+from ceilometer.tests import base
+
+
+class TestUDPPublisher(base.TestCase):
+
+    test_data = [
+        counter.Counter(
+            name='test%d' % i,
+            type=counter.TYPE_CUMULATIVE,
+            unit='',
+            volume=i,
+            user_id='test',
+            project_id='test',
+            resource_id='test_run_tasks',
+            timestamp=datetime.datetime.utcnow().isoformat(),
+            resource_metadata={'name': 'TestPublish'},
+        )
+        for i in range(5)
+    ]
+
+    def setUp(self):
+        super(TestUDPPublisher, self).setUp()
+        self.receivers = []
+        for i in range(2):
+            receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            receiver.bind(('127.0.0.1', 0))
+            receiver.settimeout(5)
+            self.receivers.append(receiver)
+        cfg.CONF.set_override('udp_collectors', [
+            '127.0.0.1:%d' % r.getsockname()[1] for r in self.receivers])
+        self.publisher = udp.UDPPublisher()
+
+    def tearDown(self):
+        cfg.CONF.clear_override('udp_collectors')
+        for receiver in self.receivers:
+            receiver.close()
+        super(TestUDPPublisher, self).tearDown()
+
+    def _receive(self, receiver):
+        msg = jsonutils.loads(receiver.recv(64 * 1024))
+        self.assertEqual(msg['encoding'], 'columnar')
+        return meter.decode_meters(msg['data'])
+
+    def test_published(self):
+        self.publisher.publish_counters(None, self.test_data, 'test')
+        meters = self._receive(self.receivers[0])
+        self.assertEqual([m['counter_volume'] for m in meters], range(5))
+        for m in meters:
+            self.assertTrue(meter.verify_signature(
+                m, cfg.CONF.metering_secret))
+
+    def test_round_robin(self):
+        self.publisher.publish_counters(None, self.test_data[:2], 'test')
+        self.publisher.publish_counters(None, self.test_data[2:], 'test')
+        self.assertEqual(len(self._receive(self.receivers[0])), 2)
+        self.assertEqual(len(self._receive(self.receivers[1])), 3)
+
+    def test_no_collector(self):
+        cfg.CONF.set_override('udp_collectors', [])
+        self.publisher.publish_counters(None, self.test_data, 'test')
+        self.receivers[0].settimeout(0)
+        self.assertRaises(socket.error, self.receivers[0].recv, 64 * 1024)
+
+    def test_split_datagrams(self):
+        self.stubs.Set(udp, 'MAX_DATAGRAM_SIZE', 600)
+        meters = [meter.meter_message_from_counter(c, 'secret', 'test')
+                  for c in self.test_data]
+        datagrams = udp.encode_datagrams(meters)
+        self.assertTrue(len(datagrams) > 1)
+        decoded = []
+        for datagram in datagrams:
+            self.assertTrue(len(datagram) <= 600)
+            decoded.extend(meter.decode_meters(
+                jsonutils.loads(datagram)['data']))
+        self.assertEqual([m['counter_volume'] for m in decoded], range(5))
+
+    def test_datagram_too_large(self):
+        self.stubs.Set(udp, 'MAX_DATAGRAM_SIZE', 10)
+        meters = [meter.meter_message_from_counter(c, 'secret', 'test')
+                  for c in self.test_data]
+        self.assertEqual(udp.encode_datagrams(meters), [])
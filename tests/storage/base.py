@@ -120,6 +120,19 @@ class DBTestBase(test_db.TestBase):
             self.msgs.append(msg)
 
 
+class RecordBatchMixin(object):
+    """Record the data of the tests in a single batch."""
+
+    def prepare_data(self):
+        recorded = []
+        self.conn.record_metering_data = recorded.append
+        try:
+            super(RecordBatchMixin, self).prepare_data()
+        finally:
+            del self.conn.record_metering_data
+        self.conn.record_metering_batch(recorded)
+
+
 class UserTest(DBTestBase):
 
     def test_get_users(self):
@@ -148,6 +161,108 @@ class ProjectTest(DBTestBase):
         assert list(projects) == expected
 
 
+class AssociationCacheTest(DBTestBase):
+
+    def _record(self, user_id, project_id, source):
+        c = counter.Counter(
+            'instance',
+            counter.TYPE_CUMULATIVE,
+            unit='',
+            volume=1,
+            user_id=user_id,
+            project_id=project_id,
+            resource_id='resource-id',
+            timestamp=datetime.datetime(2012, 7, 2, 11, 0),
+            resource_metadata={},
+        )
+        msg = meter.meter_message_from_counter(c, cfg.CONF.metering_secret,
+                                               source)
+        self.conn.record_metering_data(msg)
+
+    def test_known_associations(self):
+        hits = self.conn._associations.hits
+        self._record('user-id', 'project-id', 'test-1')
+        assert self.conn._associations.hits == hits + 2
+        assert list(self.conn.get_users(source='test-1')) == ['user-id']
+        assert list(self.conn.get_projects(source='test-1')) == \
+            ['project-id']
+
+    def test_new_source(self):
+        self._record('user-id', 'project-id', 'test-new')
+        assert list(self.conn.get_users(source='test-new')) == ['user-id']
+        assert list(self.conn.get_projects(source='test-new')) == \
+            ['project-id']
+
+    def test_clear(self):
+        self.conn.clear()
+        assert len(self.conn._associations) == 0
+
+
+class ResourceCacheTest(DBTestBase):
+
+    def _record(self, name='instance', metadata=None, minute=0):
+        c = counter.Counter(
+            name,
+            counter.TYPE_CUMULATIVE,
+            unit='',
+            volume=1,
+            user_id='user-id',
+            project_id='project-id',
+            resource_id='resource-id',
+            timestamp=datetime.datetime(2012, 7, 2, 11, minute),
+            resource_metadata=metadata or {'display_name': 'test-server',
+                                           'tag': 'self.counter',
+                                           },
+        )
+        msg = meter.meter_message_from_counter(c, cfg.CONF.metering_secret,
+                                               'test-1')
+        self.conn.record_metering_data(msg)
+
+    def _resource(self):
+        return [r for r in self.conn.get_resources(user='user-id')
+                if r.resource_id == 'resource-id'][0]
+
+    def test_unchanged(self):
+        hits = self.conn._resources.hits
+        self._record()
+        assert self.conn._resources.hits == hits + 1
+        f = storage.EventFilter(resource='resource-id')
+        assert len(list(self.conn.get_samples(f))) == 2
+        assert self._resource().metadata['tag'] == 'self.counter'
+
+    def test_metadata_changed(self):
+        misses = self.conn._resources.misses
+        self._record(metadata={'display_name': 'renamed'}, minute=1)
+        assert self.conn._resources.misses == misses + 1
+        self._record(metadata={'display_name': 'renamed'}, minute=2)
+        assert self.conn._resources.misses == misses + 1
+
+    def test_metadata_changed_by_another_meter(self):
+        misses = self.conn._resources.misses
+        self._record(metadata={'display_name': 'a'}, minute=1)
+        self._record(metadata={'display_name': 'b'}, minute=2)
+        self._record(name='cpu', metadata={'display_name': 'a'}, minute=3)
+        # Changed back since recorded for the meter
+        self._record(metadata={'display_name': 'b'}, minute=4)
+        assert self.conn._resources.misses == misses + 4
+
+    def test_new_meter(self):
+        self._record(name='cpu')
+        self.assertIn(models.ResourceMeter('cpu', 'cumulative', ''),
+                      self._resource().meter)
+
+    def test_cache_stats(self):
+        self._record()
+        stats = self.conn.get_cache_stats()
+        assert set(stats) >= set(['associations', 'resources'])
+        assert stats['resources']['hits'] == 1
+        assert stats['resources']['misses'] == len(self.msgs)
+
+    def test_clear(self):
+        self.conn.clear()
+        assert len(self.conn._resources) == 0
+
+
 class ResourceTest(DBTestBase):
 
     def test_get_resources(self):
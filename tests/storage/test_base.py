@@ -49,3 +49,20 @@ class BaseTest(unittest.TestCase):
         self.assertEqual(times[21],
                          (datetime.datetime(2013, 01, 02, 13, 19, 15),
                           datetime.datetime(2013, 01, 02, 13, 20, 10)))
+
+    def test_record_metering_batch(self):
+        recorded = []
+
+        class Connection(base.Connection):
+            def __init__(self):
+                pass
+
+            def record_metering_data(self, data):
+                if data is None:
+                    raise ValueError('invalid data')
+                recorded.append(data)
+
+        # The abstract methods are not called
+        Connection.__abstractmethods__ = frozenset()
+        Connection().record_metering_batch([1, None, 2])
+        self.assertEqual(recorded, [1, 2])
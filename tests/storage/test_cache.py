@@ -0,0 +1,106 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/storage/cache.py
+"""
+
+from ceilometer.storage import cache
+from ceilometer.tests import base
+
+
+class TestBoundedCache(base.TestCase):
+
+    def test_get_set(self):
+        c = cache.BoundedCache(10)
+        self.assertEqual(c.get('a'), None)
+        c.set('a', 1)
+        self.assertEqual(c.get('a'), 1)
+
+    def test_is_cached(self):
+        c = cache.BoundedCache(10)
+        self.assertFalse(c.is_cached('a', 1))
+        c.set('a', 1)
+        self.assertTrue(c.is_cached('a', 1))
+        self.assertFalse(c.is_cached('a', 2))
+        self.assertEqual((c.hits, c.misses), (1, 2))
+
+    def test_set_membership(self):
+        c = cache.BoundedCache(10)
+        c.add(('user', 'u', 's'))
+        self.assertIn(('user', 'u', 's'), c)
+        self.assertNotIn(('user', 'u', 'other'), c)
+        c.discard(('user', 'u', 's'))
+        self.assertNotIn(('user', 'u', 's'), c)
+
+    def test_bounded(self):
+        c = cache.BoundedCache(10)
+        for i in range(100):
+            c.add(i)
+            self.assertTrue(len(c) <= 10)
+        self.assertIn(99, c)
+        self.assertNotIn(0, c)
+
+    def test_recently_used_kept(self):
+        c = cache.BoundedCache(10)
+        c.add('hot')
+        for i in range(100):
+            self.assertIn('hot', c)
+            c.add(i)
+        self.assertIn('hot', c)
+
+    def test_disabled(self):
+        c = cache.BoundedCache(0)
+        c.add('a')
+        self.assertNotIn('a', c)
+        self.assertEqual(len(c), 0)
+
+    def test_clear(self):
+        c = cache.BoundedCache(10)
+        c.add('a')
+        c.clear()
+        self.assertNotIn('a', c)
+
+
+class TestResourceDigest(base.TestCase):
+
+    data = {'resource_id': 'r',
+            'counter_name': 'cpu',
+            'counter_type': 'cumulative',
+            'counter_unit': 'ns',
+            'user_id': 'u',
+            'project_id': 'p',
+            'source': 's',
+            'resource_metadata': {'a': 1, 'b': {'c': 2, 'd': 3}},
+            }
+
+    def test_digest_canonical(self):
+        data = dict(self.data)
+        data['resource_metadata'] = {'b': {'d': 3, 'c': 2}, 'a': 1}
+        self.assertEqual(cache.resource_digest(data),
+                         cache.resource_digest(self.data))
+
+    def test_digest_owner(self):
+        data = dict(self.data)
+        data['user_id'] = 'other'
+        self.assertNotEqual(cache.resource_digest(data),
+                            cache.resource_digest(self.data))
+
+    def test_key_per_resource(self):
+        data = dict(self.data)
+        data['counter_name'] = 'memory'
+        self.assertEqual(cache.resource_key(data),
+                         cache.resource_key(self.data))
+        self.assertNotEqual(cache.meter_key(data),
+                            cache.meter_key(self.data))
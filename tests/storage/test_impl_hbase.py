@@ -39,6 +39,14 @@ class ProjectTest(base.ProjectTest, HBaseEngineTestBase):
     pass
 
 
+class AssociationCacheTest(base.AssociationCacheTest, HBaseEngineTestBase):
+    pass
+
+
+class ResourceCacheTest(base.ResourceCacheTest, HBaseEngineTestBase):
+    pass
+
+
 class ResourceTest(base.ResourceTest, HBaseEngineTestBase):
     pass
 
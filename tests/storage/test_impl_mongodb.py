@@ -78,6 +78,14 @@ class ProjectTest(base.ProjectTest, MongoDBEngineTestBase):
     pass
 
 
+class AssociationCacheTest(base.AssociationCacheTest, MongoDBEngineTestBase):
+    pass
+
+
+class ResourceCacheTest(base.ResourceCacheTest, MongoDBEngineTestBase):
+    pass
+
+
 class ResourceTest(base.ResourceTest, MongoDBEngineTestBase):
     pass
 
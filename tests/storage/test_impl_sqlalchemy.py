@@ -23,9 +23,16 @@
 
 """
 
+import datetime
+
+import mock
 from oslo.config import cfg
+from sqlalchemy.engine import reflection
 
 from tests.storage import base
+from ceilometer import storage
+from ceilometer.storage import impl_sqlalchemy
+from ceilometer.storage.sqlalchemy import models
 from ceilometer.storage.sqlalchemy.models import table_args
 
 
@@ -41,6 +48,21 @@ class ProjectTest(base.ProjectTest, SQLAlchemyEngineTestBase):
     pass
 
 
+class AssociationCacheTest(base.AssociationCacheTest,
+                           SQLAlchemyEngineTestBase):
+    pass
+
+
+class ResourceCacheTest(base.ResourceCacheTest, SQLAlchemyEngineTestBase):
+
+    def test_metadata_changed_by_another_meter(self):
+        super(ResourceCacheTest,
+              self).test_metadata_changed_by_another_meter()
+        resource = self.conn.session.query(models.Resource).get(
+            'resource-id')
+        self.assertEqual(resource.resource_metadata, {'display_name': 'b'})
+
+
 class ResourceTest(base.ResourceTest, SQLAlchemyEngineTestBase):
     pass
 
@@ -50,17 +72,689 @@ class MeterTest(base.MeterTest, SQLAlchemyEngineTestBase):
 
 
 class RawEventTest(base.RawEventTest, SQLAlchemyEngineTestBase):
+
+    def test_get_samples_in_chunks(self):
+        self.stubs.Set(impl_sqlalchemy, 'SAMPLES_CHUNK_SIZE', 1)
+        self.conn.session.flush()
+        self.conn.session.expunge_all()
+        f = storage.EventFilter(meter='instance')
+        results = list(self.conn.get_samples(f))
+        self.assertEqual(len(results), len(self.msgs))
+        self.assertEqual(len(self.conn.session.identity_map), 0)
+
+
+class RecordBatchUserTest(base.RecordBatchMixin, base.UserTest,
+                          SQLAlchemyEngineTestBase):
     pass
 
 
-class StatisticsTest(base.StatisticsTest, SQLAlchemyEngineTestBase):
+class RecordBatchProjectTest(base.RecordBatchMixin, base.ProjectTest,
+                             SQLAlchemyEngineTestBase):
+    pass
+
+
+class RecordBatchResourceTest(base.RecordBatchMixin, base.ResourceTest,
+                              SQLAlchemyEngineTestBase):
+    pass
+
+
+class RecordBatchMeterTest(base.RecordBatchMixin, base.MeterTest,
+                           SQLAlchemyEngineTestBase):
+    pass
+
+
+class RecordBatchRawEventTest(base.RecordBatchMixin, base.RawEventTest,
+                              SQLAlchemyEngineTestBase):
     pass
 
 
+class RecordBatchTest(SQLAlchemyEngineTestBase):
+
+    def _batch(self, **kwargs):
+        msg = dict(self.msg1, message_id='batch', **kwargs)
+        self.conn._associations.clear()
+        self.conn._resources.clear()
+        self.conn.record_metering_batch([msg])
+
+    def test_existing_resource_updated(self):
+        self._batch(resource_metadata={'display_name': 'renamed'})
+        resource = self.conn.session.query(models.Resource).get(
+            'resource-id')
+        self.assertEqual(resource.resource_metadata,
+                         {'display_name': 'renamed'})
+
+    def test_resource_changed_within_batch(self):
+        def msg(name, display_name):
+            return dict(self.msg1, counter_name=name,
+                        resource_metadata={'display_name': display_name},
+                        message_id='%s-%s' % (name, display_name))
+        self.conn.record_metering_batch([msg('instance', 'a'),
+                                         msg('instance', 'b')])
+        self.conn.record_metering_batch([msg('cpu', 'a'),
+                                         msg('instance', 'b')])
+        resource = self.conn.session.query(models.Resource).get(
+            'resource-id')
+        self.assertEqual(resource.resource_metadata, {'display_name': 'b'})
+        self.assertEqual(self.conn.session.query(
+            models.ResourceMeter).filter_by(resource_id='resource-id',
+                                            counter_name='cpu').count(), 1)
+
+    def test_associations_not_duplicated(self):
+        self._batch()
+        engine = self.conn.session.get_bind()
+        for column in ('user_id', 'project_id', 'resource_id'):
+            self.assertEqual(engine.execute(
+                'SELECT count(*) FROM sourceassoc WHERE %s = ? '
+                'AND source_id = ?' % column,
+                self.msg1[column], 'test-1').scalar(), 1)
+        self.assertEqual(engine.execute(
+            'SELECT count(*) FROM resource_meter '
+            'WHERE resource_id = ?', 'resource-id').scalar(), 1)
+        self.assertEqual(len(list(self.conn.get_samples(
+            storage.EventFilter(resource='resource-id')))), 2)
+
+    def test_insert_ignore_unknown_dialect(self):
+        connection = self.conn.session.get_bind().connect()
+        with mock.patch.object(connection.dialect, 'name', 'firebird'):
+            impl_sqlalchemy._insert_ignore(
+                connection, models.User.__table__,
+                [{'id': 'user-id'}, {'id': 'user-id-new'}])
+        self.assertEqual(list(connection.execute(
+            'SELECT id FROM user WHERE id IN (?, ?)',
+            'user-id', 'user-id-new')),
+            [('user-id',), ('user-id-new',)])
+
+    def test_insert_ignore_old_postgresql(self):
+        connection = self.conn.session.get_bind().connect()
+        with mock.patch.multiple(connection.dialect, name='postgresql',
+                                 server_version_info=(9, 4, 1)):
+            impl_sqlalchemy._insert_ignore(
+                connection, models.User.__table__,
+                [{'id': 'user-id'}, {'id': 'user-id-new'}])
+        self.assertEqual(list(connection.execute(
+            'SELECT id FROM user WHERE id IN (?, ?)',
+            'user-id', 'user-id-new')),
+            [('user-id',), ('user-id-new',)])
+
+
+class SourceCacheTest(SQLAlchemyEngineTestBase):
+
+    def _record(self, **kwargs):
+        with mock.patch.object(self.conn, '_get_source',
+                               wraps=self.conn._get_source) as get_source:
+            self.conn.record_metering_data(dict(self.msg1, **kwargs))
+        return get_source.call_count
+
+    def test_known_source_not_loaded(self):
+        self.assertEqual(self._record(message_id='again'), 0)
+
+    def test_new_source_loaded(self):
+        self.assertEqual(self._record(message_id='new', source='test-new'),
+                         1)
+        self.assertEqual(self.conn.session.query(models.Source).get(
+            'test-new').id, 'test-new')
+        self.assertIn('test-new', self.conn._sources)
+
+
+class PartitionedEngineTestBase(SQLAlchemyEngineTestBase):
+
+    def setUp(self):
+        impl_sqlalchemy.SQLAlchemyStorage().register_opts(cfg.CONF)
+        cfg.CONF.set_override('sql_meter_partition_days', 1)
+        self.addCleanup(cfg.CONF.clear_override, 'sql_meter_partition_days')
+        super(PartitionedEngineTestBase, self).setUp()
+
+
+class PartitionedResourceTest(base.ResourceTest, PartitionedEngineTestBase):
+    pass
+
+
+class PartitionedMeterTest(base.MeterTest, PartitionedEngineTestBase):
+    pass
+
+
+class PartitionedRawEventTest(base.RawEventTest, PartitionedEngineTestBase):
+    pass
+
+
+class PartitionedStatisticsTest(base.StatisticsTest,
+                                PartitionedEngineTestBase):
+    pass
+
+
+class PartitionedRecordBatchTest(base.RecordBatchMixin, base.RawEventTest,
+                                 PartitionedEngineTestBase):
+    pass
+
+
+class PartitionTest(PartitionedEngineTestBase):
+
+    def _partitions(self):
+        return [p.id for p in self.conn.session.query(
+            models.MeterPartition).order_by(models.MeterPartition.id)]
+
+    def _record(self, timestamp):
+        self.conn.record_metering_data(dict(self.msg1, timestamp=timestamp,
+                                            message_id=str(timestamp)))
+
+    def test_partitions(self):
+        self.assertEqual(self._partitions(), ['meter_20120702'])
+        engine = self.conn.session.get_bind()
+        self.assertEqual(engine.execute(
+            'SELECT count(*) FROM meter').scalar(), 0)
+        self.assertEqual(engine.execute(
+            'SELECT count(*) FROM meter_20120702').scalar(),
+            len(self.msgs))
+
+    def test_routing(self):
+        self._record(datetime.datetime(2012, 7, 10, 12))
+        self.assertEqual(self._partitions(),
+                         ['meter_20120702', 'meter_20120710'])
+        f = storage.EventFilter(start=datetime.datetime(2012, 7, 10),
+                                end=datetime.datetime(2012, 7, 11))
+        statement = str(self.conn.session.query(self.conn._meter(f).id))
+        self.assertIn('meter_20120710', statement)
+        self.assertNotIn('meter_20120702', statement)
+        # Filtered in the select of each table
+        self.assertIn('meter.timestamp >=', statement)
+        self.assertIn('meter_20120710.timestamp >=', statement)
+        self.assertEqual(len(list(self.conn.get_samples(f))), 1)
+
+    def test_partitioning_disabled(self):
+        self.conn._partition_days = 0
+        f = storage.EventFilter(resource='resource-id')
+        self.assertEqual([s.message_id for s in self.conn.get_samples(f)],
+                         [self.msg1['message_id']])
+        self.conn.clear()
+        self.assertIs(self.conn._meter(f), models.Meter)
+
+    def test_samples_not_partitioned(self):
+        engine = self.conn.session.get_bind()
+        engine.execute(models.Meter.__table__.insert(), dict(
+            impl_sqlalchemy._meter_row(self.msg1), message_id='old'))
+        f = storage.EventFilter(resource='resource-id')
+        self.assertEqual(sorted(s.message_id
+                                for s in self.conn.get_samples(f)),
+                         sorted(['old', self.msg1['message_id']]))
+
+    def test_clear_expired_metering_data(self):
+        self._record(datetime.datetime(2012, 7, 4, 12))
+        self.stubs.Set(impl_sqlalchemy.timeutils, 'utcnow',
+                       lambda: datetime.datetime(2012, 7, 5, 6))
+        self.conn.clear_expired_metering_data(86400)
+        self.assertEqual(self._partitions(), ['meter_20120704'])
+        self.assertFalse(self.conn.session.get_bind().has_table(
+            'meter_20120702'))
+        self.assertEqual(len(list(self.conn.get_samples(
+            storage.EventFilter()))), 1)
+
+
+class ClearExpiredTest(SQLAlchemyEngineTestBase):
+
+    def test_clear_expired_metering_data(self):
+        self.stubs.Set(impl_sqlalchemy.timeutils, 'utcnow',
+                       lambda: datetime.datetime(2012, 7, 2, 11))
+        self.conn.clear_expired_metering_data(60 * 18)
+        self.assertEqual(sorted(s.resource_id for s in self.conn.get_samples(
+            storage.EventFilter())), ['resource-id-2', 'resource-id-3'])
+
+
+def test_partition_start():
+    assert (impl_sqlalchemy._partition_start(
+        datetime.datetime(2013, 5, 1, 12), 7)
+        == datetime.datetime(2013, 4, 29))
+    assert (impl_sqlalchemy._partition_start(
+        datetime.datetime(2013, 5, 1, 12), 1)
+        == datetime.datetime(2013, 5, 1))
+
+
+class StatisticsTest(base.StatisticsTest, SQLAlchemyEngineTestBase):
+
+    def test_period_single_query(self):
+        f = storage.EventFilter(
+            meter='volume.size',
+            start=datetime.datetime(2012, 9, 25, 10),
+            end=datetime.datetime(2012, 9, 26),
+        )
+        with mock.patch.object(impl_sqlalchemy.base, 'iter_period') as loop:
+            results = list(self.conn.get_meter_statistics(f, period=300))
+        self.assertFalse(loop.called)
+        self.assertEqual([(r.period_start, r.count) for r in results],
+                         [(datetime.datetime(2012, 9, 25, 10, 30), 2),
+                          (datetime.datetime(2012, 9, 25, 11, 30), 2),
+                          (datetime.datetime(2012, 9, 25, 12, 30), 2)])
+
+
+class StatisticsFallbackTest(base.StatisticsTest, SQLAlchemyEngineTestBase):
+
+    def setUp(self):
+        super(StatisticsFallbackTest, self).setUp()
+        self.stubs.Set(impl_sqlalchemy, '_epoch',
+                       lambda dialect, column: None)
+
+
 class CounterDataTypeTest(base.CounterDataTypeTest, SQLAlchemyEngineTestBase):
     pass
 
 
+class MeterIndexTest(SQLAlchemyEngineTestBase):
+
+    INDEXES = set(['ix_meter_counter_name_timestamp',
+                   'ix_meter_resource_id_timestamp',
+                   'ix_meter_user_id_timestamp',
+                   'ix_meter_project_id_counter_name_timestamp'])
+
+    def _indexes(self):
+        inspector = reflection.Inspector.from_engine(
+            self.conn.session.get_bind())
+        return set(i['name'] for i in inspector.get_indexes('meter'))
+
+    def test_indexes(self):
+        self.assertTrue(self.INDEXES.issubset(self._indexes()))
+
+    def test_downgrade(self):
+        self.conn.upgrade(version=6)
+        try:
+            self.assertFalse(self.INDEXES & self._indexes())
+        finally:
+            self.conn.upgrade()
+        self.assertTrue(self.INDEXES.issubset(self._indexes()))
+
+
+class MeterSourceMigrationTest(SQLAlchemyEngineTestBase):
+
+    def _sourceassoc(self):
+        return sorted(tuple(r) for r in self.engine.execute(
+            'SELECT meter_id, source_id FROM sourceassoc '
+            'WHERE meter_id IS NOT NULL'))
+
+    def _meter_sources(self):
+        return dict(tuple(r) for r in self.engine.execute(
+            'SELECT id, source_id FROM meter'))
+
+    def test_migration(self):
+        self.engine = self.conn.session.get_bind()
+        self.assertEqual(self._sourceassoc(), [])
+        sources = self._meter_sources()
+        self.assertTrue(set(['test-1', 'test-2', 'test-3']).issubset(
+            sources.values()))
+        self.conn.upgrade(version=7)
+        try:
+            self.assertEqual(self._sourceassoc(), sorted(sources.items()))
+        finally:
+            self.conn.upgrade()
+        self.assertEqual(self._sourceassoc(), [])
+        self.assertEqual(self._meter_sources(), sources)
+
+
+class ResourceMeterTest(SQLAlchemyEngineTestBase):
+
+    def setUp(self):
+        super(ResourceMeterTest, self).setUp()
+        self.conn.session.flush()
+        self.engine = self.conn.session.get_bind()
+
+    def _resource_meters(self):
+        return sorted(tuple(r) for r in self.engine.execute(
+            'SELECT resource_id, counter_name, counter_type, counter_unit '
+            'FROM resource_meter'))
+
+    def _distinct_meters(self):
+        return sorted(tuple(r) for r in self.engine.execute(
+            'SELECT DISTINCT resource_id, counter_name, counter_type, '
+            'counter_unit FROM meter'))
+
+    def test_recorded_once(self):
+        self.assertEqual(self._resource_meters(), self._distinct_meters())
+
+    def test_migration(self):
+        self.conn.upgrade(version=8)
+        try:
+            self.assertNotIn(
+                'resource_meter',
+                reflection.Inspector.from_engine(
+                    self.engine).get_table_names())
+        finally:
+            self.conn.upgrade()
+        self.assertEqual(self._resource_meters(), self._distinct_meters())
+
+
+class MetaQueryTest(SQLAlchemyEngineTestBase):
+
+    def prepare_data(self):
+        super(MetaQueryTest, self).prepare_data()
+        msg = dict(self.msg1,
+                   resource_id='resource-id-typed',
+                   resource_metadata={'display_name': 'typed-server',
+                                      'size': 512,
+                                      'ratio': 0.5,
+                                      'public': True,
+                                      'image': {'name': 'cirros'}},
+                   message_id='typed')
+        self.conn.record_metering_data(msg)
+        self.msgs.append(msg)
+
+    def _samples(self, metaquery):
+        f = storage.EventFilter(metaquery=metaquery)
+        return sorted(s.message_id for s in self.conn.get_samples(f))
+
+    def test_get_samples(self):
+        self.assertEqual(self._samples({'metadata.tag': 'self.counter2'}),
+                         [self.msg2['message_id']])
+
+    def test_get_samples_several_keys(self):
+        self.assertEqual(self._samples({'metadata.tag': 'self.counter2',
+                                        'metadata.display_name':
+                                        'test-server'}),
+                         [self.msg2['message_id']])
+        self.assertEqual(self._samples({'metadata.tag': 'self.counter2',
+                                        'metadata.display_name':
+                                        'typed-server'}), [])
+
+    def test_get_samples_typed(self):
+        for key, value in (('size', 512), ('ratio', 0.5), ('public', True),
+                           ('image.name', 'cirros')):
+            self.assertEqual(self._samples({'metadata.' + key: value}),
+                             ['typed'])
+        self.assertEqual(self._samples({'metadata.size': '512'}), [])
+        self.assertEqual(self._samples({'metadata.public': False}), [])
+
+    def test_get_samples_unsupported(self):
+        self.assertRaises(NotImplementedError, self._samples,
+                          {'metadata.size': [512]})
+
+    def test_get_resources(self):
+        resources = list(self.conn.get_resources(
+            metaquery={'metadata.tag': 'self.counter3'}))
+        self.assertEqual([r.resource_id for r in resources],
+                         ['resource-id-alternate'])
+
+    def test_get_meters(self):
+        meters = list(self.conn.get_meters(
+            metaquery={'metadata.image.name': 'cirros'}))
+        self.assertEqual([m.resource_id for m in meters],
+                         ['resource-id-typed'])
+
+    def test_clear_expired(self):
+        # Metadata cached by a collector, expired by another connection
+        self.conn.record_metering_data(dict(
+            self.msgs[-1], resource_metadata={'display_name': 'old-server'},
+            timestamp=datetime.datetime(2012, 6, 1), message_id='old'))
+        self.conn.record_metering_data(dict(self.msgs[-1],
+                                            message_id='current'))
+        self.conn.session.flush()
+        expirer = impl_sqlalchemy.Connection(cfg.CONF)
+        self.stubs.Set(impl_sqlalchemy.timeutils, 'utcnow',
+                       lambda: datetime.datetime(2012, 7, 3))
+        expirer.clear_expired_metering_data(86400)
+        self.assertEqual(self._samples({'metadata.display_name':
+                                        'old-server'}), [])
+        self.conn.record_metering_data(dict(
+            self.msgs[-1], resource_metadata={'display_name': 'old-server'},
+            timestamp=datetime.datetime(2012, 7, 2, 12), message_id='new'))
+        self.assertEqual(self._samples({'metadata.display_name':
+                                        'old-server'}), ['new'])
+        self.assertEqual(self._samples({'metadata.display_name':
+                                        'typed-server'}),
+                         ['current', 'typed'])
+
+    def test_migration(self):
+        self.conn.session.flush()
+        engine = self.conn.session.get_bind()
+        rows = sorted(tuple(r) for r in engine.execute(
+            'SELECT * FROM meta_kv'))
+        self.conn.upgrade(version=10)
+        try:
+            self.assertNotIn(
+                'meta_kv',
+                reflection.Inspector.from_engine(engine).get_table_names())
+        finally:
+            self.conn.upgrade()
+        self.assertEqual(sorted(tuple(r) for r in engine.execute(
+            'SELECT * FROM meta_kv')), rows)
+        self.assertEqual(self._samples({'metadata.size': 512}), ['typed'])
+
+
+class PartitionedMetaQueryTest(MetaQueryTest, PartitionedEngineTestBase):
+    pass
+
+
+class RecordBatchMetaQueryTest(base.RecordBatchMixin, MetaQueryTest):
+    pass
+
+
+class LazyMetadataTest(SQLAlchemyEngineTestBase):
+
+    def test_samples(self):
+        f = storage.EventFilter(resource='resource-id')
+        sample, = self.conn.get_samples(f)
+        self.assertIsInstance(sample.__dict__['resource_metadata'],
+                              basestring)
+        self.assertEqual(sample.resource_metadata,
+                         self.msg1['resource_metadata'])
+        self.assertEqual(sample.__dict__['resource_metadata'],
+                         self.msg1['resource_metadata'])
+        self.assertEqual(sample.as_dict()['resource_metadata'],
+                         self.msg1['resource_metadata'])
+
+    def test_resources(self):
+        resource, = self.conn.get_resources(resource='resource-id')
+        self.assertIsInstance(resource.__dict__['metadata'], basestring)
+        self.assertEqual(resource.metadata, self.msg1['resource_metadata'])
+
+    def test_deferred(self):
+        for model in (models.Meter, models.Resource):
+            statement = str(self.conn.session.query(model))
+            self.assertNotIn('.resource_metadata ', statement)
+        self.conn.session.flush()
+        self.conn.session.expunge_all()
+        resource = self.conn.session.query(models.Resource).get(
+            'resource-id')
+        self.assertEqual(resource.resource_metadata,
+                         self.msg1['resource_metadata'])
+
+
+class RollupTest(SQLAlchemyEngineTestBase):
+
+    START = datetime.datetime(2013, 5, 1, 18)
+
+    def prepare_data(self):
+        super(RollupTest, self).prepare_data()
+        for i in range(12):
+            msg = dict(self.msg1,
+                       counter_name='volume.size',
+                       counter_volume=i,
+                       resource_id='volume-%d' % (i % 2),
+                       user_id='user-%d' % (i % 2),
+                       project_id='project-%d' % (i % 3),
+                       source='source-%d' % (i % 2),
+                       timestamp=self.START + datetime.timedelta(
+                           minutes=150 * i),
+                       message_id='volume-%d' % i)
+            self.conn.record_metering_data(msg)
+            self.msgs.append(msg)
+
+    def _statistics(self, period=None, **kwargs):
+        f = storage.EventFilter(meter='volume.size', **kwargs)
+        return [s.as_dict()
+                for s in self.conn.get_meter_statistics(f, period)]
+
+    def _assert_rollups(self, period=None, edges=0, **kwargs):
+        with mock.patch.object(
+                self.conn, '_make_stats_query',
+                wraps=self.conn._make_stats_query) as raw:
+            statistics = self._statistics(period, **kwargs)
+        self.assertEqual(raw.call_count, edges)
+        with mock.patch.object(self.conn, '_get_rollup_statistics',
+                               return_value=None):
+            self.assertEqual(statistics, self._statistics(period, **kwargs))
+        return statistics
+
+    def test_no_range(self):
+        statistics, = self._assert_rollups()
+        self.assertEqual(statistics['count'], 12)
+        self.assertEqual(statistics['sum'], 66)
+        self.assertEqual(statistics['duration_start'], self.START)
+
+    def test_filters(self):
+        statistics, = self._assert_rollups(source='source-1')
+        self.assertEqual(statistics['count'], 6)
+        statistics, = self._assert_rollups(source='source-2')
+        self.assertEqual(statistics['count'], 0)
+
+    def test_filters_not_indexed(self):
+        for kwargs in ({'user': 'user-1'}, {'project': 'project-2'},
+                       {'resource': 'volume-0'}):
+            self.assertIsNone(self.conn._get_rollup_statistics(
+                storage.EventFilter(meter='volume.size', **kwargs), None))
+
+    def test_aligned_range(self):
+        statistics, = self._assert_rollups(
+            start=datetime.datetime(2013, 5, 2),
+            end=datetime.datetime(2013, 5, 3))
+        self.assertEqual(statistics['count'], 9)
+        self._assert_rollups(start=datetime.datetime(2013, 5, 1, 20),
+                             end=datetime.datetime(2013, 5, 2, 3))
+
+    def test_edges(self):
+        statistics, = self._assert_rollups(
+            start=datetime.datetime(2013, 5, 1, 20, 15),
+            end=datetime.datetime(2013, 5, 2, 3, 45), edges=2)
+        self.assertEqual(statistics['count'], 3)
+        self._assert_rollups(end=datetime.datetime(2013, 5, 2, 3, 45),
+                             edges=1)
+
+    def test_short_range(self):
+        self._assert_rollups(start=datetime.datetime(2013, 5, 1, 20, 15),
+                             end=datetime.datetime(2013, 5, 1, 20, 45),
+                             edges=1)
+
+    def test_periods(self):
+        statistics = self._assert_rollups(
+            period=3600,
+            start=datetime.datetime(2013, 5, 1, 18),
+            end=datetime.datetime(2013, 5, 3))
+        self.assertEqual(len(statistics), 12)
+        self._assert_rollups(period=7200,
+                             start=datetime.datetime(2013, 5, 1, 14),
+                             end=datetime.datetime(2013, 5, 2, 4))
+        statistics = self._assert_rollups(
+            period=86400,
+            start=datetime.datetime(2013, 5, 1),
+            end=datetime.datetime(2013, 5, 3),
+            source='source-0')
+        self.assertEqual([s['count'] for s in statistics], [2, 4])
+
+    def test_periods_edge(self):
+        statistics = self._assert_rollups(
+            period=7200,
+            start=datetime.datetime(2013, 5, 1, 18),
+            end=datetime.datetime(2013, 5, 2, 1, 45), edges=1)
+        self.assertEqual(statistics[-1]['period_start'],
+                         datetime.datetime(2013, 5, 2))
+        self.assertEqual(statistics[-1]['count'], 1)
+
+    def test_periods_not_aligned(self):
+        self._assert_rollups(period=3600,
+                             start=datetime.datetime(2013, 5, 1, 18, 30),
+                             end=datetime.datetime(2013, 5, 3), edges=1)
+        self._assert_rollups(period=5400,
+                             start=datetime.datetime(2013, 5, 1, 18),
+                             end=datetime.datetime(2013, 5, 3), edges=1)
+
+    def test_metaquery(self):
+        self._assert_rollups(metaquery={'metadata.tag': 'self.counter'},
+                             edges=1)
+
+    def _rollups(self):
+        self.conn.session.flush()
+        table = models.MeterRollup.__table__
+        return self.conn.session.get_bind().execute(
+            table.select().order_by(*[table.c[c]
+                                      for c in models.ROLLUP_KEY])).fetchall()
+
+    def test_compact_rollups(self):
+        # Samples recorded in separate rows
+        for i in range(3):
+            self.conn.record_metering_batch([dict(
+                self.msgs[-1], message_id='batch-%d' % i)])
+        keys = set(tuple(r[c] for c in models.ROLLUP_KEY)
+                   for r in self._rollups())
+        self.conn.compact_rollups()
+        rollups = self._rollups()
+        self.assertEqual(len(rollups), len(keys))
+        self.assertTrue(all(r.compacted for r in rollups))
+        self.assertEqual(len(set(tuple(r[c] for c in models.ROLLUP_KEY)
+                                 for r in rollups)), len(rollups))
+        last = [r for r in rollups
+                if r.resource_id == 'volume-1' and r.granularity == 3600][-1]
+        self.assertEqual(last.sample_count, 4)
+        self.assertEqual(last.volume_sum, 44)
+        self.assertEqual(self._statistics(
+            period=3600, start=self.START,
+            end=datetime.datetime(2013, 5, 3))[-1]['count'], 4)
+        self.conn.compact_rollups()
+        self.assertEqual(self._rollups(), rollups)
+
+    def test_record_adds_rollups(self):
+        self.conn.compact_rollups()
+        rows = len(self._rollups())
+        self.conn.record_metering_data(dict(
+            self.msgs[-1], counter_volume=-1, message_id='more'))
+        self.assertEqual(len(self._rollups()), rows + 2)
+        statistics, = self._statistics(resource='volume-1')
+        self.assertEqual(statistics['count'], 7)
+        self.assertEqual(statistics['min'], -1)
+        self.conn.compact_rollups()
+        self.assertEqual(len(self._rollups()), rows)
+
+    def test_clear_expired(self):
+        self.stubs.Set(impl_sqlalchemy.timeutils, 'utcnow',
+                       lambda: datetime.datetime(2013, 5, 2, 12, 30))
+        self.conn.clear_expired_metering_data(6 * 3600)
+        self.assertEqual(
+            set(r.period_start for r in self._rollups()
+                if r.granularity == 86400),
+            set([datetime.datetime(2013, 5, 2)]))
+        self.assertTrue(all(r.compacted for r in self._rollups()))
+        # The rollups of the periods partially expired match the samples
+        start = datetime.datetime(2013, 5, 2)
+        end = datetime.datetime(2013, 5, 3)
+        statistics, = self._assert_rollups(start=start, end=end)
+        self.assertEqual(statistics['count'], len(list(
+            self.conn.get_samples(storage.EventFilter(
+                meter='volume.size', start=start, end=end)))))
+        self._assert_rollups(period=3600,
+                             start=datetime.datetime(2013, 5, 2),
+                             end=datetime.datetime(2013, 5, 3))
+
+    def test_migration(self):
+        self.conn.compact_rollups()
+        rollups = [tuple(r)[1:] for r in self._rollups()]
+        self.conn.upgrade(version=11)
+        try:
+            self.assertNotIn(
+                'meter_rollup',
+                reflection.Inspector.from_engine(
+                    self.conn.session.get_bind()).get_table_names())
+        finally:
+            self.conn.upgrade()
+        self.conn.compact_rollups()
+        self.assertEqual([tuple(r)[1:] for r in self._rollups()], rollups)
+
+
+class PartitionedRollupTest(RollupTest, PartitionedEngineTestBase):
+    pass
+
+
+class RecordBatchRollupTest(base.RecordBatchMixin, RollupTest):
+    pass
+
+
+def test_epoch_unknown_dialect():
+    assert impl_sqlalchemy._epoch('firebird', None) is None
+
+
 def test_model_table_args():
     cfg.CONF.database_connection = 'mysql://localhost'
     assert table_args()
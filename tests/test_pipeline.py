@@ -17,6 +17,9 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import eventlet
+import mock
+from oslo.config import cfg
 from stevedore import extension
 
 from ceilometer import counter
@@ -56,9 +59,13 @@ class TestPipeline(base.TestCase):
     class PublisherClass():
         def __init__(self):
             self.counters = []
+            self.calls = 0
+            self.priorities = []
 
-        def publish_counters(self, ctxt, counters, source):
+        def publish_counters(self, ctxt, counters, source, priority=None):
             self.counters.extend(counters)
+            self.calls += 1
+            self.priorities.append(priority)
 
     class PublisherClassException():
         def publish_counters(self, ctxt, counters, source):
@@ -676,3 +683,161 @@ class TestPipeline(base.TestCase):
                         == 'a:b_update')
         self.assertTrue(getattr(self.TransformerClass.samples[0], "name")
                         == 'a:b')
+
+    def test_publish_batched(self):
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager,
+                                                    self.publisher_manager)
+
+        with pipeline_manager.publisher(None, None) as p:
+            for i in range(10):
+                p([self.test_counter])
+            self.assertEqual(len(self.publisher.counters), 0)
+
+        self.assertEqual(len(self.publisher.counters), 10)
+        self.assertEqual(self.publisher.calls, 1)
+
+    def test_publish_max_batch_size(self):
+        cfg.CONF.set_override('publisher_max_batch_size', 4)
+        try:
+            pipeline_manager = pipeline.PipelineManager(
+                self.pipeline_cfg,
+                self.transformer_manager,
+                self.publisher_manager)
+            with pipeline_manager.publisher(None, None) as p:
+                p([self.test_counter] * 3)
+                self.assertEqual(self.publisher.calls, 0)
+                p([self.test_counter] * 6)
+                self.assertEqual(self.publisher.calls, 2)
+                self.assertEqual(len(self.publisher.counters), 8)
+        finally:
+            cfg.CONF.clear_override('publisher_max_batch_size')
+
+        self.assertEqual(self.publisher.calls, 3)
+        self.assertEqual(len(self.publisher.counters), 9)
+
+    def test_publish_no_batching(self):
+        for size in (0, -1):
+            cfg.CONF.set_override('publisher_max_batch_size', size)
+            self.addCleanup(cfg.CONF.clear_override,
+                            'publisher_max_batch_size')
+            self.publisher.calls = 0
+            pipeline_manager = pipeline.PipelineManager(
+                self.pipeline_cfg,
+                self.transformer_manager,
+                self.publisher_manager)
+            with pipeline_manager.publisher(None, None) as p:
+                p([self.test_counter] * 3)
+                self.assertEqual(self.publisher.calls, 1)
+                p([self.test_counter])
+                self.assertEqual(self.publisher.calls, 2)
+            self.assertEqual(pipeline_manager.pipelines[0]._batches, {})
+
+    def test_publish_max_linger(self):
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager,
+                                                    self.publisher_manager)
+        with mock.patch('time.time', return_value=100.0):
+            with pipeline_manager.publisher(None, None) as p:
+                p([self.test_counter])
+                self.assertEqual(self.publisher.calls, 0)
+                with mock.patch('time.time', return_value=101.5):
+                    p([self.test_counter])
+                self.assertEqual(self.publisher.calls, 1)
+                self.assertEqual(len(self.publisher.counters), 2)
+        self.assertEqual(self.publisher.calls, 1)
+
+    def test_publish_max_linger_timer(self):
+        cfg.CONF.set_override('publisher_max_linger_ms', 10)
+        self.addCleanup(cfg.CONF.clear_override, 'publisher_max_linger_ms')
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager,
+                                                    self.publisher_manager)
+        with pipeline_manager.publisher(None, None) as p:
+            p([self.test_counter])
+            self.assertEqual(self.publisher.calls, 0)
+            eventlet.sleep(0.05)
+            self.assertEqual(self.publisher.calls, 1)
+        self.assertEqual(self.publisher.calls, 1)
+        self.assertEqual(len(self.publisher.counters), 1)
+
+    def test_publish_concurrent_flush(self):
+        cfg.CONF.set_override('publisher_max_batch_size', 2)
+        self.addCleanup(cfg.CONF.clear_override, 'publisher_max_batch_size')
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager,
+                                                    self.publisher_manager)
+        pipe = pipeline_manager.pipelines[0]
+        published = []
+
+        def publish_counters(ctxt, counters, source):
+            published.append((ctxt, len(counters)))
+            # Another publish context flushes while the batch is published
+            if len(published) == 1:
+                with pipeline_manager.publisher('ctxt2', None) as p:
+                    p([self.test_counter])
+
+        self.publisher.publish_counters = publish_counters
+        with pipeline_manager.publisher('ctxt1', None) as p:
+            p([self.test_counter] * 3)
+        self.assertEqual(published, [('ctxt1', 2), ('ctxt2', 1),
+                                     ('ctxt1', 1)])
+        self.assertEqual(pipe._batches, {})
+
+    def test_flush_publishers(self):
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager,
+                                                    self.publisher_manager)
+        self.publisher.flush = mock.Mock(side_effect=Exception('down'))
+        pipeline_manager.flush_publishers()
+        self.publisher.flush.assert_called_once_with()
+
+    def test_publish_batched_per_source(self):
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager,
+                                                    self.publisher_manager)
+        pipe = pipeline_manager.pipelines[0]
+        pipe.publish_counter(None, self.test_counter, 'src1')
+        pipe.publish_counter(None, self.test_counter, 'src2')
+        pipe.flush(None, 'src1')
+        self.assertEqual(len(self.publisher.counters), 1)
+        pipe.flush(None, 'src2')
+        self.assertEqual(len(self.publisher.counters), 2)
+
+    def test_publish_dropped_counters_not_published(self):
+        self.pipeline_cfg[0]['transformers'] = [
+            {'name': "drop", 'parameters': {}}]
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager,
+                                                    self.publisher_manager)
+        with pipeline_manager.publisher(None, None) as p:
+            p([self.test_counter])
+        self.assertEqual(self.publisher.calls, 0)
+
+    def test_publish_priority(self):
+        cfg.CONF.set_override('metering_priorities', ['critical:4'])
+        self.addCleanup(cfg.CONF.clear_override, 'metering_priorities')
+        self.pipeline_cfg[0]['priority'] = 'critical'
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager,
+                                                    self.publisher_manager)
+        with pipeline_manager.publisher(None, None) as p:
+            p([self.test_counter])
+        self.assertEqual(self.publisher.priorities, ['critical'])
+
+    def test_unknown_priority(self):
+        self.pipeline_cfg[0]['priority'] = 'critical'
+        self.assertRaises(pipeline.PipelineException,
+                          pipeline.PipelineManager,
+                          self.pipeline_cfg,
+                          self.transformer_manager,
+                          self.publisher_manager)
+
+    def test_publish_no_priority(self):
+        self.pipeline_cfg[0]['publishers'] = ['except', 'test']
+        pipeline_manager = pipeline.PipelineManager(self.pipeline_cfg,
+                                                    self.transformer_manager,
+                                                    self.publisher_manager)
+        with pipeline_manager.publisher(None, None) as p:
+            p([self.test_counter])
+        self.assertEqual(self.publisher.priorities, [None])
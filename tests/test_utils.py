@@ -0,0 +1,76 @@
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for ceilometer/utils.py
+"""
+
+from ceilometer.tests import base
+from ceilometer import utils
+
+
+class TestUtils(base.TestCase):
+
+    def test_recursive_keypairs(self):
+        data = {'a': 'A',
+                'b': 'B',
+                'nested': {'a': 'A',
+                           'b': 'B',
+                           'deep': {'x': 1}}}
+        self.assertEqual(list(utils.recursive_keypairs(data)),
+                         [('a', 'A'),
+                          ('b', 'B'),
+                          ('nested.a', 'A'),
+                          ('nested.b', 'B'),
+                          ('nested.deep.x', 1)])
+
+    def test_recursive_keypairs_separator(self):
+        self.assertEqual(list(utils.recursive_keypairs({'a': {'b': 1}},
+                                                       separator=':')),
+                         [('a:b', 1)])
+
+
+class TestHashRing(base.TestCase):
+
+    keys = ['resource-%d' % i for i in range(1000)]
+
+    def test_stable_hash(self):
+        self.assertEqual(utils.stable_hash('resource'),
+                         utils.stable_hash(u'resource'))
+        self.assertNotEqual(utils.stable_hash('resource'),
+                            utils.stable_hash('resource2'))
+
+    def test_empty(self):
+        self.assertEqual(utils.HashRing([]).get_node('resource'), None)
+
+    def test_distribution(self):
+        ring = utils.HashRing(['a', 'b', 'c'])
+        nodes = [ring.get_node(k) for k in self.keys]
+        for node in ('a', 'b', 'c'):
+            self.assertTrue(200 < nodes.count(node) < 466)
+
+    def test_same_nodes(self):
+        ring = utils.HashRing(['a', 'b', 'c'])
+        other = utils.HashRing(['c', 'b', 'a'])
+        for k in self.keys:
+            self.assertEqual(ring.get_node(k), other.get_node(k))
+
+    def test_node_removed(self):
+        ring = utils.HashRing(['a', 'b', 'c'])
+        smaller = utils.HashRing(['a', 'b'])
+        for k in self.keys:
+            node = ring.get_node(k)
+            if node != 'c':
+                # Only the keys of the removed node move
+                self.assertEqual(smaller.get_node(k), node)
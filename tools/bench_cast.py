@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare rpc.cast with the casts through the cached publishers.
+
+By default the messages go to the in-memory kombu transport, which
+measures the client side cost of the casts; --real-broker sends them to
+the rabbit server of the configuration instead.
+"""
+
+import argparse
+import time
+
+from oslo.config import cfg
+
+from ceilometer.openstack.common import context
+from ceilometer.openstack.common import rpc
+from ceilometer.publisher import cached_cast
+
+
+def make_msg(i):
+    return {
+        'method': 'record_metering_data',
+        'version': '1.0',
+        'args': {'data': [{'counter_name': 'cpu',
+                           'counter_volume': i,
+                           'resource_id': 'instance-%08d' % i}]},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark the metering casts',
+    )
+    parser.add_argument(
+        '--messages',
+        default=5000,
+        type=int,
+        help='the number of messages cast',
+    )
+    parser.add_argument(
+        '--batch',
+        default=10,
+        type=int,
+        help='the number of messages per cached cast',
+    )
+    parser.add_argument(
+        '--topic',
+        default='metering.bench',
+        help='the topic the messages are cast to',
+    )
+    parser.add_argument(
+        '--confirms',
+        action='store_true',
+        help='wait for the broker confirms of the cached casts',
+    )
+    parser.add_argument(
+        '--real-broker',
+        action='store_true',
+        help='cast to the configured rabbit server',
+    )
+    parser.add_argument('config_file', nargs='*',
+                        help='ceilometer configuration files')
+    args = parser.parse_args()
+
+    cfg.CONF([], project='ceilometer', default_config_files=args.config_file)
+    cfg.CONF.set_override('fake_rabbit', not args.real_broker)
+    cfg.CONF.set_override('metering_publisher_confirms', args.confirms)
+    ctxt = context.get_admin_context()
+
+    def rpc_casts():
+        for i in xrange(args.messages):
+            rpc.cast(ctxt, args.topic, make_msg(i))
+
+    def cached_casts():
+        for start in xrange(0, args.messages, args.batch):
+            cached_cast.cast(ctxt, [
+                (args.topic, make_msg(i))
+                for i in xrange(start, min(start + args.batch,
+                                           args.messages))
+            ])
+
+    print '%-10s %12s %12s' % ('method', 'seconds', 'casts/s')
+    for name, run in [('rpc.cast', rpc_casts), ('cached', cached_casts)]:
+        start = time.time()
+        run()
+        duration = time.time() - start
+        print '%-10s %12.2f %12.0f' % (name, duration,
+                                       args.messages / duration)
+
+
+if __name__ == '__main__':
+    main()
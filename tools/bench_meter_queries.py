@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare the latency of the meter queries of the SQLAlchemy driver
+without and with the meter indexes.
+
+The database is filled with generated samples, the indexes added by the
+007 migration are dropped and the queries are timed, then the indexes are
+created again and the queries are timed again.
+"""
+
+import argparse
+import datetime
+import importlib
+import time
+
+from oslo.config import cfg
+import sqlalchemy
+
+from ceilometer import storage
+from ceilometer.storage.sqlalchemy import models
+
+meter_indexes = importlib.import_module(
+    'ceilometer.storage.sqlalchemy.migrate_repo.versions.'
+    '007_add_meter_indexes')
+
+START = datetime.datetime(2013, 5, 1)
+
+
+def generate(conn, args):
+    """Insert the generated samples and their owners."""
+    engine = conn.session.get_bind()
+    engine.execute(models.Source.__table__.insert(), [{'id': 'bench'}])
+    engine.execute(models.User.__table__.insert(),
+                   [{'id': 'user-%d' % u} for u in xrange(args.users)])
+    engine.execute(models.Project.__table__.insert(),
+                   [{'id': 'project-%d' % p} for p in xrange(args.projects)])
+    engine.execute(models.Resource.__table__.insert(), [
+        {'id': 'resource-%d' % r,
+         'user_id': 'user-%d' % (r % args.users),
+         'project_id': 'project-%d' % (r % args.projects),
+         'resource_metadata': {}}
+        for r in xrange(args.resources)])
+
+    # Every resource has a sample of every meter at each interval
+    per_interval = args.resources * args.meters
+    interval = (args.days * 86400.0) / max(args.rows // per_interval, 1)
+    meter_table = models.Meter.__table__
+    for offset in xrange(0, args.rows, args.batch):
+        rows = []
+        for i in xrange(offset, min(offset + args.batch, args.rows)):
+            r = i % args.resources
+            rows.append({
+                'id': i + 1,
+                'counter_name': 'meter-%d' % (i // args.resources
+                                              % args.meters),
+                'counter_type': 'gauge',
+                'counter_unit': 'B',
+                'counter_volume': i % 100,
+                'user_id': 'user-%d' % (r % args.users),
+                'project_id': 'project-%d' % (r % args.projects),
+                'resource_id': 'resource-%d' % r,
+                'resource_metadata': {},
+                'timestamp': START + datetime.timedelta(
+                    seconds=interval * (i // per_interval)),
+                'source_id': 'bench',
+                'message_id': str(i),
+                'message_signature': '',
+            })
+        engine.execute(meter_table.insert(), rows)
+
+
+def get_indexes(engine):
+    """Return the tables and definitions of the meter indexes."""
+    meta = sqlalchemy.MetaData(bind=engine)
+    return [(sqlalchemy.Table(table, meta, autoload=True), name, columns)
+            for table, name, columns in meter_indexes.INDEXES
+            if table == 'meter']
+
+
+def queries(conn):
+    day = START + datetime.timedelta(days=10)
+    return [
+        ('statistics of a meter, 1 day',
+         lambda: list(conn.get_meter_statistics(storage.EventFilter(
+             meter='meter-1',
+             start=day,
+             end=day + datetime.timedelta(days=1))))),
+        ('hourly statistics of a project meter, 1 week',
+         lambda: list(conn.get_meter_statistics(storage.EventFilter(
+             meter='meter-1',
+             project='project-7',
+             start=day,
+             end=day + datetime.timedelta(days=7)),
+             period=3600))),
+        ('samples of a resource, 1 day',
+         lambda: list(conn.get_samples(storage.EventFilter(
+             resource='resource-42',
+             start=day,
+             end=day + datetime.timedelta(days=1))))),
+        ('samples of a user meter, 1 day',
+         lambda: list(conn.get_samples(storage.EventFilter(
+             meter='meter-2',
+             user='user-3',
+             start=day,
+             end=day + datetime.timedelta(days=1))))),
+    ]
+
+
+def time_queries(conn, repeat):
+    """Return the median latency in milliseconds of each query."""
+    results = []
+    for name, query in queries(conn):
+        durations = []
+        for i in xrange(repeat):
+            start = time.time()
+            query()
+            durations.append((time.time() - start) * 1000)
+            conn.session.expunge_all()
+        results.append((name, sorted(durations)[len(durations) // 2]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark the meter queries of the sqlalchemy driver',
+    )
+    parser.add_argument(
+        '--url',
+        default='sqlite:////tmp/ceilometer-bench.db',
+        help='the database the samples are generated into, which is '
+        'cleared first',
+    )
+    parser.add_argument(
+        '--rows',
+        default=2000000,
+        type=int,
+        help='the number of samples generated',
+    )
+    parser.add_argument(
+        '--resources',
+        default=1000,
+        type=int,
+        help='the number of resources',
+    )
+    parser.add_argument(
+        '--meters',
+        default=10,
+        type=int,
+        help='the number of meters of each resource',
+    )
+    parser.add_argument(
+        '--users',
+        default=500,
+        type=int,
+        help='the number of users owning the resources',
+    )
+    parser.add_argument(
+        '--projects',
+        default=100,
+        type=int,
+        help='the number of projects owning the resources',
+    )
+    parser.add_argument(
+        '--days',
+        default=30,
+        type=int,
+        help='the number of days the samples are spread over',
+    )
+    parser.add_argument(
+        '--batch',
+        default=10000,
+        type=int,
+        help='the number of samples inserted at once',
+    )
+    parser.add_argument(
+        '--repeat',
+        default=5,
+        type=int,
+        help='the number of times each query is run',
+    )
+    args = parser.parse_args()
+
+    cfg.CONF([], project='ceilometer')
+    cfg.CONF.set_override('database_connection', args.url)
+    conn = storage.get_connection(cfg.CONF)
+    conn.upgrade()
+    conn.clear()
+    engine = conn.session.get_bind()
+    indexes = get_indexes(engine)
+    for table, name, columns in indexes:
+        sqlalchemy.Index(name, *[table.c[c] for c in columns]).drop()
+
+    start = time.time()
+    generate(conn, args)
+    print 'generated %d samples in %.1fs' % (args.rows, time.time() - start)
+    before = time_queries(conn, args.repeat)
+
+    start = time.time()
+    for table, name, columns in indexes:
+        meter_indexes.create_index(engine, table, name, columns)
+    print 'created the indexes in %.1fs' % (time.time() - start)
+    after = time_queries(conn, args.repeat)
+
+    print
+    print '%-46s %12s %12s' % ('query', 'before (ms)', 'after (ms)')
+    for (name, without), (name, with_indexes) in zip(before, after):
+        print '%-46s %12.1f %12.1f' % (name, without, with_indexes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare the throughput of the SQLAlchemy driver when recording the
+samples one at a time through the ORM and in batches of Core inserts.
+"""
+
+import argparse
+import datetime
+import time
+
+from oslo.config import cfg
+
+from ceilometer import storage
+
+START = datetime.datetime(2013, 5, 1)
+
+
+def make_samples(args):
+    """Return the generated metering messages."""
+    samples = []
+    for i in xrange(args.samples):
+        r = i % args.resources
+        samples.append({
+            'source': 'bench',
+            'counter_name': 'meter-%d' % (i // args.resources % args.meters),
+            'counter_type': 'gauge',
+            'counter_unit': 'B',
+            'counter_volume': i % 100,
+            'user_id': 'user-%d' % (r % args.users),
+            'project_id': 'project-%d' % (r % args.projects),
+            'resource_id': 'resource-%d' % r,
+            'resource_metadata': {'display_name': 'resource-%d' % r,
+                                  'size': i % 3},
+            'timestamp': START + datetime.timedelta(seconds=i),
+            'message_id': str(i),
+            'message_signature': '',
+        })
+    return samples
+
+
+def record_one_by_one(conn, samples, batch):
+    for data in samples:
+        conn.record_metering_data(data)
+    conn.session.flush()
+
+
+def record_batches(conn, samples, batch):
+    for offset in xrange(0, len(samples), batch):
+        conn.record_metering_batch(samples[offset:offset + batch])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark the recording of samples by the sqlalchemy '
+        'driver',
+    )
+    parser.add_argument(
+        '--url',
+        default='sqlite:////tmp/ceilometer-bench-record.db',
+        help='the database the samples are recorded into, which is '
+        'cleared first',
+    )
+    parser.add_argument(
+        '--samples',
+        default=20000,
+        type=int,
+        help='the number of samples recorded',
+    )
+    parser.add_argument(
+        '--resources',
+        default=500,
+        type=int,
+        help='the number of resources',
+    )
+    parser.add_argument(
+        '--meters',
+        default=5,
+        type=int,
+        help='the number of meters of each resource',
+    )
+    parser.add_argument(
+        '--users',
+        default=100,
+        type=int,
+        help='the number of users owning the resources',
+    )
+    parser.add_argument(
+        '--projects',
+        default=20,
+        type=int,
+        help='the number of projects owning the resources',
+    )
+    parser.add_argument(
+        '--batch',
+        default=100,
+        type=int,
+        help='the number of samples recorded at once in batches',
+    )
+    args = parser.parse_args()
+
+    cfg.CONF([], project='ceilometer')
+    cfg.CONF.set_override('database_connection', args.url)
+    conn = storage.get_connection(cfg.CONF)
+    conn.upgrade()
+    samples = make_samples(args)
+
+    results = []
+    for name, record in (('orm, one at a time', record_one_by_one),
+                         ('core, batches of %d' % args.batch,
+                          record_batches)):
+        conn.clear()
+        start = time.time()
+        record(conn, samples, args.batch)
+        results.append((name, time.time() - start))
+
+    print '%-30s %10s %12s' % ('path', 'time (s)', 'samples/s')
+    for name, duration in results:
+        print '%-30s %10.2f %12.0f' % (name, duration,
+                                       args.samples / duration)
+
+
+if __name__ == '__main__':
+    main()
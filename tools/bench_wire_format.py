@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Copyright © 2013 eNovance <licensing@enovance.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare the size and cost of the metering message encodings.
+"""
+
+import argparse
+import datetime
+import timeit
+
+from ceilometer.collector import meter
+from ceilometer import counter
+from ceilometer.openstack.common import jsonutils
+
+
+def make_meters(count, resources):
+    timestamp = datetime.datetime.utcnow()
+    meters = []
+    for i in xrange(count):
+        resource_id = 'instance-%08d' % (i % resources)
+        c = counter.Counter(
+            name=('cpu', 'disk.read.bytes', 'network.incoming.bytes')[i % 3],
+            type=counter.TYPE_CUMULATIVE,
+            unit=('ns', 'B', 'B')[i % 3],
+            volume=i * 1000,
+            user_id='2f4ea3e2a4ef4a1b8b7c9e0e9ee1d9b1',
+            project_id='7c150a59fe714e6f9263774af9688f0e',
+            resource_id=resource_id,
+            timestamp=(timestamp + datetime.timedelta(seconds=i)).isoformat(),
+            resource_metadata={'display_name': resource_id,
+                               'instance_type': 'm1.small',
+                               'host': 'compute-%d' % (i % resources % 7),
+                               'image_ref': 'ab6e5c3a-c2d8-4b6b-8fa3',
+                               'memory_mb': 2048,
+                               'vcpus': 1,
+                               'root_gb': 20,
+                               'ephemeral_gb': 0,
+                               'state': 'active'},
+        )
+        meters.append(meter.meter_message_from_counter(c, 'secret',
+                                                       'openstack'))
+    return meters
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark the metering message encodings',
+    )
+    parser.add_argument(
+        '--samples',
+        default=1000,
+        type=int,
+        help='the number of samples in a batch',
+    )
+    parser.add_argument(
+        '--resources',
+        default=100,
+        type=int,
+        help='the number of distinct resources in a batch',
+    )
+    parser.add_argument(
+        '--repeat',
+        default=20,
+        type=int,
+        help='the number of times each operation is run',
+    )
+    args = parser.parse_args()
+
+    meters = make_meters(args.samples, args.resources)
+    encodings = [
+        ('list', lambda: jsonutils.dumps(meters), jsonutils.loads),
+        ('columnar',
+         lambda: jsonutils.dumps(meter.encode_meters(meters)),
+         lambda payload: meter.decode_meters(jsonutils.loads(payload))),
+        ('list+zlib',
+         lambda: meter.compress_data(meters, 'zlib'),
+         lambda payload: meter.decompress_data(payload, 'zlib')),
+        ('col+zlib',
+         lambda: meter.compress_data(meter.encode_meters(meters), 'zlib'),
+         lambda payload: meter.decode_meters(
+             meter.decompress_data(payload, 'zlib'))),
+    ]
+
+    print '%-10s %12s %12s %12s' % ('encoding', 'bytes',
+                                    'encode (ms)', 'decode (ms)')
+    for name, encode, decode in encodings:
+        payload = encode()
+        encode_time = min(timeit.repeat(encode, number=1,
+                                        repeat=args.repeat))
+        decode_time = min(timeit.repeat(lambda: decode(payload), number=1,
+                                        repeat=args.repeat))
+        print '%-10s %12d %12.2f %12.2f' % (name, len(payload),
+                                            encode_time * 1000,
+                                            decode_time * 1000)
+
+
+if __name__ == '__main__':
+    main()